@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+"""
+benchmarks/json_codecs.py
+=========================
+This compares the JSON libraries `COUCHDB_JSON` can use (see
+`flask_couchdb.codec`), encoding and decoding documents and
+``include_docs`` view responses of a few sizes. Libraries that aren't
+installed are skipped. It doesn't need a CouchDB server.
+
+Run it with ``python benchmarks/json_codecs.py [repeat]``.
+
+:copyright: 2010 Matthew "LeafStorm" Frazier
+:license:   MIT/X11, see LICENSE for details (part of Flask-CouchDB)
+"""
+import sys
+import time
+from flask_couchdb.codec import CODECS
+
+
+def make_doc(n, fields):
+    doc = {'_id': 'doc%06d' % n, '_rev': '1-%032x' % n,
+           'doc_type': 'blogpost', 'title': u'Post n\xb0%d' % n,
+           'tags': ['tag%d' % i for i in range(5)],
+           'created': '2010-06-01T12:00:00Z', 'score': n * 0.5}
+    for i in range(fields):
+        doc['field%d' % i] = 'value %d of document %d' % (i, n)
+    return doc
+
+
+def make_view(rows, fields):
+    docs = [make_doc(n, fields) for n in range(rows)]
+    return {'total_rows': rows, 'offset': 0,
+            'rows': [{'id': doc['_id'], 'key': doc['_id'], 'value': None,
+                      'doc': doc} for doc in docs]}
+
+
+PAYLOADS = [
+    ('small document', make_doc(0, 5)),
+    ('large document', make_doc(0, 500)),
+    ('view, 100 rows', make_view(100, 20)),
+    ('view, 1000 rows', make_view(1000, 20)),
+]
+
+
+def best_of(repeat, fn, arg):
+    best = None
+    for i in range(repeat):
+        started = time.time()
+        fn(arg)
+        elapsed = time.time() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main(repeat=20):
+    codecs = []
+    for name in sorted(CODECS):
+        try:
+            codecs.append((name, CODECS[name]()))
+        except ImportError:
+            print '%s is not installed, skipping it' % name
+    print '%-16s %-12s %9s %12s %12s' % ('payload', 'codec', 'bytes',
+                                         'encode ms', 'decode ms')
+    for label, payload in PAYLOADS:
+        for name, (decode, encode) in codecs:
+            text = encode(payload)
+            assert decode(text) == payload
+            print '%-16s %-12s %9d %12.3f %12.3f' % (
+                label, name, len(text.encode('utf-8')),
+                best_of(repeat, encode, payload) * 1000,
+                best_of(repeat, decode, text) * 1000)
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
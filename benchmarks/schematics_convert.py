@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+"""
+benchmarks/schematics_convert.py
+================================
+This compares the compiled converters of `schematics_document.Document`
+classes with schematics' generic import and export loops: wrapping JSON in
+documents, exporting documents to JSON, and getting an unchanged document's
+JSON ready to store, which validates it again on the generic path. It
+doesn't need a CouchDB server.
+
+Run it with ``python benchmarks/schematics_convert.py [docs] [fields]``.
+
+:copyright: 2010 Matthew "LeafStorm" Frazier
+:license:   MIT/X11, see LICENSE for details (part of Flask-CouchDB)
+"""
+import sys
+import time
+from couchdb_schematics.document import Document as BaseDocument
+from flask_couchdb import schematics_document
+from flask_couchdb.schematics_document import (StringType, IntType,
+                                               DateTimeType, ListType)
+
+
+def make_class(fields):
+    attrs = dict(('field%d' % i, StringType()) for i in range(fields))
+    attrs.update(score=IntType(), created=DateTimeType(),
+                 tags=ListType(StringType()))
+    return type('BlogPost', (schematics_document.Document,), attrs)
+
+
+def make_doc(n, fields):
+    doc = {'_id': u'doc%06d' % n, '_rev': u'1-%032x' % n,
+           'doc_type': u'BlogPost', 'score': n,
+           'created': u'2010-06-01T12:00:00Z',
+           'tags': [u'tag%d' % i for i in range(5)]}
+    for i in range(fields):
+        doc['field%d' % i] = u'value %d of document %d' % (i, n)
+    return doc
+
+
+def timed(fn, items):
+    started = time.time()
+    for item in items:
+        fn(item)
+    return time.time() - started
+
+
+def generic_to_json(doc):
+    doc.validate()
+    return BaseDocument.to_primitive(doc)
+
+
+def main(count=2000, fields=20):
+    cls = make_class(fields)
+    raw = [make_doc(n, fields) for n in range(count)]
+    docs = [cls.wrap(data) for data in raw]
+    for doc in docs:
+        cls._converter.to_json(doc)
+    print '%-10s %12s %12s' % ('', 'generic ms', 'compiled ms')
+    for label, generic, compiled, items in [
+            ('wrap', cls, cls.wrap, raw),
+            ('export', BaseDocument.to_primitive, cls.to_primitive, docs),
+            ('store', generic_to_json, cls._converter.to_json, docs)]:
+        print '%-10s %12.1f %12.1f' % (label, timed(generic, items) * 1000,
+                                       timed(compiled, items) * 1000)
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+"""
+benchmarks/startup.py
+=====================
+This measures how long it takes to register the views of a lot of document
+classes with `CouchDB.add_document`, which happens every time an
+application starts. It compares it with the old way of finding the views,
+going through ``dir`` and ``getattr``. It doesn't need a CouchDB server.
+
+Run it with ``python benchmarks/startup.py [classes] [fields] [views]``.
+
+:copyright: 2010 Matthew "LeafStorm" Frazier
+:license:   MIT/X11, see LICENSE for details (part of Flask-CouchDB)
+"""
+import sys
+import time
+from couchdb.design import ViewDefinition as CouchDBViewDefinition
+from flask_couchdb import CouchDB, Document, TextField, ViewField
+from flask_couchdb import schematics_document
+
+MAP_FUN = '''\
+function (doc) {
+    if (doc.doc_type == '%s') {
+        emit(doc.field0, doc);
+    };
+}'''
+
+
+def make_classes(count, fields, views):
+    classes = []
+    for n in range(count):
+        doc_type = 'type%d' % n
+        attrs = dict(('field%d' % i, TextField()) for i in range(fields))
+        attrs.update(('view%d' % i, ViewField(doc_type, MAP_FUN % doc_type))
+                     for i in range(views))
+        attrs['doc_type'] = doc_type
+        classes.append(type('Doc%d' % n, (Document,), attrs))
+        attrs = dict(('field%d' % i, schematics_document.StringType())
+                     for i in range(fields))
+        attrs.update(('view%d' % i, ViewField(doc_type + '_schematics',
+                                              MAP_FUN % doc_type))
+                     for i in range(views))
+        classes.append(type('SchematicsDoc%d' % n,
+                            (schematics_document.Document,), attrs))
+    return classes
+
+
+def dir_viewdefs(dc):
+    viewdefs = []
+    for name in dir(dc):
+        try:
+            item = getattr(dc, name)
+            if isinstance(item, CouchDBViewDefinition):
+                viewdefs.append(item)
+        except:
+            pass
+    return viewdefs
+
+
+def timed(label, fn, classes, repeat=5):
+    best = None
+    for i in range(repeat):
+        started = time.time()
+        fn(classes)
+        elapsed = time.time() - started
+        best = elapsed if best is None else min(best, elapsed)
+    print '%-20s %8.2f ms' % (label, best * 1000)
+    return best
+
+
+def main(count=250, fields=30, views=3):
+    classes = make_classes(count, fields, views)
+    print '%d classes, %d fields and %d views each' % (len(classes), fields,
+                                                       views)
+
+    def with_dir(classes):
+        for dc in classes:
+            dir_viewdefs(dc)
+
+    def with_add_document(classes):
+        manager = CouchDB()
+        for dc in classes:
+            manager.add_document(dc)
+
+    def with_add_all_documents(classes):
+        CouchDB().add_all_documents()
+
+    old = timed('dir/getattr', with_dir, classes)
+    new = timed('add_document', with_add_document, classes)
+    timed('add_all_documents', with_add_all_documents, classes)
+    print 'speedup: %.1fx' % (old / new)
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
@@ -13,13 +13,29 @@ CouchDB database server easier.
 """
 
 from flask_couchdb.manager import CouchDB
-from flask_couchdb.views import ViewDefinition, ViewField
-from flask_couchdb.pagination import Page, Row, paginate 
+from flask_couchdb.pool import ConnectionPool, PoolTimeout
+from flask_couchdb.cache import (IdentityMap, LRUCache, DocumentCache,
+                                 SequenceCache)
+from flask_couchdb.bulk import BulkResult
+from flask_couchdb.retry import ConflictStats
+from flask_couchdb.changes import ChangesFeed
+from flask_couchdb.design import SyncLockTimeout
+from flask_couchdb.views import ViewDefinition, ViewField, ViewCache
+from flask_couchdb.records import Record, record_class
+from flask_couchdb.pagination import (Page, PageCache, Row, paginate,
+                                      paginate_async, iterate_view)
 from flask_couchdb.document import *
 from flask_couchdb.document import __all__ as document_all
 import flask_couchdb.schematics_document as schematics_document
-
-__all__ = ['CouchDB', 'ViewDefinition', 'ViewField', 'Row', 'paginate', 'schematics_document']
+import flask_couchdb.codec as codec
+
+__all__ = ['CouchDB', 'ConnectionPool', 'PoolTimeout', 'IdentityMap',
+           'LRUCache', 'DocumentCache', 'SequenceCache', 'BulkResult',
+           'ConflictStats', 'ChangesFeed', 'SyncLockTimeout',
+           'ViewDefinition', 'ViewField',
+           'ViewCache', 'Record', 'record_class', 'PageCache', 'Row',
+           'paginate', 'paginate_async', 'iterate_view', 'schematics_document',
+           'codec']
 __all__.extend( document_all )
 
 
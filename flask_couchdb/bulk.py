@@ -0,0 +1,200 @@
+# -*- coding: utf-8 -*-
+"""
+
+flask_couchdb.bulk
+~~~~~~~~~~~~~~~~~~
+
+Helpers for loading and saving many documents in a few requests, shared by
+both `Document` classes.
+
+:copyright: 2010 Matthew "LeafStorm" Frazier
+:license:   MIT/X11, see LICENSE for details
+
+"""
+
+from couchdb.http import ResourceConflict
+from flask_couchdb.cache import (current_identity_map, current_document_cache,
+                                 document_stored, document_deleted)
+
+__all__ = ['BulkResult']
+
+#: The default number of documents sent or requested in one request.
+BATCH_SIZE = 1000
+
+
+class BulkResult(object):
+    """
+    This is the outcome of saving or deleting several documents at once. It
+    holds one ``(doc, ok, rev_or_exc)`` tuple per document, in the order
+    they were given, where `rev_or_exc` is the new revision if `ok` is
+    `True` and the exception describing the failure otherwise. Iterating
+    over it yields those tuples.
+    """
+    def __init__(self, results=None):
+        self.results = results or []
+
+    def __len__(self):
+        return len(self.results)
+
+    def __iter__(self):
+        return iter(self.results)
+
+    def __nonzero__(self):
+        return self.ok
+
+    def __repr__(self):
+        return '<%s %d succeeded, %d failed>' % (
+            type(self).__name__, len(self.succeeded), len(self.failed))
+
+    @property
+    def ok(self):
+        """Whether every document was saved."""
+        return all(ok for doc, ok, rev in self.results)
+
+    @property
+    def succeeded(self):
+        """The documents that were saved."""
+        return [doc for doc, ok, rev in self.results if ok]
+
+    @property
+    def failed(self):
+        """The documents that were not saved, for whatever reason."""
+        return [doc for doc, ok, exc in self.results if not ok]
+
+    @property
+    def conflicts(self):
+        """
+        The documents that were not saved because of a revision conflict.
+        These can be reloaded and retried.
+        """
+        return [doc for doc, ok, exc in self.results
+                if not ok and isinstance(exc, ResourceConflict)]
+
+    @property
+    def errors(self):
+        """``(doc, exc)`` pairs for every document that was not saved."""
+        return [(doc, exc) for doc, ok, exc in self.results if not ok]
+
+
+def chunks(items, size):
+    """
+    This splits a list into consecutive lists of at most `size` items.
+    """
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+def load_documents(cls, db, ids, batch_size=BATCH_SIZE):
+    """
+    This loads the documents with the given IDs through ``_all_docs``, one
+    request per `batch_size` IDs, and wraps them in `cls`. It returns a list
+    in the same order as `ids`, with `None` for any document that doesn't
+    exist. Documents already in the request's identity map are not fetched
+    again.
+
+    :param cls: The document class.
+    :param db: The database to load from.
+    :param ids: The document IDs.
+    :param batch_size: The maximum number of IDs to request at once.
+    """
+    ids = list(ids)
+    identity_map = current_identity_map()
+    document_cache = current_document_cache()
+    docs = {}
+    wanted = []
+    for id in ids:
+        if id in docs:
+            continue
+        doc = identity_map.get(db, id) if identity_map is not None else None
+        if isinstance(doc, cls):
+            docs[id] = doc
+        else:
+            docs[id] = None
+            wanted.append(id)
+    for batch in chunks(wanted, batch_size):
+        for row in db.view('_all_docs', keys=batch, include_docs=True):
+            data = row.doc
+            if data is None:
+                continue
+            if document_cache is not None:
+                document_cache.add(db, data)
+            doc = docs[row.key] = cls.wrap(data)
+            if identity_map is not None:
+                identity_map.add(db, doc)
+    return [docs[id] for id in ids]
+
+
+def store_documents(db, docs, to_json, saved, batch_size=BATCH_SIZE,
+                    unchanged=None):
+    """
+    This saves documents through ``_bulk_docs``, one request per
+    `batch_size` documents, and returns a `BulkResult`.
+
+    :param db: The database to save to.
+    :param docs: The document instances.
+    :param to_json: A function that returns the JSON data to send for a
+                    document, or raises an exception if it can't be saved
+                    (because it doesn't validate, for example). That
+                    exception is reported as the document's result.
+    :param saved: A function called with each saved document and its new
+                  ID and revision.
+    :param batch_size: The maximum number of documents to send at once.
+    :param unchanged: A function that tells whether a document hasn't
+                      changed since it was loaded or last saved. Those
+                      documents aren't sent, and are reported as saved with
+                      the revision they have.
+    """
+    docs = list(docs)
+    results = []
+    pending = []
+    for doc in docs:
+        try:
+            if unchanged is not None and unchanged(doc):
+                results.append((doc, True, doc.rev))
+                continue
+            pending.append((doc, to_json(doc)))
+        except Exception as e:
+            results.append((doc, False, e))
+    for batch in chunks(pending, batch_size):
+        outcome = db.update([data for doc, data in batch])
+        for (doc, data), (ok, id, rev) in zip(batch, outcome):
+            if ok:
+                saved(doc, id, rev)
+                document_stored(db, doc)
+            results.append((doc, ok, rev))
+    return _ordered(docs, results)
+
+
+def delete_documents(db, docs, batch_size=BATCH_SIZE):
+    """
+    This deletes documents through ``_bulk_docs``, one request per
+    `batch_size` documents, and returns a `BulkResult`. Each document must
+    have an ID and the revision being deleted.
+
+    :param db: The database to delete from.
+    :param docs: The document instances.
+    :param batch_size: The maximum number of documents to send at once.
+    """
+    docs = list(docs)
+    results = []
+    pending = []
+    for doc in docs:
+        if doc.id is None or doc.rev is None:
+            results.append((doc, False,
+                            ValueError('no valid document id and revision')))
+        else:
+            pending.append(doc)
+    for batch in chunks(pending, batch_size):
+        outcome = db.update([{'_id': doc.id, '_rev': doc.rev,
+                              '_deleted': True} for doc in batch])
+        for doc, (ok, id, rev) in zip(batch, outcome):
+            if ok:
+                document_deleted(db, id)
+            results.append((doc, ok, rev))
+    return _ordered(docs, results)
+
+
+def _ordered(docs, results):
+    position = dict((id(doc), index) for index, doc in enumerate(docs))
+    results.sort(key=lambda result: position[id(result[0])])
+    return BulkResult(results)
@@ -0,0 +1,423 @@
+# -*- coding: utf-8 -*-
+"""
+
+flask_couchdb.cache
+~~~~~~~~~~~~~~~~~~~
+
+Caches that let `Document.load` skip round-trips to the server.
+
+:copyright: 2010 Matthew "LeafStorm" Frazier
+:license:   MIT/X11, see LICENSE for details
+
+"""
+
+import copy
+import time
+import threading
+from collections import OrderedDict
+from couchdb.client import Document as RawDocument
+from couchdb.http import ResourceNotFound
+from flask import g, has_app_context
+
+__all__ = ['IdentityMap', 'LRUCache', 'DocumentCache', 'SequenceCache']
+
+
+class IdentityMap(object):
+    """
+    This keeps track of the documents loaded during a single request, so
+    that loading the same document again returns the instance that was
+    already loaded instead of fetching it from the database again. The
+    manager creates one for every request if `COUCHDB_IDENTITY_MAP` is set.
+
+    Documents are keyed by their database and ID.
+    """
+    def __init__(self):
+        self.documents = {}
+
+    def __len__(self):
+        return len(self.documents)
+
+    def get(self, db, id):
+        """
+        This returns the document with the given ID if it has been loaded or
+        stored in this request, or `None` otherwise.
+
+        :param db: The database the document lives in.
+        :param id: The document ID.
+        """
+        return self.documents.get((db.resource.url, id))
+
+    def add(self, db, doc):
+        """
+        This records a document that has been loaded or stored.
+
+        :param db: The database the document lives in.
+        :param doc: The document instance.
+        """
+        if doc.id is not None:
+            self.documents[(db.resource.url, doc.id)] = doc
+
+    def discard(self, db, id):
+        """
+        This forgets the document with the given ID, if it is known.
+
+        :param db: The database the document lives in.
+        :param id: The document ID.
+        """
+        self.documents.pop((db.resource.url, id), None)
+
+    def clear(self):
+        """This forgets every document."""
+        self.documents.clear()
+
+
+class LRUCache(object):
+    """
+    A thread-safe, bounded mapping that evicts the least recently used
+    entries once it holds more than `maxsize` of them, and entries older than
+    `ttl` seconds when they are looked up.
+
+    It counts `hits`, `misses` and `evictions`, which `stats` reports.
+
+    :param maxsize: The maximum number of entries.
+    :param ttl: The maximum age of an entry in seconds, or `None` to keep
+                entries until they are evicted for space.
+    """
+    def __init__(self, maxsize=1000, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.RLock()
+        self.hits = self.misses = self.evictions = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def get(self, key, default=None):
+        """
+        This returns the value stored under `key`, or `default` if there
+        isn't one (or it has expired).
+        """
+        with self.lock:
+            value = self._lookup(key, default)
+            if value is default:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return value
+
+    def put(self, key, value):
+        """
+        This stores `value` under `key`, evicting the least recently used
+        entries if the cache is full.
+        """
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = (time.time(), value)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def discard(self, key):
+        """This removes the entry for `key`, if there is one."""
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def clear(self):
+        """This removes every entry."""
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        """
+        This returns a dictionary with the `size` and `maxsize` of the cache
+        and its `hits`, `misses` and `evictions` counters.
+        """
+        with self.lock:
+            return {'size': len(self.entries), 'maxsize': self.maxsize,
+                    'hits': self.hits, 'misses': self.misses,
+                    'evictions': self.evictions}
+
+    def _lookup(self, key, default=None):
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return default
+        if self.ttl is not None and time.time() - entry[0] > self.ttl:
+            self.evictions += 1
+            return default
+        self.entries[key] = entry
+        return entry[1]
+
+
+class DocumentCache(LRUCache):
+    """
+    This is a process-wide cache of raw documents, shared by every request.
+    The manager creates one if `COUCHDB_DOCUMENT_CACHE_SIZE` is set, and
+    `Document.load` uses it.
+
+    A cached document is never returned without checking that it is still
+    current. The check is a ``HEAD`` request, which only returns headers,
+    and the ``ETag`` it returns is compared with the cached revision. (The
+    couchdb-python session can't report a ``304`` for a conditional ``GET``
+    unless it cached the response itself, so ``HEAD`` is used instead.)
+    Storing or deleting a document through a `Document` class removes it
+    from the cache.
+    """
+    def fetch(self, db, id):
+        """
+        This returns a fresh copy of the document with the given ID, from the
+        cache if the cached revision is current and from the database
+        otherwise. It returns `None` if the document doesn't exist.
+
+        :param db: The database the document lives in.
+        :param id: The document ID.
+        """
+        key = (db.resource.url, id)
+        with self.lock:
+            data = self._lookup(key)
+        if data is not None:
+            try:
+                _, headers, _ = _doc_resource(db, id).head()
+            except ResourceNotFound:
+                self.discard(key)
+                with self.lock:
+                    self.misses += 1
+                return None
+            if headers.get('etag', '').strip('"') == data['_rev']:
+                with self.lock:
+                    self.hits += 1
+                return RawDocument(copy.deepcopy(data))
+        with self.lock:
+            self.misses += 1
+        doc = db.get(id)
+        if doc is None:
+            self.discard(key)
+        else:
+            self.add(db, doc)
+        return doc
+
+    def add(self, db, data):
+        """
+        This caches a copy of a raw document that was just fetched.
+
+        :param db: The database the document lives in.
+        :param data: The document's JSON data.
+        """
+        self.put((db.resource.url, data['_id']), copy.deepcopy(dict(data)))
+
+    def invalidate(self, db, id):
+        """
+        This removes the document with the given ID from the cache.
+
+        :param db: The database the document lives in.
+        :param id: The document ID.
+        """
+        self.discard((db.resource.url, id))
+
+
+class SequenceCache(LRUCache):
+    """
+    This is a cache of things computed from a database, such as view
+    results, that are only valid until the database changes. Every entry is
+    stored along with the database's ``update_seq`` at the time, and only
+    returned while that is still the database's ``update_seq``.
+
+    Checking the ``update_seq`` takes a request, so it is checked at most
+    once every `interval` seconds per database, and lookups in between
+    don't touch the server at all. That means an entry can be returned up
+    to `interval` seconds after the database changed. Storing or deleting a
+    document through a `Document` class makes the next lookup check again
+    (see `expire`).
+
+    :param maxsize: The maximum number of entries.
+    :param ttl: The maximum age of an entry in seconds, or `None`.
+    :param interval: Seconds between checks of a database's ``update_seq``.
+    """
+    def __init__(self, maxsize=1000, ttl=None, interval=1.0):
+        LRUCache.__init__(self, maxsize, ttl)
+        self.interval = interval
+        self.seqs = {}
+
+    def update_seq(self, resource):
+        """
+        This returns the ``update_seq`` of a database, as it was at most
+        `interval` seconds ago.
+
+        :param resource: The database's `couchdb.http.Resource`.
+        """
+        with self.lock:
+            known = self.seqs.get(resource.url)
+        if known is not None and time.time() - known[1] < self.interval:
+            return known[0]
+        _, _, data = resource.get_json()
+        with self.lock:
+            self.seqs[resource.url] = (data['update_seq'], time.time())
+        return data['update_seq']
+
+    def expire(self, resource):
+        """
+        This makes the next lookup for a database check its ``update_seq``
+        again, because it is known to have changed.
+
+        :param resource: The database's `couchdb.http.Resource`.
+        """
+        with self.lock:
+            self.seqs.pop(resource.url, None)
+
+    def lookup(self, resource, key):
+        """
+        This returns the database's current ``update_seq`` and the value
+        stored under `key` for it, or `None` if there isn't one. Pass the
+        ``update_seq`` to `store` if the value has to be computed.
+
+        :param resource: The database's `couchdb.http.Resource`.
+        :param key: The key.
+        """
+        seq = self.update_seq(resource)
+        return seq, self.get((resource.url, seq, key))
+
+    def store(self, resource, seq, key, value):
+        """
+        This stores a value computed while the database's ``update_seq``
+        was `seq`. (Entries for older ``update_seq`` values are never
+        returned again, and get evicted as the cache fills up.)
+
+        :param resource: The database's `couchdb.http.Resource`.
+        :param seq: The ``update_seq`` `lookup` returned.
+        :param key: The key.
+        :param value: The value.
+        """
+        self.put((resource.url, seq, key), value)
+
+
+def _doc_resource(db, id):
+    if id.startswith('_design/'):
+        return db.resource('_design', id[8:])
+    return db.resource(id)
+
+
+def current_manager():
+    """
+    This returns the manager for the current request (``g.couch``), or
+    `None` if there isn't one.
+    """
+    if not has_app_context():
+        return None
+    return getattr(g, 'couch', None)
+
+
+def current_identity_map():
+    """
+    This returns the identity map for the current request, or `None` if
+    there isn't a request or the identity map is not enabled.
+    """
+    couch = current_manager()
+    return None if couch is None else couch.identity_map
+
+
+def current_document_cache():
+    """
+    This returns the manager's document cache, or `None` if there isn't a
+    manager in the current context or the cache is not enabled.
+    """
+    couch = current_manager()
+    return None if couch is None else couch.document_cache
+
+
+def load_document(cls, db, id, **options):
+    """
+    This loads the document with the given ID and wraps it in `cls`, going
+    through the request's identity map and the document cache if they are
+    enabled. Both `Document` classes load documents with this. If any
+    `options` (such as `rev`) are given, the caches are skipped.
+
+    :param cls: The document class.
+    :param db: The database to load from.
+    :param id: The document ID.
+    """
+    if options:
+        data = db.get(id, **options)
+        return None if data is None else cls.wrap(data)
+    identity_map = current_identity_map()
+    if identity_map is not None:
+        doc = identity_map.get(db, id)
+        if isinstance(doc, cls):
+            return doc
+    document_cache = current_document_cache()
+    if document_cache is not None:
+        data = document_cache.fetch(db, id)
+    else:
+        data = db.get(id)
+    if data is None:
+        return None
+    doc = cls.wrap(data)
+    if identity_map is not None:
+        identity_map.add(db, doc)
+    return doc
+
+
+def document_stored(db, doc, couch=None):
+    """
+    This updates the caches after a document has been stored. Documents
+    saved in the background by write-behind are stored outside of any
+    request, so the manager is passed as `couch` (and there is no identity
+    map to update).
+
+    :param db: The database the document was stored in.
+    :param doc: The document instance.
+    :param couch: The manager, if there isn't one in the current context.
+    """
+    if couch is None:
+        document_queued(db, doc)
+        couch = current_manager()
+        if couch is None:
+            return
+    if couch.document_cache is not None:
+        couch.document_cache.invalidate(db, doc.id)
+    _database_changed(db, couch)
+
+
+def document_queued(db, doc):
+    """
+    This adds a document queued for write-behind to the request's identity
+    map. The other caches are only updated once it has been written (see
+    `document_stored`), so they can't be filled with the old revision in
+    the meantime.
+
+    :param db: The database the document will be stored in.
+    :param doc: The document instance.
+    """
+    identity_map = current_identity_map()
+    if identity_map is not None:
+        identity_map.add(db, doc)
+
+
+def document_deleted(db, id):
+    """
+    This updates the caches after a document has been deleted.
+
+    :param db: The database the document was deleted from.
+    :param id: The document ID.
+    """
+    identity_map = current_identity_map()
+    if identity_map is not None:
+        identity_map.discard(db, id)
+    document_cache = current_document_cache()
+    if document_cache is not None:
+        document_cache.invalidate(db, id)
+    _database_changed(db)
+
+
+def _database_changed(db, couch=None):
+    if couch is None:
+        couch = current_manager()
+        if couch is None:
+            return
+    for cache in (couch.page_cache, couch.view_cache):
+        if cache is not None:
+            cache.expire(db.resource)
+    if couch.index_warmer is not None:
+        couch.index_warmer.touch(db)
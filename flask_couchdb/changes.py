@@ -0,0 +1,294 @@
+# -*- coding: utf-8 -*-
+"""
+
+flask_couchdb.changes
+~~~~~~~~~~~~~~~~~~~~~
+
+Following a database's ``_changes`` feed in the background, and passing
+the changes to handlers in batches.
+
+:copyright: 2010 Matthew "LeafStorm" Frazier
+:license:   MIT/X11, see LICENSE for details
+
+"""
+
+import os
+import time
+import threading
+import Queue
+from collections import deque
+from couchdb.http import ResourceConflict
+from flask_couchdb.design import read_local, write_local
+
+__all__ = ['ChangesFeed']
+
+#: The local (unreplicated) document the last handled sequence is saved in,
+#: unless the feed is given another name.
+CHECKPOINT = 'flask-couchdb-changes'
+
+
+class ChangesFeed(object):
+    """
+    This follows a database's ``_changes`` feed from a background thread
+    and passes the changes to handlers on a thread pool, so an application
+    can react to new and changed documents without polling views.
+
+    The feed is read with ``feed=longpoll`` (one request per batch) or
+    ``feed=continuous`` (one long-lived request), always with
+    ``include_docs``. The changes are collected into batches of up to
+    `batch_size`, each dispatched at most `interval` seconds after its
+    first change arrived. Every handler is called with a list of the
+    changes in the batch whose document has its `doc_type` (or all of
+    them, if it has none), and isn't called if there are none. Deleted
+    documents only reach handlers without a `doc_type`, unless the
+    deletion kept the document's fields.
+
+    At most `max_pending` batches are handled at the same time. When that
+    many are still running, the feed stops reading until the oldest one is
+    done, so slow handlers hold back the feed instead of letting changes
+    pile up in memory. Since batches run in parallel, set `max_pending`
+    to 1 if the handlers need to see the changes in order.
+
+    Once a batch and every batch before it have been handled, its last
+    sequence number is saved in the local document `checkpoint`, and a
+    feed that is started again picks up from there. (So a change is
+    handled at least once, but may be handled again if the process stops
+    before its checkpoint is saved.) If the feed can't be read, because
+    the connection was lost or the server is down, it waits `retry_delay`
+    seconds, doubling up to `max_retry_delay`, and resumes from the last
+    change it read.
+
+    :param db: The database.
+    :param handlers: A list of ``(fn, doc_type)`` pairs. It is read for
+                     every batch, so handlers can be added to it later.
+    :param submit: A function like `CouchDB.submit` that runs a function
+                   in the background and returns an `AsyncResult`.
+    :param feed: ``'longpoll'`` or ``'continuous'``.
+    :param batch_size: The maximum number of changes per batch.
+    :param interval: The maximum number of seconds a change waits for its
+                     batch to fill up.
+    :param max_pending: The maximum number of batches handled at once.
+    :param timeout: Seconds the server holds a request open when there are
+                    no changes.
+    :param checkpoint: The name of the local document, without
+                       ``_local/``.
+    :param retry_delay: Seconds to wait before reconnecting the first time.
+    :param max_retry_delay: The longest wait before reconnecting.
+    :param on_error: A function called with ``(changes, exc)`` when a
+                     handler fails, and with ``(None, exc)`` when the feed
+                     can't be read or the checkpoint can't be saved.
+    """
+    def __init__(self, db, handlers, submit, feed='longpoll', batch_size=100,
+                 interval=1.0, max_pending=4, timeout=60,
+                 checkpoint=CHECKPOINT, retry_delay=1.0,
+                 max_retry_delay=60.0, on_error=None):
+        if feed not in ('longpoll', 'continuous'):
+            raise ValueError('unknown feed %r' % feed)
+        self.db = db
+        self.handlers = handlers
+        self.submit = submit
+        self.feed = feed
+        self.batch_size = batch_size
+        self.interval = interval
+        self.max_pending = max_pending
+        self.timeout = timeout
+        self.checkpoint = checkpoint
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self.on_error = on_error
+        self.lock = threading.Lock()
+        self.stopping = None
+        self.pid = None
+        self.reader = self.dispatcher = None
+        self.queue = None
+        self.seq = self.checkpointed = None
+        self.saved = None
+        self.received = self.handled = self.failed = 0
+        self.batches = self.waits = self.reconnects = 0
+
+    @property
+    def running(self):
+        """Whether the feed is being followed."""
+        return self.dispatcher is not None and self.pid == os.getpid() \
+            and self.dispatcher.is_alive()
+
+    def start(self, since=None):
+        """
+        This starts following the feed, from the last checkpoint or from
+        `since`. It does nothing if the feed is already running.
+
+        :param since: The sequence number to start after, overriding the
+                      checkpoint. Optional.
+        """
+        with self.lock:
+            if self.running:
+                return self
+            self.saved = read_local(self.db, self.checkpoint) or {}
+            if since is None:
+                since = self.saved.get('since', 0)
+            self.seq = self.checkpointed = since
+            self.pid = os.getpid()
+            # a reader from before a restart may still be waiting on the
+            # server, so every run gets its own queue and stop event
+            self.stopping = threading.Event()
+            self.queue = Queue.Queue(self.batch_size * self.max_pending)
+            self.reader = threading.Thread(
+                target=self._read, args=(since, self.queue, self.stopping))
+            self.reader.daemon = True
+            self.dispatcher = threading.Thread(
+                target=self._run, args=(self.queue, self.stopping))
+            self.dispatcher.daemon = True
+            self.reader.start()
+            self.dispatcher.start()
+        return self
+
+    def stop(self, timeout=None):
+        """
+        This stops following the feed. The changes that were already read
+        are handled and checkpointed first, unless that takes longer than
+        `timeout` seconds.
+
+        :param timeout: The maximum number of seconds to wait.
+        """
+        if self.dispatcher is None or self.pid != os.getpid():
+            return
+        self.stopping.set()
+        self.dispatcher.join(timeout)
+
+    def stats(self):
+        """
+        This returns a dictionary with the last sequence number read
+        (`seq`) and checkpointed (`checkpoint`), the number of changes
+        waiting to be batched (`depth`), and running totals of changes
+        `received` and `handled`, of `batches`, of handler calls that
+        `failed`, of `waits` for a batch to finish before reading more,
+        and of `reconnects`.
+        """
+        with self.lock:
+            return {
+                'seq': self.seq,
+                'checkpoint': self.checkpointed,
+                'depth': self.queue.qsize() if self.queue is not None else 0,
+                'received': self.received,
+                'handled': self.handled,
+                'batches': self.batches,
+                'failed': self.failed,
+                'waits': self.waits,
+                'reconnects': self.reconnects,
+            }
+
+    def _error(self, changes, exc):
+        if self.on_error is not None:
+            try:
+                self.on_error(changes, exc)
+            except Exception:
+                pass
+
+    def _changes(self, since):
+        options = {'since': since, 'include_docs': True,
+                   'timeout': int(self.timeout * 1000)}
+        if self.feed == 'continuous':
+            # this ends with a last_seq line once the server times out
+            return self.db.changes(feed='continuous', **options)
+        data = self.db.changes(feed='longpoll', limit=self.batch_size,
+                               **options)
+        return data['results'] + [{'last_seq': data['last_seq']}]
+
+    def _read(self, since, queue, stopping):
+        delay = self.retry_delay
+        while not stopping.is_set():
+            try:
+                for change in self._changes(since):
+                    delay = self.retry_delay
+                    if 'last_seq' in change:
+                        since = change['last_seq']
+                        continue
+                    while not stopping.is_set():
+                        try:
+                            queue.put(change, True, self.interval)
+                            break
+                        except Queue.Full:
+                            pass
+                    else:
+                        return
+                    since = change['seq']
+                    with self.lock:
+                        self.seq = since
+                        self.received += 1
+            except Exception as e:
+                with self.lock:
+                    self.reconnects += 1
+                self._error(None, e)
+                stopping.wait(delay)
+                delay = min(delay * 2, self.max_retry_delay)
+
+    def _next_batch(self, queue):
+        try:
+            batch = [queue.get(True, self.interval)]
+        except Queue.Empty:
+            return []
+        deadline = time.time() + self.interval
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(queue.get(True, remaining))
+            except Queue.Empty:
+                break
+        return batch
+
+    def _run(self, queue, stopping):
+        pending = deque()
+        while not (stopping.is_set() and queue.empty()):
+            batch = self._next_batch(queue)
+            if batch:
+                if len(pending) >= self.max_pending:
+                    with self.lock:
+                        self.waits += 1
+                    self._finish(*pending.popleft())
+                pending.append((batch[-1]['seq'],
+                                self.submit(self._handle, batch)))
+            while pending and pending[0][1].ready():
+                self._finish(*pending.popleft())
+        while pending:
+            self._finish(*pending.popleft())
+
+    def _handle(self, batch):
+        for fn, doc_type in list(self.handlers):
+            if doc_type is None:
+                changes = batch
+            else:
+                changes = [change for change in batch
+                           if (change.get('doc') or {}).get('doc_type') ==
+                           doc_type]
+            if not changes:
+                continue
+            try:
+                fn(changes)
+            except Exception as e:
+                with self.lock:
+                    self.failed += 1
+                self._error(changes, e)
+        with self.lock:
+            self.handled += len(batch)
+            self.batches += 1
+
+    def _finish(self, seq, result):
+        result.wait()
+        self.saved['since'] = seq
+        try:
+            try:
+                write_local(self.db, self.checkpoint, self.saved)
+            except ResourceConflict:
+                # somebody else saved it too, so overwrite their revision
+                current = read_local(self.db, self.checkpoint) or {}
+                self.saved.pop('_rev', None)
+                if '_rev' in current:
+                    self.saved['_rev'] = current['_rev']
+                write_local(self.db, self.checkpoint, self.saved)
+        except Exception as e:
+            self._error(None, e)
+            return
+        with self.lock:
+            self.checkpointed = seq
@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+"""
+
+flask_couchdb.codec
+~~~~~~~~~~~~~~~~~~~
+
+Choosing the JSON library documents, view results and pagination tokens are
+encoded and decoded with.
+
+:copyright: 2010 Matthew "LeafStorm" Frazier
+:license:   MIT/X11, see LICENSE for details
+
+"""
+
+from couchdb import json as couchdb_json
+
+__all__ = ['CODECS', 'use', 'encode', 'decode']
+
+
+def _text(data):
+    # couchdb-python expects unicode, and some libraries return UTF-8 bytes
+    if isinstance(data, str):
+        return data.decode('utf-8')
+    return data
+
+
+def _stdlib():
+    import json
+    return (json.loads,
+            lambda obj: _text(json.dumps(obj, allow_nan=False,
+                                         ensure_ascii=False)))
+
+
+def _simplejson():
+    import simplejson
+    return (simplejson.loads,
+            lambda obj: _text(simplejson.dumps(obj, allow_nan=False,
+                                               ensure_ascii=False)))
+
+
+def _ujson():
+    import ujson
+    # ujson only writes 10 decimal places of a float unless told otherwise,
+    # and 15 is the most it can do
+    return (lambda data: ujson.loads(data, precise_float=True),
+            lambda obj: _text(ujson.dumps(obj, ensure_ascii=False,
+                                          double_precision=15)))
+
+
+#: The JSON libraries `use` knows by name, mapped to functions that import
+#: them and return a ``(decode, encode)`` pair. Only ``json`` comes with
+#: Python; the others have to be installed separately. (``ujson`` writes
+#: floats with at most 15 decimal places, so ones that need more, like
+#: ``1 / 3.0``, come back slightly different.)
+CODECS = {
+    'json': _stdlib,
+    'simplejson': _simplejson,
+    'ujson': _ujson,
+}
+
+
+def use(codec):
+    """
+    This makes all the JSON going to and from the server, as well as the
+    pagination tokens made by `paginate`, go through another JSON library.
+    Since couchdb-python only has one JSON setting, this affects every
+    database in the process. The manager calls this with its `COUCHDB_JSON`
+    setting.
+
+    :param codec: The name of a library in `CODECS`, or a ``(decode,
+                  encode)`` pair of functions. `decode` is passed a string,
+                  and `encode` has to return a (unicode) string.
+    """
+    if isinstance(codec, basestring):
+        try:
+            factory = CODECS[codec]
+        except KeyError:
+            raise ValueError('unknown JSON codec %r' % codec)
+        codec = factory()
+    decode, encode = codec
+    couchdb_json.use(decode=decode, encode=encode)
+
+
+def encode(obj):
+    """
+    This encodes `obj` as JSON with the codec in use.
+
+    :param obj: The value to encode.
+    """
+    return couchdb_json.encode(obj)
+
+
+def decode(data):
+    """
+    This decodes a JSON string with the codec in use.
+
+    :param data: The string to decode.
+    """
+    return couchdb_json.decode(data)
@@ -0,0 +1,271 @@
+# -*- coding: utf-8 -*-
+"""
+
+flask_couchdb.converter
+~~~~~~~~~~~~~~~~~~~~~~~
+
+Compiled conversion between CouchDB's JSON and `schematics_document.Document`
+instances.
+
+:copyright: 2010 Matthew "LeafStorm" Frazier
+:license:   MIT/X11, see LICENSE for details
+
+"""
+
+from collections import OrderedDict
+from couchdb_schematics.document import Document as BaseDocument
+from schematics.common import DROP, DEFAULT, NOT_NONE, NONEMPTY, PRIMITIVE
+from schematics.datastructures import Context
+from schematics.exceptions import FieldError, CompoundError
+from schematics.models import FieldDescriptor, ModelDict
+from schematics.role import Role
+from schematics.transforms import (import_converter, to_primitive_converter,
+                                   to_primitive)
+from schematics.types import (StringType, NumberType, BooleanType,
+                              DateTimeType, DateType, TimedeltaType,
+                              UUIDType, ListType, DictType, ModelType)
+from schematics.undefined import Undefined
+
+__all__ = ['Converter']
+
+#: The fields the server sets when a document is saved.
+SAVED_FIELDS = frozenset(['_id', '_rev'])
+
+#: The field types whose values can't be changed in place.
+IMMUTABLE_TYPES = (StringType, NumberType, BooleanType, DateTimeType,
+                   DateType, TimedeltaType, UUIDType)
+
+
+class Converter(object):
+    """
+    This converts the documents of one `schematics_document.Document`
+    subclass between CouchDB's JSON and instances, with the same results as
+    schematics' generic import and export loops. Every class gets one when
+    it is defined, which works out once what the generic loops work out
+    again for every document: the keys each field is read from and written
+    to, which fields are exported at all, and at what export level. Anything
+    the tables don't cover - an unknown key, a value that doesn't convert, a
+    custom ``__init__`` or role - goes through the generic path, so errors
+    are still raised by schematics itself.
+
+    :param cls: The document class.
+    """
+    def __init__(self, cls):
+        self.cls = cls
+        self.schema = schema = cls._schema
+        self.input_keys = frozenset(schema.valid_input_keys)
+        #: Whether `load` can stand in for ``cls(data)``.
+        self.stock_init = cls.__init__.im_func is BaseDocument.__init__.im_func
+        self.imports = []
+        self.setters = []
+        for name, field in schema.fields.items():
+            if getattr(field, 'fset', None) is not None:
+                self.setters.append(name)
+                continue
+            keys = tuple(key for key in field.get_input_keys()
+                         if key and key != name)
+            self.imports.append((name, field, keys))
+        #: The keys whose lists and dictionaries `load` may put in a
+        #: document as they are, instead of converting them to new ones.
+        self.shared_keys = tuple(self.setters) + tuple(
+            key for name, field, keys in self.imports
+            if not _detached(field) for key in (name,) + keys)
+
+        options = schema.options
+        self.ordered = options.export_order
+        role = options.roles.get(None)
+        if role is None:
+            role = options.roles.get('default')
+        #: Whether `export` can stand in for the default ``to_primitive``.
+        self.stock_role = role is None or isinstance(role, Role)
+        context = Context(export_level=None)
+        self.exports = []
+        for name, field in schema.fields.items():
+            if role is not None and self.stock_role and role(name, None):
+                continue
+            level = field.get_export_level(context)
+            if level == DROP:
+                continue
+            plain = isinstance(_descriptor(cls, name), FieldDescriptor)
+            self.exports.append((name, field.serialized_name or name, field,
+                                 level, plain))
+
+    def load(self, data):
+        """
+        This makes a document from its JSON, like ``cls(data)``.
+
+        :param data: The document's JSON, as a dictionary.
+        """
+        cls = self.cls
+        if not (self.stock_init and data and
+                self.input_keys.issuperset(data)):
+            return cls(data)
+        context = Context(initialized=True, field_converter=import_converter,
+                          trusted_data={}, mapping={}, partial=True,
+                          strict=True, init_values=True, apply_defaults=True,
+                          convert=True, validate=False, new=True, oo=True,
+                          recursive=False, app_data={})
+        converted = {}
+        for name, field, keys in self.imports:
+            value = data.get(name, Undefined)
+            if value is Undefined:
+                for key in keys:
+                    if key in data:
+                        value = data[key]
+                        break
+                else:
+                    value = field.default
+                    if value is Undefined:
+                        value = None
+            if value is not None:
+                try:
+                    value = field.convert(value, context)
+                except (FieldError, CompoundError):
+                    # let schematics collect the errors
+                    return cls(data)
+            converted[name] = value
+        for name in self.setters:
+            converted[name] = data.get(name, Undefined)
+        doc = cls.__new__(cls)
+        doc._data = ModelDict(converted=converted)
+        doc.doc_type = cls.__name__
+        return doc
+
+    def detached(self, data):
+        """
+        This returns whether a document `load` makes from `data` won't
+        share any of its lists or dictionaries, so changing the document
+        can't change `data`.
+
+        :param data: The document's JSON, as a dictionary.
+        """
+        for key in self.shared_keys:
+            if isinstance(data.get(key), (dict, list)):
+                return False
+        return True
+
+    def export(self, doc):
+        """
+        This returns a document's JSON, like ``doc.to_primitive()``.
+
+        :param doc: The document.
+        """
+        if not self.stock_role:
+            return to_primitive(self.schema, doc)
+        context = Context(initialized=True,
+                          field_converter=to_primitive_converter, role=None,
+                          raise_error_on_role=True, export_level=None,
+                          app_data={})
+        data = OrderedDict() if self.ordered else {}
+        values = doc._data
+        for name, key, field, level, plain in self.exports:
+            if plain:
+                value = values.get(name, Undefined)
+            else:
+                try:
+                    value = getattr(doc, name)
+                except Exception:
+                    value = Undefined
+            if value is not None and value is not Undefined:
+                value = field.export(value, PRIMITIVE, context)
+            if value is Undefined:
+                if level <= DEFAULT:
+                    continue
+                value = None
+            elif value is None:
+                if level <= NOT_NONE:
+                    continue
+            elif field.is_compound and len(value) == 0:
+                if level <= NONEMPTY:
+                    continue
+            data[key] = value
+        return data
+
+    def to_json(self, doc, validate=True, data=None):
+        """
+        This returns the JSON to save a document as, validating it first if
+        `validate` is set. A document that hasn't changed since it last
+        validated (apart from the ID and revision the server gave it when it
+        was saved) isn't validated again.
+
+        :param doc: The document.
+        :param validate: Whether to validate the document.
+        :param data: The document's JSON, if it was just exported.
+        """
+        if not validate:
+            return data if data is not None else self.export(doc)
+        validated = doc.__dict__.get('_validated')
+        converted = doc._data.converted
+        if validated is not None and all(
+                key in SAVED_FIELDS and type(value) is unicode
+                for key, value in converted.iteritems()):
+            if data is None:
+                data = self.export(doc)
+            if data == validated:
+                if converted:
+                    # what validating would have done with them
+                    valid = dict(doc._data.valid)
+                    valid.update(converted)
+                    doc._data.valid = valid
+                    doc._data.converted = {}
+                return data
+        doc.validate()
+        data = doc._validated = self.export(doc)
+        return data
+
+    def stored_json(self, doc):
+        """
+        This returns the JSON a document was loaded or last saved with, the
+        way `export` gives it, or `None` if it was never loaded or saved.
+
+        :param doc: The document.
+        """
+        stored = doc.__dict__.get('_stored')
+        if stored is None:
+            loaded = doc.__dict__.pop('_loaded', None)
+            if loaded is None:
+                return None
+            stored = doc._stored = self.export(self.load(loaded))
+        return stored
+
+    def saved(self, doc, id, rev, sent=None):
+        """
+        This records the ID and revision a document was saved with.
+
+        :param doc: The document.
+        :param id: Its ID.
+        :param rev: Its new revision.
+        :param sent: A copy of the JSON that was saved, if there is one.
+        """
+        doc._id = id
+        doc._rev = rev
+        for data in (doc.__dict__.get('_validated'), sent):
+            if data is not None:
+                data['_id'] = id
+                data['_rev'] = rev
+        if sent is not None:
+            doc._stored = sent
+
+
+def _detached(field, seen=None):
+    # whether converting a value for `field` always makes new lists and
+    # dictionaries
+    if isinstance(field, IMMUTABLE_TYPES):
+        return True
+    if isinstance(field, (ListType, DictType)):
+        return _detached(field.field, seen)
+    if isinstance(field, ModelType):
+        seen = seen or set()
+        if field.model_class in seen:
+            return True
+        seen.add(field.model_class)
+        return all(_detached(inner, seen)
+                   for inner in field.model_class._schema.fields.values())
+    return False
+
+
+def _descriptor(cls, name):
+    for klass in cls.__mro__:
+        if name in vars(klass):
+            return vars(klass)[name]
+    return None
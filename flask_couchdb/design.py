@@ -0,0 +1,208 @@
+# -*- coding: utf-8 -*-
+"""
+
+flask_couchdb.design
+~~~~~~~~~~~~~~~~~~~~
+
+Helpers for building the design documents for a set of view definitions,
+and for keeping track of which ones are already up to date.
+
+:copyright: 2010 Matthew "LeafStorm" Frazier
+:license:   MIT/X11, see LICENSE for details
+
+"""
+
+import os
+import time
+import socket
+import hashlib
+from couchdb.design import ViewDefinition as CouchDBViewDefinition
+from couchdb.http import ResourceConflict, ResourceNotFound
+from flask import json
+
+#: What is added to a design document's name to get the name of the design
+#: document its new version is staged in.
+STAGING_SUFFIX = '-staging'
+
+#: The local (unreplicated) document that records the hashes of the design
+#: documents as they were last synced.
+SYNC_STATE = 'flask-couchdb-sync'
+
+#: The local document that serves as a lock while a process syncs.
+SYNC_LOCK = 'flask-couchdb-sync-lock'
+
+
+class SyncLockTimeout(Exception):
+    """
+    Raised when another process held the sync lock for longer than `sync`
+    was willing to wait.
+    """
+
+
+class _Unsaved(object):
+    """
+    This stands in for a database when the design documents
+    `couchdb.design.ViewDefinition.sync_many` builds should be collected
+    instead of saved. It reads from the real database.
+    """
+    def __init__(self, db):
+        self.db = db
+        self.docs = []
+
+    def get(self, id, default=None):
+        return self.db.get(id, default)
+
+    def update(self, docs):
+        self.docs.extend(docs)
+        return []
+
+
+def changed_design_docs(db, viewdefs, remove_missing=False, callback=None):
+    """
+    This returns the design documents that have to be saved for the views
+    in the database to match `viewdefs`, without saving them. They are
+    built by `couchdb.design.ViewDefinition.sync_many` itself, which
+    normally saves them right away.
+
+    :param db: The database.
+    :param viewdefs: The view definitions.
+    :param remove_missing: Whether to remove views that aren't in
+                           `viewdefs` from the design documents.
+    :param callback: A function called with every design document that
+                     changed.
+    """
+    unsaved = _Unsaved(db)
+    CouchDBViewDefinition.sync_many(unsaved, viewdefs, remove_missing,
+                                    callback)
+    return unsaved.docs
+
+
+def design_name(doc_id):
+    """
+    This returns the name of a design document from its ID.
+
+    :param doc_id: The ID, starting with ``_design/``.
+    """
+    return doc_id[len('_design/'):]
+
+
+def staged_doc(doc, existing=None):
+    """
+    This returns a copy of a design document to be saved under its staging
+    name.
+
+    :param doc: The design document.
+    :param existing: The design document already saved under the staging
+                     name, if there is one.
+    """
+    staged = dict(doc)
+    staged['_id'] = doc['_id'] + STAGING_SUFFIX
+    staged.pop('_rev', None)
+    if existing is not None:
+        staged['_rev'] = existing['_rev']
+    return staged
+
+
+def design_hashes(viewdefs):
+    """
+    This returns a dictionary mapping the name of every design document in
+    `viewdefs` to a hash of its views, which changes whenever any of them
+    does.
+
+    :param viewdefs: The view definitions.
+    """
+    views = {}
+    for view in viewdefs:
+        views.setdefault(view.design, []).append(
+            [view.name, view.map_fun, view.reduce_fun, view.language,
+             view.options])
+    return dict((design, hashlib.sha1(
+                    json.dumps(sorted(specs), sort_keys=True)).hexdigest())
+                for design, specs in views.items())
+
+
+def read_local(db, name):
+    """
+    This returns the local document with the given name, or `None` if it
+    doesn't exist.
+
+    :param db: The database.
+    :param name: The name of the document, without ``_local/``.
+    """
+    try:
+        _, _, data = db.resource('_local', name).get_json()
+    except ResourceNotFound:
+        return None
+    return data
+
+
+def write_local(db, name, doc):
+    """
+    This saves a local document and sets its new revision on `doc`. It
+    raises `ResourceConflict` if `doc` doesn't have the current revision.
+
+    :param db: The database.
+    :param name: The name of the document, without ``_local/``.
+    :param doc: The document.
+    """
+    _, _, data = db.resource('_local', name).put_json(body=doc)
+    doc['_rev'] = data['rev']
+    return doc
+
+
+def record_hash(db, design, hash):
+    """
+    This records the hash of a single design document's views as synced,
+    for when it is only in place after the lock has been released (like
+    a staged design document once it has been swapped in).
+
+    :param db: The database.
+    :param design: The name of the design document.
+    :param hash: The hash, from `design_hashes`.
+    """
+    while True:
+        state = read_local(db, SYNC_STATE) or {'hashes': {}}
+        state['hashes'][design] = hash
+        try:
+            return write_local(db, SYNC_STATE, state)
+        except ResourceConflict:
+            # somebody else recorded theirs in the meantime
+            pass
+
+
+def acquire_sync_lock(db, timeout):
+    """
+    This tries to take the lock that makes sure only one process syncs a
+    database's design documents at a time. It returns the lock document if
+    it got the lock, or `None` if another process holds it. A lock that is
+    older than `timeout` seconds is considered abandoned and taken over.
+
+    :param db: The database.
+    :param timeout: Seconds after which a lock expires.
+    """
+    lock = {'owner': '%s:%d' % (socket.gethostname(), os.getpid()),
+            'expires': time.time() + timeout}
+    current = read_local(db, SYNC_LOCK)
+    if current is not None:
+        if current.get('expires', 0) > time.time():
+            return None
+        lock['_rev'] = current['_rev']
+    try:
+        return write_local(db, SYNC_LOCK, lock)
+    except ResourceConflict:
+        return None
+
+
+def release_sync_lock(db, lock):
+    """
+    This releases a lock taken with `acquire_sync_lock`.
+
+    :param db: The database.
+    :param lock: The lock document.
+    """
+    lock['expires'] = 0
+    try:
+        write_local(db, SYNC_LOCK, lock)
+    except ResourceConflict:
+        # it expired and somebody else took it over
+        pass
@@ -7,6 +7,14 @@ from couchdb.mapping import (Field, TextField, FloatField, IntegerField,
                              Mapping, DEFAULT)
 import couchdb
 import couchdb.mapping as mapping
+from flask_couchdb.cache import (load_document, document_stored,
+                                 document_queued)
+from flask_couchdb.writebehind import current_write_behind
+from flask_couchdb.bulk import (BATCH_SIZE, load_documents, store_documents,
+                                delete_documents)
+from flask_couchdb.updates import (snapshot, shallow_snapshot, field_changes,
+                                   current_update_handler, update_document)
+from flask_couchdb.retry import RETRIES, BACKOFF, update_with_retries
 
 __all__ = ["Document"]
 mapping.__all__.remove('ViewField')
@@ -23,6 +31,11 @@ class Document(mapping.Document):
     attribute on the class, every document will have a `doc_type` field
     automatically attached to it with that value. That way, you can tell
     different document types apart in views.
+    
+    Documents keep track of the fields that changed since they were loaded
+    or last stored (see `changed_fields`), so storing one that hasn't
+    changed doesn't do anything, and the ones that have can be saved by
+    sending only those fields (see `store`).
     """
     def __init__(self, raw_data=None):
         if raw_data is None:
@@ -31,13 +44,43 @@ class Document(mapping.Document):
         cls = type(self)
         if hasattr(cls, 'doc_type'):
             self._data['doc_type'] = cls.doc_type
+        self._stored = None
+    
+    @classmethod
+    def wrap(cls, data):
+        """
+        This makes a document from its JSON, and remembers a copy of it to
+        tell which fields change. The document keeps using `data`, so only
+        the lists and dictionaries in it are copied (see `shallow_snapshot`).
+        
+        :param data: The document's JSON, as a dictionary.
+        """
+        doc = super(Document, cls).wrap(data)
+        doc._stored = shallow_snapshot(data)
+        return doc
+    
+    def changed_fields(self):
+        """
+        This returns the names of the fields (as they are stored in the JSON)
+        that were changed or removed since the document was loaded or last
+        stored, in alphabetical order. For a document that was never loaded
+        or stored, that is all of them.
+        """
+        if self._stored is None:
+            return sorted(self._data)
+        fields, removed = field_changes(self._stored, self._data)
+        return sorted(fields.keys() + removed)
     
     @classmethod
     def load(cls, id, db=None):
         """
         This is used to retrieve a specific document from the database. If a
         database is not given, the thread-local database (``g.couch``) is
-        used. 
+        used. If the request's identity map is enabled and the document has
+        already been loaded or stored in this request, that instance is
+        returned without going to the database. If the manager's document
+        cache is enabled, a cached copy is used once its revision has been
+        checked.
         
         For compatibility with code used to the parameter ordering used in the
         original CouchDB library, the parameters can be given in reverse
@@ -48,14 +91,171 @@ class Document(mapping.Document):
         """
         if isinstance(id, couchdb.Database):
             id, db = db, id
-        return super(Document, cls).load(db or g.couch.db, id)
+        return load_document(cls, db or g.couch.db, id)
     
-    def store(self, db=None):
+    @classmethod
+    def load_async(cls, id, db=None):
+        """
+        This works like `load`, but loads the document on the manager's
+        thread pool (see `CouchDB.submit`). It returns an `AsyncResult`
+        right away, whose `get` method returns the document, so many
+        documents can be loaded at the same time.
+        
+        :param id: The document ID to load.
+        :param db: The database to use. Optional.
+        """
+        if isinstance(id, couchdb.Database):
+            id, db = db, id
+        return g.couch.submit(cls.load, id, db or g.couch.db)
+    
+    @classmethod
+    def load_many(cls, ids, db=None, batch_size=BATCH_SIZE):
+        """
+        This retrieves several documents at once, using one request to
+        ``_all_docs`` for every `batch_size` IDs instead of one request per
+        document. It returns a list in the same order as `ids`, with `None`
+        in place of any document that could not be found.
+        
+        :param ids: The document IDs to load.
+        :param db: The database to use. Optional.
+        :param batch_size: The maximum number of IDs to request at once.
+        """
+        return load_documents(cls, db or g.couch.db, ids, batch_size)
+    
+    def store(self, db=None, defer=None, partial=None):
         """
         This saves the document to the database. If a database is not given,
-        the thread-local database (``g.couch``) is used.
+        the thread-local database (``g.couch``) is used. If the document
+        hasn't changed since it was loaded or last stored, nothing is sent.
+        
+        If the manager's write-behind mode is on, the document is queued
+        and saved in the background, so its revision is not updated until
+        then.
+        
+        Otherwise, if the manager has an update handler (see
+        `COUCHDB_UPDATE_HANDLER`), a document that was loaded is saved by
+        sending only the fields that changed through it. It still raises
+        `ResourceConflict` if the document was changed on the server since
+        it was loaded.
+        
+        :param db: The database to use. Optional.
+        :param defer: Whether to queue the document for write-behind,
+                      overriding the manager's setting. Optional.
+        :param partial: Whether to send only the changed fields, overriding
+                        the manager's setting. Optional.
+        """
+        db = db or g.couch.db
+        data = self._data
+        stored = self._stored
+        if stored is not None and data == stored:
+            return self
+        queue = current_write_behind(defer)
+        handler = current_update_handler(partial)
+        if queue is not None:
+            queue.put(db, self, _to_json(self), _saved_as(snapshot(data)))
+            document_queued(db, self)
+            return self
+        if handler is not None and stored is not None:
+            _saved(self, self.id, update_document(db, handler, stored, data))
+        else:
+            mapping.Document.store(self, db)
+            self._stored = snapshot(data)
+        document_stored(db, self)
+        return self
+    
+    def store_async(self, db=None):
+        """
+        This works like `store`, but saves the document on the manager's
+        thread pool (see `CouchDB.submit`). It returns an `AsyncResult`
+        right away, whose `get` method returns the document once it has
+        been saved (or raises the error that prevented it).
+        
+        :param db: The database to use. Optional.
+        """
+        return g.couch.submit(self.store, db or g.couch.db, defer=False)
+    
+    @classmethod
+    def update(cls, id, fn, db=None, retries=RETRIES, backoff=BACKOFF):
+        """
+        This loads a fresh copy of a document from the database (skipping
+        the identity map and the document cache), calls `fn` with it to
+        change it in place and stores it right away (even in write-behind
+        mode). If that runs into a conflict because someone else saved the
+        document in the meantime, it is loaded again and `fn` is called with
+        the new copy, up to `retries` more times, so `fn` should work out
+        the change from the document it is given. If the document doesn't
+        exist, `fn` is given a new one with that ID. It returns the stored
+        document, or raises `ResourceConflict` once there are no retries
+        left.
+        
+        Before trying again, it waits a random time of up to `backoff`
+        seconds, doubling with every conflict, or as long as `backoff`
+        returns if it is a function (called with the number of conflicts
+        so far, from 0). Updates and their conflicts are counted by
+        `doc_type` in the manager's `conflict_stats`.
+        
+        :param id: The document ID to update.
+        :param fn: The function that changes the document.
+        :param db: The database to use. Optional.
+        :param retries: The number of times to try again after a conflict.
+        :param backoff: The base delay in seconds, or a function returning
+                        the delay.
+        """
+        return update_with_retries(cls, db or g.couch.db, id, fn,
+                                   lambda id: cls(dict(id=id)),
+                                   getattr(cls, 'doc_type', cls.__name__),
+                                   retries, backoff)
+    
+    @classmethod
+    def store_many(cls, docs, db=None, batch_size=BATCH_SIZE):
+        """
+        This saves several documents at once through ``_bulk_docs``, one
+        request per `batch_size` documents. The new revisions are set on the
+        documents that were saved. Documents that haven't changed since they
+        were loaded or last stored aren't sent. Unlike `store`, a conflict
+        does not raise an exception - instead, a `BulkResult` is returned
+        that tells which documents were saved and which ran into conflicts,
+        so those can be retried.
         
+        :param docs: The documents to save.
         :param db: The database to use. Optional.
+        :param batch_size: The maximum number of documents to send at once.
         """
-        return mapping.Document.store(self, db or g.couch.db)
+        return store_documents(db or g.couch.db, docs, _to_json, _saved,
+                               batch_size, _unchanged)
+    
+    @classmethod
+    def delete_many(cls, docs, db=None, batch_size=BATCH_SIZE):
+        """
+        This deletes several documents at once through ``_bulk_docs``, and
+        returns a `BulkResult` like `store_many`.
+        
+        :param docs: The documents to delete.
+        :param db: The database to use. Optional.
+        :param batch_size: The maximum number of documents to send at once.
+        """
+        return delete_documents(db or g.couch.db, docs, batch_size)
+
+
+def _to_json(doc):
+    return doc._data
+
+
+def _unchanged(doc):
+    return doc._stored is not None and doc._data == doc._stored
+
+
+def _saved(doc, id, rev):
+    doc._data['_id'] = id
+    doc._data['_rev'] = rev
+    doc._stored = snapshot(doc._data)
+
+
+def _saved_as(stored):
+    # write-behind saves the document later, when it may have changed again
+    def saved(doc, id, rev):
+        doc._data['_id'] = stored['_id'] = id
+        doc._data['_rev'] = stored['_rev'] = rev
+        doc._stored = stored
+    return saved
 
@@ -12,11 +12,36 @@ CouchDB database server easier.
 
 """
 
+import os
+import time
+import atexit
 import itertools
+import threading
 import couchdb
+from multiprocessing.pool import ThreadPool
+from couchdb.client import ViewResults
+from couchdb.http import Session
 from couchdb.design import ViewDefinition as CouchDBViewDefinition
 from flask import g, current_app
 from flask import _app_ctx_stack as stack
+from flask_couchdb import codec
+from flask_couchdb.cache import IdentityMap, DocumentCache, document_stored
+from flask_couchdb.pool import ConnectionPool
+from flask_couchdb.pagination import PageCache
+from flask_couchdb.views import ViewCache, document_viewdefs, fetch_rows
+from flask_couchdb.document import Document
+from flask_couchdb.schematics_document import Document as SchematicsDocument
+from flask_couchdb.warming import IndexWarmer, IndexBuild
+from flask_couchdb.design import (STAGING_SUFFIX, SYNC_STATE,
+                                  changed_design_docs, design_name,
+                                  staged_doc, design_hashes, read_local,
+                                  write_local, record_hash,
+                                  acquire_sync_lock, release_sync_lock,
+                                  SyncLockTimeout)
+from flask_couchdb.writebehind import WriteBehindQueue
+from flask_couchdb.updates import install_update_handler
+from flask_couchdb.retry import ConflictStats
+from flask_couchdb.changes import ChangesFeed, CHECKPOINT
 
 __all__ = ['CouchDB']
 
@@ -28,6 +53,104 @@ class CouchDB(object):
     This manages connecting to the database every request and synchronizing
     the view definitions to it.
     
+    Connections made by the manager itself go through a bounded
+    `ConnectionPool`, configured with these settings:
+    
+    `COUCHDB_POOL_SIZE`
+        The maximum number of connections to the server. (Defaults to 10.)
+    `COUCHDB_POOL_TIMEOUT`
+        Seconds to wait for a free connection before giving up, or `None`
+        to wait forever. (Defaults to `None`.)
+    `COUCHDB_KEEPALIVE`
+        Whether to reuse connections between requests. (Defaults to `True`.)
+    `COUCHDB_IDLE_TIMEOUT`
+        Seconds an unused connection is kept open. (Defaults to 60.)
+    `COUCHDB_CONNECT_TIMEOUT`, `COUCHDB_READ_TIMEOUT`
+        Socket timeouts, in seconds. (Default to `None`.)
+    
+    `COUCHDB_JSON` chooses the JSON library requests, responses and
+    pagination tokens are encoded and decoded with, such as ``'ujson'``
+    (see `flask_couchdb.codec.use`). It applies to the whole process.
+    (Defaults to `None`, which leaves couchdb-python's choice alone.)
+    
+    If `COUCHDB_IDENTITY_MAP` is set, every request gets an `IdentityMap`
+    (as `identity_map`), so loading the same document several times in one
+    request only fetches it once. (Defaults to `False`.)
+    
+    If `COUCHDB_DOCUMENT_CACHE_SIZE` is set, the manager keeps a
+    `DocumentCache` of that many documents (as `document_cache`), shared by
+    every request. Entries older than `COUCHDB_DOCUMENT_CACHE_TTL` seconds
+    are dropped. (Default to 0, meaning no cache, and `None`.)
+    
+    If `COUCHDB_PAGE_CACHE_SIZE` is set, `paginate` caches that many pages
+    in a `PageCache` (as `page_cache`). The database's ``update_seq`` is
+    checked every `COUCHDB_PAGE_CACHE_INTERVAL` seconds, and cached pages
+    are dropped when it changes. (Default to 0, meaning no cache, and 1.0.)
+    
+    If `COUCHDB_VIEW_CACHE_BYTES` is set, views that ask for it (see
+    `ViewDefinition`) cache up to that many bytes of results in a
+    `ViewCache` (as `view_cache`). The database's ``update_seq`` is checked
+    every `COUCHDB_VIEW_CACHE_INTERVAL` seconds, and cached results are
+    dropped when it changes. (Default to 0, meaning no cache, and 1.0.)
+    
+    `COUCHDB_VIEW_STALE` is the ``stale`` option views are queried with
+    unless they say otherwise (see `ViewDefinition`), such as ``'ok'`` or
+    ``'update_after'``. If `COUCHDB_INDEX_WARMER` is set, an `IndexWarmer`
+    (as `index_warmer`) updates the indexes of the registered views in the
+    background `COUCHDB_INDEX_WARMER_DELAY` seconds after documents are
+    written through a `Document` class, so stale reads stay close to
+    current. (Default to `None`, `False` and 1.0.) Failures to update an
+    index are passed to the `on_warm_error` callbacks.
+    
+    If `COUCHDB_SYNC_INCREMENTAL` is set, `sync` only saves the design
+    documents whose views changed since they were last synced, and only
+    one process syncs at a time, holding a lock for at most
+    `COUCHDB_SYNC_LOCK_TIMEOUT` seconds. The others wait for up to
+    `COUCHDB_SYNC_LOCK_WAIT` seconds before raising `SyncLockTimeout`.
+    (Default to `False`, 60 and 120.)
+    
+    Calls made with `submit` (and the ``*_async`` methods built on it) run
+    on a pool of `COUCHDB_WORKERS` threads. (Defaults to 10.)
+    
+    If `COUCHDB_WRITE_BEHIND` is set, `Document.store` queues documents on
+    a `WriteBehindQueue` (as `write_behind`) instead of saving them right
+    away. They are written in batches of `COUCHDB_WRITE_BEHIND_BATCH_SIZE`
+    documents, at most `COUCHDB_WRITE_BEHIND_INTERVAL` seconds after being
+    queued. At most `COUCHDB_WRITE_BEHIND_QUEUE_SIZE` documents wait, and
+    `store` blocks for up to `COUCHDB_WRITE_BEHIND_TIMEOUT` seconds when the
+    queue is full. (Default to `False`, 100, 1.0, 10000 and `None`.)
+    Otherwise there is no queue until a document is stored with
+    ``defer=True``. Any documents still waiting are written by `close`,
+    which is called when the process exits. If
+    `COUCHDB_WRITE_BEHIND_FLUSH_ON_TEARDOWN` is set, they are also written
+    (see `flush`) when an application context is torn down. That makes
+    every request wait for its writes, but suits jobs and scripts that run
+    in an application context of their own. (Defaults to `False`.)
+    
+    If `COUCHDB_UPDATE_HANDLER` is set to the name of an update handler (as
+    ``design/name``), `sync` saves `flask_couchdb.updates.UPDATE_HANDLER`
+    under that name, and `Document.store` saves documents that were loaded
+    by sending only the fields that changed through it, instead of the
+    whole document. (Defaults to `None`.)
+    
+    `Document.update` tries changes again when they run into a conflict,
+    and counts them for every type of document in a `ConflictStats` (as
+    `conflict_stats`), whose `stats` show where documents are most often
+    written at the same time.
+    
+    `follow_changes` starts a `ChangesFeed` (as `changes_feed`) that passes
+    the database's changes to the handlers added with `on_changes`. It
+    reads the feed with `COUCHDB_CHANGES_FEED` (``'longpoll'`` or
+    ``'continuous'``), in batches of up to `COUCHDB_CHANGES_BATCH_SIZE`
+    changes collected for at most `COUCHDB_CHANGES_INTERVAL` seconds, and
+    handles at most `COUCHDB_CHANGES_MAX_PENDING` batches at a time on the
+    thread pool. The server holds requests open for
+    `COUCHDB_CHANGES_TIMEOUT` seconds, progress is checkpointed in the
+    local document `COUCHDB_CHANGES_CHECKPOINT`, and after losing the
+    connection the feed reconnects after `COUCHDB_CHANGES_RETRY_DELAY`
+    seconds, doubling every time it fails. (Default to ``'longpoll'``,
+    100, 1.0, 4, 60, ``'flask-couchdb-changes'`` and 1.0.)
+    
     :param auto_sync: Whether to automatically sync the database every
                       request. (Defaults to `False`.)
     """
@@ -35,17 +158,114 @@ class CouchDB(object):
         self.doc_viewdefs = {}
         self.general_viewdefs = []
         self.sync_callbacks = []
+        self.write_error_callbacks = []
+        self.warm_error_callbacks = []
+        self.change_handlers = []
+        self.change_error_callbacks = []
         self.db = db
         self.server = server
+        self.pool = None
+        self.executor = None
+        self.executor_pid = None
+        self.executor_lock = threading.Lock()
+        self.executor_local = threading.local()
+        self.workers = 10
+        self.document_cache = None
+        self.page_cache = None
+        self.view_cache = None
+        self.view_stale = None
+        self.index_warmer = None
+        self.write_behind = None
+        self.write_behind_options = {}
+        self.write_behind_lock = threading.Lock()
+        self.defer_writes = False
+        self.update_handler = None
+        self.conflict_stats = ConflictStats()
+        self.changes_feed = None
         self.app = app
         if self.app is not None:
            self.init_app(app)
     
     def init_app(self, app):
+        app.config.setdefault('COUCHDB_POOL_SIZE', 10)
+        app.config.setdefault('COUCHDB_POOL_TIMEOUT', None)
+        app.config.setdefault('COUCHDB_KEEPALIVE', True)
+        app.config.setdefault('COUCHDB_IDLE_TIMEOUT', 60)
+        app.config.setdefault('COUCHDB_CONNECT_TIMEOUT', None)
+        app.config.setdefault('COUCHDB_READ_TIMEOUT', None)
+        app.config.setdefault('COUCHDB_JSON', None)
+        if app.config['COUCHDB_JSON'] is not None:
+            codec.use(app.config['COUCHDB_JSON'])
+        app.config.setdefault('COUCHDB_WORKERS', 10)
+        self.workers = app.config['COUCHDB_WORKERS']
+        app.config.setdefault('COUCHDB_IDENTITY_MAP', False)
+        app.config.setdefault('COUCHDB_DOCUMENT_CACHE_SIZE', 0)
+        app.config.setdefault('COUCHDB_DOCUMENT_CACHE_TTL', None)
+        if app.config['COUCHDB_DOCUMENT_CACHE_SIZE']:
+            self.document_cache = DocumentCache(
+                app.config['COUCHDB_DOCUMENT_CACHE_SIZE'],
+                app.config['COUCHDB_DOCUMENT_CACHE_TTL'])
+        app.config.setdefault('COUCHDB_PAGE_CACHE_SIZE', 0)
+        app.config.setdefault('COUCHDB_PAGE_CACHE_INTERVAL', 1.0)
+        if app.config['COUCHDB_PAGE_CACHE_SIZE']:
+            self.page_cache = PageCache(
+                app.config['COUCHDB_PAGE_CACHE_SIZE'],
+                app.config['COUCHDB_PAGE_CACHE_INTERVAL'])
+        app.config.setdefault('COUCHDB_VIEW_CACHE_BYTES', 0)
+        app.config.setdefault('COUCHDB_VIEW_CACHE_INTERVAL', 1.0)
+        if app.config['COUCHDB_VIEW_CACHE_BYTES']:
+            self.view_cache = ViewCache(
+                app.config['COUCHDB_VIEW_CACHE_BYTES'],
+                app.config['COUCHDB_VIEW_CACHE_INTERVAL'])
+        app.config.setdefault('COUCHDB_VIEW_STALE', None)
+        app.config.setdefault('COUCHDB_INDEX_WARMER', False)
+        app.config.setdefault('COUCHDB_INDEX_WARMER_DELAY', 1.0)
+        self.view_stale = app.config['COUCHDB_VIEW_STALE']
+        if app.config['COUCHDB_INDEX_WARMER']:
+            self.index_warmer = IndexWarmer(
+                self.index_views, app.config['COUCHDB_INDEX_WARMER_DELAY'],
+                on_error=self._warm_failed)
+        app.config.setdefault('COUCHDB_SYNC_INCREMENTAL', False)
+        app.config.setdefault('COUCHDB_SYNC_LOCK_TIMEOUT', 60)
+        app.config.setdefault('COUCHDB_SYNC_LOCK_WAIT', 120)
+        app.config.setdefault('COUCHDB_WRITE_BEHIND', False)
+        app.config.setdefault('COUCHDB_WRITE_BEHIND_BATCH_SIZE', 100)
+        app.config.setdefault('COUCHDB_WRITE_BEHIND_INTERVAL', 1.0)
+        app.config.setdefault('COUCHDB_WRITE_BEHIND_QUEUE_SIZE', 10000)
+        app.config.setdefault('COUCHDB_WRITE_BEHIND_TIMEOUT', None)
+        app.config.setdefault('COUCHDB_WRITE_BEHIND_FLUSH_ON_TEARDOWN', False)
+        self.defer_writes = app.config['COUCHDB_WRITE_BEHIND']
+        self.write_behind_options = dict(
+            batch_size=app.config['COUCHDB_WRITE_BEHIND_BATCH_SIZE'],
+            interval=app.config['COUCHDB_WRITE_BEHIND_INTERVAL'],
+            maxsize=app.config['COUCHDB_WRITE_BEHIND_QUEUE_SIZE'],
+            timeout=app.config['COUCHDB_WRITE_BEHIND_TIMEOUT'])
+        if self.defer_writes:
+            self.get_write_behind()
+        app.teardown_appcontext(self._teardown)
+        app.config.setdefault('COUCHDB_UPDATE_HANDLER', None)
+        self.update_handler = app.config['COUCHDB_UPDATE_HANDLER']
+        app.config.setdefault('COUCHDB_CHANGES_FEED', 'longpoll')
+        app.config.setdefault('COUCHDB_CHANGES_BATCH_SIZE', 100)
+        app.config.setdefault('COUCHDB_CHANGES_INTERVAL', 1.0)
+        app.config.setdefault('COUCHDB_CHANGES_MAX_PENDING', 4)
+        app.config.setdefault('COUCHDB_CHANGES_TIMEOUT', 60)
+        app.config.setdefault('COUCHDB_CHANGES_CHECKPOINT', CHECKPOINT)
+        app.config.setdefault('COUCHDB_CHANGES_RETRY_DELAY', 1.0)
         app.before_request(self.request_start)
 
     def request_start(self):
         g.couch = self
+        if current_app.config.get('COUCHDB_IDENTITY_MAP'):
+            g.couch_identity_map = IdentityMap()
+
+    @property
+    def identity_map(self):
+        """
+        The `IdentityMap` for the current request, or `None` if it is not
+        enabled (or there is no request).
+        """
+        return getattr(g, 'couch_identity_map', None)
 
     def all_viewdefs(self):
         """
@@ -55,6 +275,17 @@ class CouchDB(object):
         return itertools.chain(self.general_viewdefs,
                                *self.doc_viewdefs.itervalues())
     
+    def index_views(self):
+        """
+        This returns a dictionary mapping the name of every design document
+        with registered views to the name of one of its views, which is
+        enough to update all of its indexes.
+        """
+        views = {}
+        for viewdef in self.all_viewdefs():
+            views.setdefault(viewdef.design, viewdef.name)
+        return views
+    
     def add_document(self, dc):
         """
         This adds all the view definitions from a document class so they will
@@ -62,17 +293,31 @@ class CouchDB(object):
         
         :param dc: The class to add. It should be a subclass of `Document`.
         """
-        viewdefs = []
-        for name in dir(dc):
-            try:
-                item = getattr(dc, name)
-                if isinstance(item, CouchDBViewDefinition):
-                    viewdefs.append(item)
-            except:
-                pass
+        viewdefs = document_viewdefs(dc)
         if viewdefs:
             self.doc_viewdefs[dc] = viewdefs
     
+    def add_all_documents(self, base=None):
+        """
+        This adds the view definitions from every document class defined so
+        far (that is, every subclass of `Document` and
+        `schematics_document.Document`), so they don't have to be added one
+        at a time with `add_document`. Classes defined later aren't added,
+        so call this once all the models have been imported.
+        
+        :param base: Only add subclasses of this class. Optional.
+        """
+        pending = [base] if base is not None else [Document,
+                                                   SchematicsDocument]
+        seen = set()
+        while pending:
+            cls = pending.pop()
+            for subclass in cls.__subclasses__():
+                if subclass not in seen:
+                    seen.add(subclass)
+                    pending.append(subclass)
+                    self.add_document(subclass)
+    
     def add_viewdef(self, viewdef):
         """
         This adds standalone view definitions (it should be a `ViewDefinition`
@@ -96,6 +341,11 @@ class CouchDB(object):
         are called in the order they are added, but you shouldn't rely on
         that.
         
+        The exception is ``sync(staged=True)``: the callbacks run once the
+        new design documents are saved under their staging names, which is
+        before they replace the real ones. Until the `IndexBuild` it returns
+        is ready, the views still answer with the old definitions.
+        
         If you can reliably detect whether it is necessary, this may be a good
         place to add default data. However, the callbacks could theoretically
         be run on every request, so it is a bad idea to insert the default
@@ -105,6 +355,257 @@ class CouchDB(object):
         """
         self.sync_callbacks.append(fn)
     
+    def on_write_error(self, fn):
+        """
+        This adds a callback to run when a document queued for write-behind
+        could not be saved. It is passed the document and the exception
+        (usually a `couchdb.http.ResourceConflict`). It runs on the
+        background thread, so it can't rely on the thread locals.
+        
+        :param fn: The callback function to add.
+        """
+        self.write_error_callbacks.append(fn)
+    
+    def _write_failed(self, doc, exc):
+        for callback in self.write_error_callbacks:
+            callback(doc, exc)
+    
+    def _write_saved(self, db, doc):
+        document_stored(db, doc, self)
+    
+    def on_warm_error(self, fn):
+        """
+        This adds a callback to run when the `IndexWarmer` fails to update
+        the indexes of a design document. It is passed the database, the
+        name of the design document and the exception. It runs on the
+        warmer's background thread, so it can't rely on the thread locals.
+        
+        :param fn: The callback function to add.
+        """
+        self.warm_error_callbacks.append(fn)
+    
+    def _warm_failed(self, db, design, exc):
+        for callback in self.warm_error_callbacks:
+            callback(db, design, exc)
+    
+    def on_changes(self, fn, doc_type=None):
+        """
+        This adds a handler for the database's changes, which are passed to
+        it in batches once `follow_changes` has been called. It is called
+        with a list of changes, as they appear in the ``_changes`` feed,
+        each with the changed document as ``doc``. It runs on the manager's
+        thread pool, in an application context (see `submit`).
+        
+        :param fn: The handler to add.
+        :param doc_type: Only pass the handler changes to documents with
+                         this `doc_type`, such as ``Signature.doc_type``.
+                         Optional.
+        """
+        self.change_handlers.append((fn, doc_type))
+        return fn
+    
+    def on_change_error(self, fn):
+        """
+        This adds a callback to run when a handler added with `on_changes`
+        raises an exception. It is passed the changes the handler was
+        called with and the exception, or `None` and the exception if the
+        changes feed itself can't be read or checkpointed.
+        
+        :param fn: The callback function to add.
+        """
+        self.change_error_callbacks.append(fn)
+    
+    def _change_failed(self, changes, exc):
+        for callback in self.change_error_callbacks:
+            callback(changes, exc)
+    
+    def follow_changes(self, app=None, since=None):
+        """
+        This starts following the database's ``_changes`` feed in the
+        background, passing the changes to the handlers added with
+        `on_changes`, and returns the `ChangesFeed`. It picks up after the
+        last change that was handled before, unless `since` is given. If
+        the feed is already being followed, it is returned as-is.
+        
+        :param app: The app to get the settings from, and to run the
+                    handlers in. Defaults to the current app.
+        :param since: The sequence number to start after. Optional.
+        """
+        if self.changes_feed is not None and self.changes_feed.running:
+            return self.changes_feed
+        # the handlers run on the feed's own threads, which have no
+        # application context to find the app in
+        app = app or self.app or current_app._get_current_object()
+        config = app.config
+        self.changes_feed = ChangesFeed(
+            self.connect_db(app), self.change_handlers,
+            self._submit_for(app),
+            feed=config['COUCHDB_CHANGES_FEED'],
+            batch_size=config['COUCHDB_CHANGES_BATCH_SIZE'],
+            interval=config['COUCHDB_CHANGES_INTERVAL'],
+            max_pending=config['COUCHDB_CHANGES_MAX_PENDING'],
+            timeout=config['COUCHDB_CHANGES_TIMEOUT'],
+            checkpoint=config['COUCHDB_CHANGES_CHECKPOINT'],
+            retry_delay=config['COUCHDB_CHANGES_RETRY_DELAY'],
+            on_error=self._change_failed)
+        return self.changes_feed.start(since)
+    
+    def get_write_behind(self):
+        """
+        This returns the `WriteBehindQueue` documents are deferred to,
+        creating it the first time and arranging for `close` to be called
+        when the process exits.
+        """
+        with self.write_behind_lock:
+            if self.write_behind is None:
+                self.write_behind = WriteBehindQueue(
+                    on_error=self._write_failed, on_saved=self._write_saved,
+                    **self.write_behind_options)
+                atexit.register(self.close)
+            return self.write_behind
+    
+    def flush(self):
+        """
+        This blocks until every document queued for write-behind has been
+        written.
+        """
+        if self.write_behind is not None:
+            self.write_behind.flush()
+    
+    def close(self):
+        """
+        This writes every document still queued for write-behind and stops
+        its background thread. It is called when the process exits (once
+        there is a queue), but can be called earlier to shut the manager
+        down cleanly (a document stored after that starts the thread
+        again).
+        """
+        if self.write_behind is not None:
+            self.write_behind.close()
+    
+    def _teardown(self, exc):
+        if current_app.config.get('COUCHDB_WRITE_BEHIND_FLUSH_ON_TEARDOWN'):
+            self.flush()
+    
+    def submit(self, fn, *args, **kwargs):
+        """
+        This calls `fn` with the given arguments on the manager's thread pool
+        and returns a `multiprocessing.pool.AsyncResult` right away. Its
+        `~AsyncResult.get` method waits for and returns the result (or
+        raises the exception `fn` raised).
+        
+        The call runs in an application context where ``g.couch`` is this
+        manager and the current request's identity map (if any) is shared,
+        so `fn` can use the same helpers a view function can. All the
+        calls share the manager's connection pool.
+        
+        A call that is made from one of the pool's own threads and waits
+        for a call it submits can deadlock the pool, so check `on_worker`
+        first and make the call inline.
+        
+        :param fn: The function to call.
+        """
+        app = current_app._get_current_object() if stack.top else self.app
+        identity_map = self.identity_map if stack.top else None
+        return self.get_executor().apply_async(
+            self._run_in_context, (app, identity_map, fn, args, kwargs))
+    
+    def _submit_for(self, app):
+        # like `submit`, for background threads that have no application
+        # context of their own to take the app from
+        def submit(fn, *args, **kwargs):
+            return self.get_executor().apply_async(
+                self._run_in_context, (app, None, fn, args, kwargs))
+        return submit
+    
+    def gather(self, *calls, **options):
+        """
+        This runs several independent calls at the same time on the
+        manager's thread pool (see `submit`), waits for them, and returns
+        their results in the same order. Each call can be a `ViewResults`
+        (what you get by calling or slicing a view), whose rows are fetched,
+        or any function that takes no arguments, for example::
+        
+            posts, authors, post = g.couch.gather(
+                BlogPost.by_date(limit=10),
+                Author.all(),
+                lambda: BlogPost.load(post_id),
+                timeout=5)
+        
+        A call that fails does not affect the others - the exception it
+        raised is put in its place in the results instead. A call that is
+        still running after `timeout` seconds gets a
+        `multiprocessing.TimeoutError` in its place.
+        
+        On one of the pool's own threads (in a call made with `submit` or an
+        `on_changes` handler, for example), the calls are made one after the
+        other instead, since waiting for them could deadlock the pool, and
+        `timeout` is not enforced.
+        
+        :param calls: The calls to make.
+        :param timeout: Seconds to wait for the calls, or `None` to wait as
+                        long as they take.
+        """
+        timeout = options.pop('timeout', None)
+        if options:
+            raise TypeError('unexpected keyword arguments: %s' %
+                            ', '.join(options))
+        if self.on_worker():
+            results = []
+            for call in calls:
+                try:
+                    results.append(_run_call(call))
+                except Exception as e:
+                    results.append(e)
+            return results
+        pending = [self.submit(_run_call, call) for call in calls]
+        deadline = None if timeout is None else time.time() + timeout
+        results = []
+        for result in pending:
+            if deadline is not None:
+                remaining = max(deadline - time.time(), 0)
+            else:
+                remaining = None
+            try:
+                results.append(result.get(remaining))
+            except Exception as e:
+                results.append(e)
+        return results
+    
+    def get_executor(self):
+        """
+        This returns the thread pool `submit` uses, creating it the first
+        time (and again in a child process after a fork).
+        """
+        with self.executor_lock:
+            if self.executor is None or self.executor_pid != os.getpid():
+                self.executor = ThreadPool(self.workers)
+                self.executor_pid = os.getpid()
+            return self.executor
+    
+    def on_worker(self):
+        """
+        This returns whether the current thread is one of the manager's pool
+        threads. Code that may itself be running on the pool (like
+        `paginate_async`) checks this and runs a call inline instead of
+        submitting it and waiting - with every thread waiting on a call
+        queued behind it, the pool would deadlock.
+        """
+        return getattr(self.executor_local, 'active', False)
+    
+    def _run_in_context(self, app, identity_map, fn, args, kwargs):
+        self.executor_local.active = True
+        try:
+            if app is None:
+                return fn(*args, **kwargs)
+            with app.app_context():
+                g.couch = self
+                if identity_map is not None:
+                    g.couch_identity_map = identity_map
+                return fn(*args, **kwargs)
+        finally:
+            self.executor_local.active = False
+    
     def connect_db(self, app=None):
         """
         This connects to the database for the given app. It presupposes that
@@ -114,19 +615,60 @@ class CouchDB(object):
         :param app: The app to get the settings from.
         """
         if self.db: return self.db
-        self.server = couchdb.Server( app.config['COUCHDB_SERVER'] )
+        app = app or self.app or current_app
+        self.connect_server(app)
         self.db = self.get_or_create_db( app.config['COUCHDB_DATABASE'] )
         return self.db
 
+    def connect_server(self, app=None):
+        """
+        This connects to the server given by `COUCHDB_SERVER`, sending all
+        requests through a connection pool set up from the app's settings.
+        If the manager was given a server, that is used as-is.
+        
+        :param app: The app to get the settings from.
+        """
+        if self.server is not None: return self.server
+        config = (app or self.app or current_app).config
+        self.pool = ConnectionPool(
+            maxsize=config.get('COUCHDB_POOL_SIZE', 10),
+            keepalive=config.get('COUCHDB_KEEPALIVE', True),
+            idle_timeout=config.get('COUCHDB_IDLE_TIMEOUT', 60),
+            connect_timeout=config.get('COUCHDB_CONNECT_TIMEOUT'),
+            read_timeout=config.get('COUCHDB_READ_TIMEOUT'),
+            wait_timeout=config.get('COUCHDB_POOL_TIMEOUT'))
+        session = Session(timeout=config.get('COUCHDB_READ_TIMEOUT'))
+        session.connection_pool = self.pool
+        self.server = couchdb.Server(config['COUCHDB_SERVER'],
+                                     session=session)
+        return self.server
+
+    def pool_stats(self):
+        """
+        This returns the statistics of the manager's connection pool (see
+        `ConnectionPool.stats`), or `None` if the manager was given a server
+        it didn't connect itself.
+        """
+        if self.pool is None: return None
+        return self.pool.stats()
+
     def get_or_create_db(self, db_name, server=None):
-        server = server or self.server
+        """
+        This returns the database with the given name, creating it if it
+        doesn't exist yet.
+        
+        :param db_name: The name of the database.
+        :param server: The server to use. (Defaults to the manager's server,
+                       connected with `connect_server` if necessary.)
+        """
+        server = server or self.connect_server()
         if db_name not in server:
            db = server.create(db_name)
         else:
            db = server[db_name]
         return db
 
-    def sync(self, app=None):
+    def sync(self, app=None, warm=False, staged=False, force=False):
         """
         This syncs the database for the given app. It will first make sure the
         database exists, then synchronize all the views and run all the
@@ -137,13 +679,119 @@ class CouchDB(object):
         exists on the manager, it will be called before every design document
         is updated.
         
+        If `COUCHDB_SYNC_INCREMENTAL` is set (and `force` isn't), a hash of
+        each design document's views is recorded in a local document, and
+        design documents whose views haven't changed since they were last
+        synced aren't fetched or saved at all. Only one process syncs at a
+        time (a local document serves as the lock), so when many processes
+        start at once, the others wait for it to finish and then find
+        nothing left to do. A lock older than `COUCHDB_SYNC_LOCK_TIMEOUT`
+        seconds is considered abandoned, and after waiting for
+        `COUCHDB_SYNC_LOCK_WAIT` seconds, `SyncLockTimeout` is raised.
+        (Since the hashes only cover the views, a design document that was
+        edited or deleted by hand, or changed by `update_design_doc`, isn't
+        put back until its views change - use `force` for that.)
+        
+        Changing a design document makes CouchDB rebuild its indexes the
+        next time one of its views is queried, and that query has to wait
+        for it. If `warm` is set, the indexes of the design documents that
+        changed are built in the background right away, in parallel on the
+        manager's thread pool (see `submit`), and an `IndexBuild` is
+        returned to follow their progress.
+        
+        If `staged` is set (which implies `warm`), the changed design
+        documents are saved under staging names instead (see
+        `flask_couchdb.design.STAGING_SUFFIX`), and each one only replaces
+        the real design document once its index is built, so the views keep
+        answering from the old index in the meantime. The `on_sync`
+        callbacks don't wait for that.
+        
         :param app: The application to synchronize with.
+        :param warm: Whether to build the changed indexes in the background.
+        :param staged: Whether to build them in staging design documents.
+        :param force: Whether to check every design document, even if its
+                      views haven't changed.
         """
         db = self.db
-        CouchDBViewDefinition.sync_many(
-            db, tuple(self.all_viewdefs()),
-            callback=getattr(self, 'update_design_doc', None)
-        )
+        viewdefs = tuple(self.all_viewdefs())
+        app = app or self.app
+        config = app.config if app is not None else {}
+        lock = None
+        swapped_hashes = {}
+        if not force and config.get('COUCHDB_SYNC_INCREMENTAL', False):
+            hashes = design_hashes(viewdefs)
+            timeout = config.get('COUCHDB_SYNC_LOCK_TIMEOUT', 60)
+            wait = config.get('COUCHDB_SYNC_LOCK_WAIT', 120)
+            deadline = time.time() + wait
+            while True:
+                state = read_local(db, SYNC_STATE) or {'hashes': {}}
+                outdated = set(design for design, hash in hashes.items()
+                               if state['hashes'].get(design) != hash)
+                if not outdated:
+                    break
+                if lock is not None:
+                    viewdefs = [viewdef for viewdef in viewdefs
+                                if viewdef.design in outdated]
+                    break
+                lock = acquire_sync_lock(db, timeout)
+                if lock is None:
+                    # another process is syncing, so wait for it
+                    if time.time() >= deadline:
+                        raise SyncLockTimeout('the sync lock was not '
+                                              'released after %s seconds'
+                                              % wait)
+                    time.sleep(min(0.5, max(deadline - time.time(), 0)))
+            if not outdated:
+                viewdefs = []
+        try:
+            results = self._sync_designs(db, viewdefs, staged)
+            if lock is not None:
+                saved = dict((design_name(id), ok) for ok, id, rev in results)
+                for design in outdated:
+                    staging = saved.get(design + STAGING_SUFFIX)
+                    if staging:
+                        # recorded once the staged document is swapped in
+                        swapped_hashes[design] = hashes[design]
+                    elif staging is None and saved.get(design, True):
+                        state['hashes'][design] = hashes[design]
+                write_local(db, SYNC_STATE, state)
+        finally:
+            if lock is not None:
+                release_sync_lock(db, lock)
+        if self.update_handler is not None:
+            install_update_handler(db, self.update_handler)
         for callback in self.sync_callbacks:
             callback(db)
+        if warm or staged:
+            views = self.index_views()
+            changed = {}
+            for ok, id, rev in results:
+                if ok:
+                    design = design_name(id)
+                    if staged:
+                        design = design[:-len(STAGING_SUFFIX)]
+                    changed[design] = views[design]
+            on_swapped = None
+            if swapped_hashes:
+                on_swapped = lambda design: record_hash(
+                    db, design, swapped_hashes[design])
+            return IndexBuild(db, changed, staged,
+                              on_swapped=on_swapped).start(self.submit)
+    
+    def _sync_designs(self, db, viewdefs, staged):
+        if not viewdefs:
+            return []
+        callback = getattr(self, 'update_design_doc', None)
+        if staged:
+            docs = [staged_doc(doc, db.get(doc['_id'] + STAGING_SUFFIX))
+                    for doc in changed_design_docs(db, viewdefs,
+                                                   callback=callback)]
+            return db.update(docs)
+        return CouchDBViewDefinition.sync_many(db, viewdefs,
+                                               callback=callback)
+
 
+def _run_call(call):
+    if isinstance(call, ViewResults):
+        return fetch_rows(call)
+    return call()
@@ -1,8 +1,14 @@
 # -*- coding: utf-8 -*-
 
-from flask import json
+import copy
+from collections import Sequence
+from flask import abort, g, json
 from couchdb.client import ViewResults, Row
 from couchdb.design import ViewDefinition as CouchDBViewDefinition
+from couchdb.http import Resource
+from flask_couchdb import codec
+from flask_couchdb.cache import SequenceCache, current_manager
+from flask_couchdb.records import _declared_fields
 
 ### Pagination
 
@@ -11,7 +17,7 @@ class Page(object):
     This represents a single page of items. They are created by the `paginate`
     function.
     """
-    #: A list of the actual items returned from the view.
+    #: The actual items returned from the view, as a `LazyItems` sequence.
     items = ()
     
     #: The `start` value for the next page, if there is one. If not, this
@@ -28,6 +34,88 @@ class Page(object):
         self.prev = prev
 
 
+_UNWRAPPED = object()
+
+
+class LazyItems(Sequence):
+    """
+    This is a read-only list of view rows that are only wrapped (in a
+    `Document` class, for example) the first time they are accessed. A
+    template that only shows part of a page doesn't pay for building the
+    rest of it. Slicing returns a plain list.
+    
+    :param rows: The unwrapped rows.
+    :param wrapper: The function to wrap each row with.
+    """
+    def __init__(self, rows, wrapper):
+        self.rows = rows
+        self.wrapper = wrapper
+        self.wrapped = [_UNWRAPPED] * len(rows)
+    
+    def __len__(self):
+        return len(self.rows)
+    
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        item = self.wrapped[index]
+        if item is _UNWRAPPED:
+            item = self.wrapped[index] = self.wrapper(self.rows[index])
+        return item
+    
+    def __eq__(self, other):
+        if not isinstance(other, (list, tuple, LazyItems)):
+            return NotImplemented
+        return list(self) == list(other)
+    
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        return result if result is NotImplemented else not result
+    
+    def __repr__(self):
+        return '<%s %d items>' % (type(self).__name__, len(self))
+
+
+def _projection(fields, doc_class=None):
+    """
+    This returns a function that copies a row, keeping only the given fields
+    (and the ID, revision and type) of its document or value. Fields the
+    document class stores under another key (like ``TextField(name='by')``)
+    are looked up by their attribute name.
+    """
+    keys = {}
+    if isinstance(getattr(doc_class, '_fields', None), dict):
+        keys = dict(_declared_fields(doc_class))
+    keep = frozenset(keys.get(field, field) for field in fields)
+    keep |= frozenset(('_id', '_rev', 'doc_type'))
+    def project(row):
+        row = Row(row)
+        name = 'doc' if row.get('doc') is not None else 'value'
+        data = row.get(name)
+        if isinstance(data, dict):
+            row[name] = dict((k, v) for k, v in data.items() if k in keep)
+        return row
+    return project
+
+
+class PageCache(SequenceCache):
+    """
+    This caches the pages `paginate` returns, so popular pages don't have
+    to be queried again for every visitor. Pages are cached by view, view
+    options, start value and page size, and only returned while the
+    database's ``update_seq`` hasn't changed (see `SequenceCache`), so a
+    cached page is at most `interval` seconds out of date. Looking up a
+    page between those checks doesn't make any requests at all.
+    
+    The manager creates one if `COUCHDB_PAGE_CACHE_SIZE` is set.
+    
+    :param maxsize: The maximum number of pages.
+    :param interval: Seconds between checks of a database's ``update_seq``.
+    """
+    def __init__(self, maxsize=1000, interval=1.0):
+        SequenceCache.__init__(self, maxsize, interval=interval)
+
+
 def _clone(results, **options):
     """
     This clones a `ViewResults` object. It's mostly for use by the `paginate`
@@ -38,7 +126,19 @@ def _clone(results, **options):
     return ViewResults(results.view, newopts)
 
 
-def paginate(view, count, start=None):
+def _unwrapped(results):
+    """
+    This returns a copy of the view behind a `ViewResults` object that
+    returns plain `Row` objects, and the wrapper the view had. The view
+    itself isn't changed.
+    """
+    raw = copy.copy(results.view)
+    raw.wrapper = None
+    return raw, results.view.wrapper or (lambda r: r)
+
+
+def paginate(view, count, start=None, concurrent=False, carry_prev=False,
+             cache=True, fields=None):
     """
     This implements linked-list pagination. You pass in the view to use, the
     number of items per page, and the JSON-encoded `start` value for the page,
@@ -51,42 +151,108 @@ def paginate(view, count, start=None):
     You should probably use the `start` values as a query parameter (e.g.
     ``?start=whatever``).
     
+    Every page after the first one normally takes two queries, one after
+    the other: one forwards for the items and the `next` link, and one
+    backwards for the `prev` link. There are two ways to make that faster:
+    
+    - With `concurrent`, the backwards query runs on the manager's thread
+      pool (see `CouchDB.submit`) at the same time as the forwards one.
+      (Unless this is already running on the pool, as with
+      `paginate_async`.)
+    - With `carry_prev`, the `next` value also records where the current
+      page starts, which is where the `prev` link of the next page has to
+      point. Following a `next` link then takes a single query. (Following
+      a `prev` link still takes both.)
+    
+    If the manager has a `PageCache` (see `COUCHDB_PAGE_CACHE_SIZE`), pages
+    are looked up in it first, unless `cache` is `False`.
+    
+    The page's items are only wrapped as they are used (see `LazyItems`).
+    If `fields` is given, every other field of the documents is dropped
+    before they are wrapped, so wrapping them is cheaper. (The items are
+    still instances of the document class, but without those fields.)
+    
     :param view: A `ViewResults` instance. (You get this by calling, slicing,
                  or subscripting a `ViewDefinition` or `ViewField`.)
     :param count: The number of items to put on a single page.
     :param start: The start value of the page, as a string.
+    :param concurrent: Whether to run the two queries at the same time.
+    :param carry_prev: Whether to put the previous page's start in the
+                       `next` values.
+    :param cache: Whether to use the manager's `PageCache`, if it has one.
+    :param fields: The names of the only fields the items need (their
+                   attribute names on the document class).
     """
-    # first, patch the wrapper
+    # first, get a copy of the view without the wrapper - the view itself
+    # may be shared with other threads
     if isinstance(view, CouchDBViewDefinition):
         view = view()
-    old_wrapper = view.view.wrapper or (lambda r: r)
-    view.view.wrapper = Row
-    rewrap = lambda r: [old_wrapper(i) for i in r]
+    raw, view_wrapper = _unwrapped(view)
+    if fields is not None:
+        # document classes wrap rows with a bound classmethod
+        doc_class = getattr(view_wrapper, '__self__', None)
+        project = _projection(fields, doc_class)
+        wrapper = lambda r: view_wrapper(project(r))
+    else:
+        wrapper = view_wrapper
     
-    # then, actually paginate
+    couch = current_manager()
+    page_cache = couch.page_cache if cache and couch is not None else None
+    if page_cache is not None:
+        resource = _database_resource(view)
+        key = (view.view.resource.url, getattr(view.view, 'map_fun', None),
+               json.dumps(view.options, sort_keys=True), start, count,
+               carry_prev)
+        seq, cached = page_cache.lookup(resource, key)
+        if cached is not None:
+            items, next, prev = cached
+            return Page(LazyItems(items,
+                                  lambda r: wrapper(copy.deepcopy(r))),
+                        next, prev)
+    items, next, prev = _paginate(ViewResults(raw, view.options), count,
+                                  start, concurrent, carry_prev)
+    if page_cache is not None:
+        page_cache.store(resource, seq, key,
+                         (copy.deepcopy(items), next, prev))
+    return Page(LazyItems(items, wrapper), next, prev)
+
+
+def _paginate(view, count, start, concurrent, carry_prev):
+    """
+    This does the actual work for `paginate`, and returns the unwrapped
+    rows for the page and its `next` and `prev` values.
+    """
     # the algorithm we're using is in the misc/pagination-algorithm.txt file
     if start is None:
         # first page
         results = list(_clone(view, limit=count + 1))
         if len(results) <= count:
             # only one page
-            return Page(rewrap(results), None, None)
+            return results, None, None
         else:
-            nextstart = results[-1]
-            next = json.dumps([nextstart.key, nextstart.id])
-            return Page(rewrap(results[:-1]), next, None)
+            next = _next_start(results, carry_prev)
+            return results[:-1], next, None
     else:
         # subsequent page
         descending = view.options.get('descending', False)
         try:
-            startkey, startid = json.loads(start)
-        except ValueError:
+            cursor = codec.decode(start)
+            startkey, startid = cursor[:2]
+            prevstart = cursor[2] if len(cursor) > 2 else None
+        except (ValueError, TypeError, KeyError):
             abort(400)
+        backwards = None
+        if prevstart is None:
+            backwards = _clone(view, limit=count, startkey=startkey,
+                               startkey_docid=startid, skip=1,
+                               descending=not descending)
+            # on a pool thread already (from `paginate_async`), the query
+            # is run inline, since waiting for it could deadlock the pool
+            concurrent = concurrent and not g.couch.on_worker()
+            if concurrent:
+                backwards = g.couch.submit(list, backwards)
         forwards = list(_clone(view, limit=count + 1, startkey=startkey,
                                startkey_docid=startid))
-        backwards = list(_clone(view, limit=count, startkey=startkey,
-                                startkey_docid=startid, skip=1,
-                                descending=not descending))
         
         # processing "next" link
         if len(forwards) <= count:
@@ -95,16 +261,115 @@ def paginate(view, count, start=None):
             items = forwards
         else:
             # there is a next page
-            nextstart = forwards[-1]
-            next = json.dumps([nextstart.key, nextstart.id])
+            next = _next_start(forwards, carry_prev)
             items = forwards[:-1]
         
         # processing "previous" link
-        if not backwards:
-            # no previous results
-            prev = None
+        if prevstart is not None:
+            # the previous page's start came with this page's
+            prev = codec.encode(prevstart)
         else:
-            prevstart = backwards[-1]
-            prev = json.dumps([prevstart.key, prevstart.id])
+            if concurrent:
+                backwards = backwards.get()
+            else:
+                backwards = list(backwards)
+            if not backwards:
+                # no previous results
+                prev = None
+            else:
+                prevstart = backwards[-1]
+                prev = codec.encode([prevstart.key, prevstart.id])
         
-        return Page(rewrap(items), next, prev)
+        return items, next, prev
+
+
+def _database_resource(results):
+    """
+    This returns the `Resource` for the database a `ViewResults` object
+    queries.
+    """
+    resource = results.view.resource
+    url = resource.url
+    for marker in ('/_design/', '/_all_docs', '/_temp_view'):
+        if marker in url:
+            url = url[:url.rindex(marker)]
+            break
+    return Resource(url, resource.session)
+
+
+def _next_start(results, carry_prev):
+    """
+    This returns the `next` value for a page, given its results including
+    the extra row that starts the next page.
+    """
+    nextstart = results[-1]
+    if carry_prev:
+        first = results[0]
+        return codec.encode([nextstart.key, nextstart.id,
+                             [first.key, first.id]])
+    return codec.encode([nextstart.key, nextstart.id])
+
+
+def paginate_async(view, count, start=None, **options):
+    """
+    This works like `paginate`, but runs the queries on the manager's thread
+    pool (see `CouchDB.submit`). It returns an `AsyncResult` right away,
+    whose `get` method returns the `Page`.
+    
+    :param view: A `ViewResults` instance.
+    :param count: The number of items to put on a single page.
+    :param start: The start value of the page, as a string.
+    :param options: `concurrent` and `carry_prev`, as for `paginate`.
+    """
+    return g.couch.submit(paginate, view, count, start, **options)
+
+
+def iterate_view(view, batch_size=100, prefetch=False):
+    """
+    This iterates over every row of a view, fetching `batch_size` rows per
+    query. It uses the same ``[key, docid]`` start values as `paginate`, so
+    it doesn't slow down towards the end of the view like `skip` does, but
+    unlike calling `paginate` in a loop, it only queries forwards. This is
+    meant for walking whole views, for reindexing or migrations::
+    
+        for post in iterate_view(BlogPost.by_date(), 500):
+            migrate(post)
+    
+    If `prefetch` is set, the next batch is fetched on the manager's thread
+    pool (see `CouchDB.submit`) while the current one is being processed,
+    unless this is already running on the pool.
+    
+    :param view: A `ViewResults` instance. (You get this by calling, slicing,
+                 or subscripting a `ViewDefinition` or `ViewField`.) Its
+                 `limit` option, if any, limits the total number of rows.
+    :param batch_size: The number of rows to fetch per query.
+    :param prefetch: Whether to fetch the next batch in the background.
+    """
+    if isinstance(view, CouchDBViewDefinition):
+        view = view()
+    raw, wrapper = _unwrapped(view)
+    fetch = lambda options: ViewResults(raw, options).rows
+    options = view.options.copy()
+    remaining = options.pop('limit', None)
+    options['limit'] = batch_size + 1
+    rows = fetch(options)
+    while rows:
+        # the extra row is where the next batch starts
+        nextstart = rows.pop() if len(rows) > batch_size else None
+        if remaining is not None and remaining <= len(rows):
+            nextstart = None
+        pending = None
+        if nextstart is not None:
+            options.pop('skip', None)
+            options.update(startkey=nextstart.key,
+                           startkey_docid=nextstart.id)
+            # not on a pool thread, where waiting for it could deadlock
+            if prefetch and not g.couch.on_worker():
+                pending = g.couch.submit(fetch, options.copy())
+        for row in rows[:remaining]:
+            yield wrapper(row)
+        if nextstart is None:
+            return
+        if remaining is not None:
+            remaining -= len(rows)
+        rows = pending.get() if pending is not None else fetch(options)
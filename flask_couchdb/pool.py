@@ -0,0 +1,204 @@
+# -*- coding: utf-8 -*-
+"""
+
+flask_couchdb.pool
+~~~~~~~~~~~~~~~~~~
+
+A bounded HTTP connection pool for couchdb-python sessions.
+
+:copyright: 2010 Matthew "LeafStorm" Frazier
+:license:   MIT/X11, see LICENSE for details
+
+"""
+
+import os
+import time
+import threading
+import weakref
+from couchdb import http, util
+
+__all__ = ['ConnectionPool', 'PoolTimeout']
+
+
+class PoolTimeout(Exception):
+    """
+    Raised when no connection became available within the pool's
+    `wait_timeout`.
+    """
+
+
+class ConnectionPool(http.ConnectionPool):
+    """
+    This is a drop-in replacement for couchdb-python's connection pool. The
+    stock pool opens a new connection whenever none is idle and keeps every
+    connection it is given back, which under load means an unbounded number
+    of sockets. This one limits the number of connections per host, makes
+    callers wait for a free one, and drops connections that have sat idle
+    for too long.
+
+    It is safe to share between threads (and greenlets, as long as the
+    `threading` module is monkey-patched). If the process forks, the child
+    starts with an empty pool instead of sharing the parent's sockets.
+
+    :param maxsize: The maximum number of connections to each host.
+    :param keepalive: Whether to reuse connections. If `False`, every
+                      connection is closed as soon as it is released.
+    :param idle_timeout: Seconds an idle connection may be kept around
+                         before it is closed, or `None` to keep it forever.
+    :param connect_timeout: Socket timeout while connecting.
+    :param read_timeout: Socket timeout for reading responses.
+    :param wait_timeout: Seconds to wait for a free connection before
+                         raising `PoolTimeout`, or `None` to wait forever.
+    """
+    def __init__(self, maxsize=10, keepalive=True, idle_timeout=60,
+                 connect_timeout=None, read_timeout=None, wait_timeout=None,
+                 disable_ssl_verification=False):
+        http.ConnectionPool.__init__(self, read_timeout,
+                                     disable_ssl_verification)
+        self.maxsize = maxsize
+        self.keepalive = keepalive
+        self.idle_timeout = idle_timeout
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.wait_timeout = wait_timeout
+        self.lock = threading.RLock()
+        self.available = threading.Condition(self.lock)
+        self._reset()
+
+    def _reset(self):
+        self.pid = os.getpid()
+        #: idle connections, keyed by (scheme, host), as (conn, released)
+        self.conns = {}
+        #: number of connections handed out, keyed by (scheme, host)
+        self.in_use = {}
+        #: weak references to the connections handed out, keyed by id
+        self.checked_out = {}
+        self.created = self.discarded = self.waits = self.timeouts = 0
+
+    def get(self, url):
+        key = tuple(util.urlsplit(url, 'http', False)[:2])
+        with self.lock:
+            if self.pid != os.getpid():
+                self._reset()
+            self._wait_for_slot(key)
+            self.in_use[key] = self.in_use.get(key, 0) + 1
+            conn = self._pop_idle(key)
+        if conn is None:
+            try:
+                conn = self._connect(*key)
+            except:
+                with self.lock:
+                    self._free_slot(key)
+                raise
+        with self.lock:
+            ref = weakref.ref(conn, self._lost_callback(id(conn)))
+            self.checked_out[id(conn)] = (key, ref)
+        return conn
+
+    def release(self, url, conn):
+        with self.lock:
+            entry = self.checked_out.pop(id(conn), None)
+            if entry is None:
+                # not one of ours, or handed out before a fork
+                conn.close()
+                return
+            key = entry[0]
+            self._free_slot(key)
+            if self.keepalive:
+                self.conns.setdefault(key, []).append((conn, time.time()))
+            else:
+                conn.close()
+
+    def stats(self):
+        """
+        This returns a dictionary describing the state of the pool: the
+        `maxsize`, the number of connections `in_use` and `idle`, and running
+        totals of connections `created` and `discarded`, of callers that had
+        to wait for a connection (`waits`) and of those that gave up
+        (`timeouts`).
+        """
+        with self.lock:
+            return {
+                'maxsize': self.maxsize,
+                'in_use': sum(self.in_use.values()),
+                'idle': sum(len(conns) for conns in self.conns.values()),
+                'created': self.created,
+                'discarded': self.discarded,
+                'waits': self.waits,
+                'timeouts': self.timeouts,
+            }
+
+    def _wait_for_slot(self, key):
+        if self.in_use.get(key, 0) < self.maxsize:
+            return
+        self.waits += 1
+        deadline = None
+        if self.wait_timeout is not None:
+            deadline = time.time() + self.wait_timeout
+        while self.in_use.get(key, 0) >= self.maxsize:
+            if deadline is None:
+                self.available.wait()
+                continue
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                self.timeouts += 1
+                raise PoolTimeout('no connection to %s://%s available after '
+                                  '%s seconds' % (key + (self.wait_timeout,)))
+            self.available.wait(remaining)
+
+    def _free_slot(self, key):
+        self.in_use[key] -= 1
+        self.available.notify()
+
+    def _pop_idle(self, key):
+        conns = self.conns.get(key)
+        now = time.time()
+        while conns:
+            conn, released = conns.pop(-1)
+            if (self.idle_timeout is None or
+                    now - released < self.idle_timeout):
+                return conn
+            conn.close()
+            self.discarded += 1
+        return None
+
+    def _connect(self, scheme, host):
+        if scheme == 'http':
+            cls = http.HTTPConnection
+        elif scheme == 'https':
+            if self.disable_ssl_verification:
+                cls = http.InsecureHTTPSConnection
+            else:
+                cls = http.HTTPSConnection
+        else:
+            raise ValueError('%s is not a supported scheme' % scheme)
+        conn = cls(host, timeout=self.connect_timeout)
+        conn.connect()
+        if self.read_timeout != self.connect_timeout:
+            conn.sock.settimeout(self.read_timeout)
+            conn.timeout = self.read_timeout
+        with self.lock:
+            self.created += 1
+        return conn
+
+    def _lost_callback(self, conn_id):
+        # couchdb-python closes rather than releases the connection behind a
+        # response that was never read to the end (continuous feeds, for
+        # example), so free its slot once the connection is garbage
+        pool = weakref.ref(self)
+        def lost(ref):
+            self = pool()
+            if self is None:
+                return
+            with self.lock:
+                entry = self.checked_out.get(conn_id)
+                if entry is not None and entry[1] is ref:
+                    del self.checked_out[conn_id]
+                    self.discarded += 1
+                    self._free_slot(entry[0])
+        return lost
+
+    def __del__(self):
+        for conns in list(self.conns.values()):
+            for conn, released in conns:
+                conn.close()
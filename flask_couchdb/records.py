@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+"""
+
+flask_couchdb.records
+~~~~~~~~~~~~~~~~~~~~~
+
+Compact, read-only records for listing documents without building full
+document instances.
+
+:copyright: 2010 Matthew "LeafStorm" Frazier
+:license:   MIT/X11, see LICENSE for details
+
+"""
+
+import threading
+
+__all__ = ['Record', 'record_class']
+
+_classes = {}
+_classes_lock = threading.Lock()
+
+
+class Record(object):
+    """
+    This is the base class of the records `record_class` makes. A record
+    has an attribute for the document's `id` and `rev` and for every field
+    the document class declares, holding the value straight from the JSON,
+    without any conversion or validation (so dates are still strings, for
+    example). Records use ``__slots__``, so they are much smaller than
+    documents, and they can't be changed.
+    """
+    __slots__ = ()
+
+    #: The attribute names, in order.
+    _fields = ()
+
+    #: The keys in the JSON document the declared fields are read from.
+    _keys = ()
+
+    def __init__(self, *values):
+        for name, value in zip(self.__slots__, values):
+            object.__setattr__(self, name, value)
+
+    @classmethod
+    def from_row(cls, row):
+        """
+        This makes a record from a view row, from its ``doc`` if the view
+        was queried with ``include_docs``, and otherwise from its value.
+
+        :param row: The row.
+        """
+        data = row.get('doc')
+        if data is None:
+            data = row.get('value')
+            if not isinstance(data, dict):
+                data = {}
+        get = data.get
+        return cls(row.get('id') or get('_id'), get('_rev'),
+                   *[get(key) for key in cls._keys])
+
+    def __setattr__(self, name, value):
+        raise AttributeError('%s is read-only' % type(self).__name__)
+
+    def __delattr__(self, name):
+        raise AttributeError('%s is read-only' % type(self).__name__)
+
+    def _values(self):
+        return tuple(getattr(self, name) for name in self.__slots__)
+
+    def _asdict(self):
+        """This returns the record's attributes as a dictionary."""
+        return dict((name, getattr(self, name)) for name in self.__slots__)
+
+    def __eq__(self, other):
+        if type(other) is not type(self):
+            return NotImplemented
+        return self._values() == other._values()
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        return result if result is NotImplemented else not result
+
+    def __hash__(self):
+        return hash(self._values())
+
+    def __repr__(self):
+        return '<%s %r@%r>' % (type(self).__name__, self.id, self.rev)
+
+
+def _declared_fields(doc_class):
+    """
+    This returns ``(attribute, key)`` pairs for the fields a document class
+    declares, either with couchdb-python's mapping or with schematics.
+    """
+    fields = getattr(doc_class, '_fields', None) or {}
+    skip = set(['_id', '_rev', 'id', 'rev'])
+    skip.update(getattr(doc_class, '_serializables', None) or ())
+    pairs = []
+    for name, field in sorted(fields.items()):
+        if name in skip:
+            continue
+        if hasattr(field, 'serialized_name'):
+            key = field.serialized_name
+        else:
+            # couchdb.mapping fields keep their key as `name`
+            key = getattr(field, 'name', None)
+        pairs.append((name, key or name))
+    return pairs
+
+
+def record_class(doc_class):
+    """
+    This returns the `Record` subclass for a document class, which is made
+    the first time it is asked for, with a slot for each declared field.
+    Views return these instead of documents when queried with
+    ``records=True`` (see `ViewDefinition`).
+
+    :param doc_class: A `Document` or `schematics_document.Document`
+                      subclass.
+    """
+    try:
+        return _classes[doc_class]
+    except KeyError:
+        pass
+    pairs = _declared_fields(doc_class)
+    names = ('id', 'rev') + tuple(name for name, key in pairs)
+    attrs = {'__slots__': names, '_fields': names,
+             '_keys': tuple(key for name, key in pairs),
+             '__module__': doc_class.__module__}
+    cls = type(doc_class.__name__ + 'Record', (Record,), attrs)
+    with _classes_lock:
+        return _classes.setdefault(doc_class, cls)
@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+"""
+
+flask_couchdb.retry
+~~~~~~~~~~~~~~~~~~~
+
+Updating a document by loading it, changing it and storing it again until
+that doesn't run into a conflict, shared by both `Document` classes, and
+keeping count of the conflicts for every type of document.
+
+:copyright: 2010 Matthew "LeafStorm" Frazier
+:license:   MIT/X11, see LICENSE for details
+
+"""
+
+import random
+import threading
+import time
+from couchdb.http import ResourceConflict
+from flask_couchdb.cache import current_manager
+
+__all__ = ['ConflictStats']
+
+#: The default number of times an update is tried again after a conflict.
+RETRIES = 5
+
+#: The default base delay (in seconds) before trying an update again.
+BACKOFF = 0.05
+
+#: The longest (in seconds) an update ever waits before trying again.
+MAX_BACKOFF = 2.0
+
+
+class ConflictStats(object):
+    """
+    This keeps count of the updates made with ``Document.update`` and the
+    conflicts they ran into, for every type of document, to show which
+    documents are written by many clients at once. The manager has one (as
+    `conflict_stats`). It is safe to use from several threads.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counts = {}
+
+    def record(self, doc_type, attempts, conflicts, failed=False):
+        """
+        This counts one update.
+
+        :param doc_type: The type of the document that was updated.
+        :param attempts: The number of times it was stored.
+        :param conflicts: The number of those that ran into a conflict.
+        :param failed: Whether it gave up after too many conflicts.
+        """
+        with self.lock:
+            counts = self.counts.get(doc_type)
+            if counts is None:
+                counts = self.counts[doc_type] = {
+                    'updates': 0, 'attempts': 0, 'conflicts': 0,
+                    'failed': 0, 'max_conflicts': 0}
+            counts['updates'] += 1
+            counts['attempts'] += attempts
+            counts['conflicts'] += conflicts
+            counts['failed'] += int(failed)
+            counts['max_conflicts'] = max(counts['max_conflicts'], conflicts)
+
+    def stats(self):
+        """
+        This returns a dictionary mapping every type of document that was
+        updated to a dictionary with running totals of its `updates`, the
+        `attempts` to store them, the `conflicts` those ran into and the
+        updates that `failed` after too many conflicts, and the most
+        conflicts one update ran into (`max_conflicts`). Its
+        `conflict_rate` is the share of attempts that conflicted.
+        """
+        with self.lock:
+            stats = {}
+            for doc_type, counts in self.counts.iteritems():
+                stats[doc_type] = dict(counts)
+                stats[doc_type]['conflict_rate'] = (
+                    float(counts['conflicts']) / counts['attempts']
+                    if counts['attempts'] else 0.0)
+            return stats
+
+    def reset(self):
+        """
+        This clears all of the counts.
+        """
+        with self.lock:
+            self.counts.clear()
+
+
+def backoff_delay(backoff, attempt):
+    """
+    This returns how long to wait before trying an update again. If
+    `backoff` is a number, it is a random delay of up to `backoff` seconds,
+    doubled for every attempt that conflicted before and capped at
+    `MAX_BACKOFF`, so clients that conflicted with each other don't all
+    try again at the same time. Otherwise, it is called with the number of
+    the attempt (from 0) and returns the delay.
+
+    :param backoff: The base delay, or a function returning the delay.
+    :param attempt: The number of attempts that conflicted before this one.
+    """
+    if callable(backoff):
+        return backoff(attempt)
+    return random.uniform(0, min(MAX_BACKOFF, backoff * 2 ** attempt))
+
+
+def update_with_retries(cls, db, id, fn, new, doc_type, retries=RETRIES,
+                        backoff=BACKOFF):
+    """
+    This loads a document, calls `fn` with it to change it and stores it.
+    If storing it runs into a conflict, the document is loaded again and
+    `fn` is called with the new copy, up to `retries` more times, waiting a
+    little longer every time (see `backoff_delay`). The document is always
+    loaded from the database itself, not the caches, so it is current and
+    copies other code in the request holds aren't changed. It returns the
+    stored document, or raises the last `ResourceConflict` once there are
+    no retries left. The update is counted in the manager's
+    `conflict_stats`.
+
+    :param cls: The document class.
+    :param db: The database.
+    :param id: The document ID.
+    :param fn: The function that changes the document.
+    :param new: A function returning a new document with the given ID, to
+                pass to `fn` if the document doesn't exist.
+    :param doc_type: The type of document to count the update under.
+    :param retries: The number of times to try again after a conflict.
+    :param backoff: The base delay, or a function returning the delay.
+    """
+    couch = current_manager()
+    stats = couch.conflict_stats if couch is not None else None
+    attempt = 0
+    while True:
+        data = db.get(id)
+        doc = new(id) if data is None else cls.wrap(data)
+        fn(doc)
+        try:
+            doc.store(db, defer=False)
+        except ResourceConflict:
+            if attempt >= retries:
+                if stats is not None:
+                    stats.record(doc_type, attempt + 1, attempt + 1, True)
+                raise
+        else:
+            if stats is not None:
+                stats.record(doc_type, attempt + 1, attempt)
+            return doc
+        time.sleep(backoff_delay(backoff, attempt))
+        attempt += 1
@@ -2,9 +2,18 @@
 
 
 import couchdb
-from couchdb_schematics.document import SchematicsDocument
+from couchdb_schematics.document import SchematicsDocument, DocumentMeta
 
 from flask import g
+from flask_couchdb.cache import (load_document, document_stored,
+                                 document_queued, document_deleted)
+from flask_couchdb.writebehind import current_write_behind
+from flask_couchdb.bulk import (BATCH_SIZE, load_documents, store_documents,
+                                delete_documents)
+from flask_couchdb.converter import Converter
+from flask_couchdb.retry import RETRIES, BACKOFF, update_with_retries
+from flask_couchdb.updates import (snapshot, field_changes,
+                                   current_update_handler, update_document)
 
 from schematics.models import Model, ModelMeta
 from schematics.types.base import *
@@ -17,35 +26,247 @@ __all__ = ["Document", "Model"]
 #__all__.extend(base_all)
 #__all__.extend(compound_all)
 
+class CompiledDocumentMeta(DocumentMeta):
+    """
+    This gives every document class its `Converter` when it is defined.
+    """
+    def __init__(cls, name, bases, attrs):
+        super(CompiledDocumentMeta, cls).__init__(name, bases, attrs)
+        cls._converter = Converter(cls)
+
+
 class Document(SchematicsDocument):
+    """
+    This is a document class built on schematics. Like
+    `flask_couchdb.Document`, documents keep track of the fields that
+    changed since they were loaded or last stored (see `changed_fields`),
+    so storing one that hasn't changed doesn't do anything, and the ones
+    that have can be saved by sending only those fields (see `store`).
+    """
+    __metaclass__ = CompiledDocumentMeta
+
+    @classmethod
+    def wrap(cls, data):
+        """
+        This makes a document from its JSON. It gives the same document as
+        ``cls(data)``, but with the class's compiled `Converter` instead of
+        schematics' generic import loop, and remembers the JSON to tell
+        which fields change. It is only copied if the document could change
+        it in place (see `Converter.detached`); otherwise it is kept as it
+        is, and only converted again once it is compared with.
+        
+        :param data: The document's JSON, as a dictionary.
+        """
+        converter = cls._converter
+        doc = converter.load(data)
+        doc._loaded = data if converter.detached(data) else snapshot(data)
+        return doc
+
+    def to_primitive(self, role=None, app_data=None, **kwargs):
+        """
+        This exports the document to JSON. Without a `role` or any options,
+        it uses the class's compiled `Converter`.
+        """
+        if role is None and app_data is None and not kwargs:
+            return self._converter.export(self)
+        return super(Document, self).to_primitive(role, app_data, **kwargs)
+
+    def changed_fields(self):
+        """
+        This returns the names of the fields (as they are stored in the JSON)
+        that were changed or removed since the document was loaded or last
+        stored, in alphabetical order. For a document that was never loaded
+        or stored, that is all of them.
+        """
+        data = self._converter.export(self)
+        stored = self._converter.stored_json(self)
+        if stored is None:
+            return sorted(data)
+        fields, removed = field_changes(stored, data)
+        return sorted(fields.keys() + removed)
 
     @classmethod
     def load(cls, id, db=None, **kwargs):
         """
         This is used to retrieve a specific document from the database. If a
         database is not given, the thread-local database (``g.couch.db``) is
-        used. 
+        used. If the request's identity map is enabled and the document has
+        already been loaded or stored in this request, that instance is
+        returned without going to the database. If the manager's document
+        cache is enabled, a cached copy is used once its revision has been
+        checked.
         
         For compatibility with code used to the parameter ordering used in the
         original CouchDB library, the parameters can be given in reverse
         order.
         
+        :param id: The document ID to load.
+        :param db: The database to use. Optional.
+        :param kwargs: Options for fetching the document, such as `rev`.
+        """
+        if isinstance(id, couchdb.Database):
+            id, db = db, id
+        return load_document(cls, db or g.couch.db, id, **kwargs)
+
+    @classmethod
+    def load_async(cls, id, db=None, **kwargs):
+        """
+        This works like `load`, but loads the document on the manager's
+        thread pool (see `CouchDB.submit`). It returns an `AsyncResult`
+        right away, whose `get` method returns the document, so many
+        documents can be loaded at the same time.
+        
         :param id: The document ID to load.
         :param db: The database to use. Optional.
         """
         if isinstance(id, couchdb.Database):
             id, db = db, id
-        return super(Document, cls).load(db or g.couch.db, id, **kwargs)
+        return g.couch.submit(cls.load, id, db or g.couch.db, **kwargs)
+
+    @classmethod
+    def load_many(cls, ids, db=None, batch_size=BATCH_SIZE):
+        """
+        This retrieves several documents at once, using one request to
+        ``_all_docs`` for every `batch_size` IDs instead of one request per
+        document. It returns a list in the same order as `ids`, with `None`
+        in place of any document that could not be found.
+        
+        :param ids: The document IDs to load.
+        :param db: The database to use. Optional.
+        :param batch_size: The maximum number of IDs to request at once.
+        """
+        return load_documents(cls, db or g.couch.db, ids, batch_size)
     
-    def store(self, db=None, validate=True):
+    def store(self, db=None, validate=True, defer=None, partial=None):
         """
         This saves the document to the database. If a database is not given,
-        the thread-local database (``g.couch.db``) is used.
+        the thread-local database (``g.couch.db``) is used. If the document
+        hasn't changed since it was loaded or last stored, nothing is sent
+        (and it isn't validated). A document that hasn't changed since it
+        last validated isn't validated again.
+        
+        If the manager's write-behind mode is on, the document is validated
+        and queued, and saved in the background, so its revision is not
+        updated until then.
+        
+        Otherwise, if the manager has an update handler (see
+        `COUCHDB_UPDATE_HANDLER`), a document that was loaded is saved by
+        sending only the fields that changed through it. It still raises
+        `ResourceConflict` if the document was changed on the server since
+        it was loaded.
+        
+        :param db: The database to use. Optional.
+        :param validate: Whether to validate the document first.
+        :param defer: Whether to queue the document for write-behind,
+                      overriding the manager's setting. Optional.
+        :param partial: Whether to send only the changed fields, overriding
+                        the manager's setting. Optional.
+        """
+        db = db or g.couch.db
+        converter = self._converter
+        data = converter.export(self)
+        stored = converter.stored_json(self)
+        if data == stored:
+            return self
+        data = converter.to_json(self, validate, data)
+        saved = _saved_as(snapshot(data))
+        queue = current_write_behind(defer)
+        handler = current_update_handler(partial)
+        if queue is not None:
+            queue.put(db, self, data, saved)
+            document_queued(db, self)
+            return self
+        if handler is not None and stored is not None:
+            saved(self, self.id, update_document(db, handler, stored, data))
+        else:
+            saved(self, *db.save(data))
+        document_stored(db, self)
+        return self
+
+    def store_async(self, db=None, validate=True):
+        """
+        This works like `store`, but validates and saves the document on the
+        manager's thread pool (see `CouchDB.submit`). It returns an
+        `AsyncResult` right away, whose `get` method returns the document
+        once it has been saved (or raises the error that prevented it).
         
         :param db: The database to use. Optional.
+        :param validate: Whether to validate the document first.
         """
-        return super(Document,self).store(db or g.couch.db, validate)
+        return g.couch.submit(self.store, db or g.couch.db, validate,
+                              defer=False)
+
+    @classmethod
+    def update(cls, id, fn, db=None, retries=RETRIES, backoff=BACKOFF):
+        """
+        This loads a fresh copy of a document, calls `fn` with it to change
+        it in place, and validates and stores it right away (even in
+        write-behind mode), retrying with a fresh copy after a conflict. It
+        works like `flask_couchdb.Document.update`, and counts updates by
+        the class's name in the manager's `conflict_stats`.
+        
+        :param id: The document ID to update.
+        :param fn: The function that changes the document.
+        :param db: The database to use. Optional.
+        :param retries: The number of times to try again after a conflict.
+        :param backoff: The base delay in seconds, or a function returning
+                        the delay.
+        """
+        return update_with_retries(cls, db or g.couch.db, id, fn,
+                                   lambda id: cls(dict(_id=id)),
+                                   cls.__name__, retries, backoff)
 
     def delete_instance(self, db=None):
-        super(Document, self).delete_instance(db or g.couch.db)
+        db = db or g.couch.db
+        super(Document, self).delete_instance(db)
+        document_deleted(db, self.id)
+
+    @classmethod
+    def store_many(cls, docs, db=None, validate=True, batch_size=BATCH_SIZE):
+        """
+        This saves several documents at once through ``_bulk_docs``, one
+        request per `batch_size` documents. The new revisions are set on the
+        documents that were saved. Unlike `store`, neither a validation error
+        nor a conflict raises an exception - instead, a `BulkResult` is
+        returned that tells which documents were saved and which failed, so
+        those can be fixed or retried. Documents that don't validate are not
+        sent at all, and neither are documents that haven't changed since
+        they were loaded or last stored.
+        
+        :param docs: The documents to save.
+        :param db: The database to use. Optional.
+        :param validate: Whether to validate the documents first.
+        :param batch_size: The maximum number of documents to send at once.
+        """
+        exported = {}
+        sent = {}
+        def unchanged(doc):
+            data = exported[id(doc)] = doc._converter.export(doc)
+            return data == doc._converter.stored_json(doc)
+        def to_json(doc):
+            data = doc._converter.to_json(doc, validate, exported.pop(id(doc)))
+            sent[id(doc)] = snapshot(data)
+            return data
+        def saved(doc, doc_id, rev):
+            doc._converter.saved(doc, doc_id, rev, sent.pop(id(doc)))
+        return store_documents(db or g.couch.db, docs, to_json, saved,
+                               batch_size, unchanged)
+
+    @classmethod
+    def delete_many(cls, docs, db=None, batch_size=BATCH_SIZE):
+        """
+        This deletes several documents at once through ``_bulk_docs``, and
+        returns a `BulkResult` like `store_many`.
+        
+        :param docs: The documents to delete.
+        :param db: The database to use. Optional.
+        :param batch_size: The maximum number of documents to send at once.
+        """
+        return delete_documents(db or g.couch.db, docs, batch_size)
+
+
+def _saved_as(sent):
+    def saved(doc, id, rev):
+        doc._converter.saved(doc, id, rev, sent)
+    return saved
 
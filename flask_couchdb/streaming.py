@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+"""
+
+flask_couchdb.streaming
+~~~~~~~~~~~~~~~~~~~~~~~
+
+Incremental parsing of view responses, so rows can be processed one at a
+time without reading the whole response into memory.
+
+:copyright: 2010 Matthew "LeafStorm" Frazier
+:license:   MIT/X11, see LICENSE for details
+
+"""
+
+import re
+from couchdb import json
+from couchdb.http import CHUNK_SIZE
+
+__all__ = ['iter_rows']
+
+_ROWS_START = re.compile(r'"rows"\s*:\s*\[')
+_STRUCTURE = re.compile(r'["{}]')
+_STRING_END = re.compile(r'(?:[^"\\]|\\.)*"', re.S)
+
+
+class RowScanner(object):
+    """
+    This splits the ``rows`` array of a view response into the JSON text of
+    the individual rows as the response is fed to it, keeping only the
+    unfinished row in memory.
+    """
+    def __init__(self):
+        self.buffer = ''
+        self.pos = 0
+        self.depth = 0
+        self.start = None
+        self.in_rows = False
+        self.done = False
+
+    def feed(self, data):
+        """
+        This adds a piece of the response, and returns a list of the rows
+        (as decoded JSON) that it completed.
+        """
+        if self.done:
+            return []
+        buf = self.buffer + data
+        if not self.in_rows:
+            match = _ROWS_START.search(buf)
+            if match is None:
+                # keep enough to find the start if it was split in two
+                self.buffer = buf[-32:]
+                return []
+            self.in_rows = True
+            buf = buf[match.end():]
+            self.pos = 0
+        rows = []
+        pos = self.pos
+        while not self.done:
+            if self.depth == 0:
+                while pos < len(buf) and buf[pos] in ' \t\r\n,':
+                    pos += 1
+                if pos >= len(buf):
+                    break
+                if buf[pos] == ']':
+                    self.done = True
+                    pos = len(buf)
+                    break
+                if buf[pos] != '{':
+                    raise ValueError('unexpected %r in view rows' % buf[pos])
+                self.start = pos
+                self.depth = 1
+                pos += 1
+                continue
+            match = _STRUCTURE.search(buf, pos)
+            if match is None:
+                pos = len(buf)
+                break
+            char = match.group()
+            if char == '"':
+                end = _STRING_END.match(buf, match.end())
+                if end is None:
+                    # the string isn't complete yet, rescan it next time
+                    pos = match.start()
+                    break
+                pos = end.end()
+            elif char == '{':
+                self.depth += 1
+                pos = match.end()
+            else:
+                self.depth -= 1
+                pos = match.end()
+                if self.depth == 0:
+                    text = buf[self.start:pos]
+                    rows.append(json.decode(text.decode('utf-8')))
+                    self.start = None
+        if self.start is None:
+            cut = pos
+        else:
+            cut, self.start = self.start, 0
+        self.buffer = buf[cut:]
+        self.pos = pos - cut
+        return rows
+
+
+def iter_rows(body, chunk_size=CHUNK_SIZE):
+    """
+    This reads a view response from the file-like `body` a chunk at a time
+    and yields its rows (as dictionaries) one at a time.
+
+    :param body: The response body.
+    :param chunk_size: The number of bytes to read at once.
+    """
+    scanner = RowScanner()
+    while not scanner.done:
+        data = body.read(chunk_size)
+        if not data:
+            break
+        for row in scanner.feed(data):
+            yield row
+    if not scanner.done:
+        raise ValueError('view response ended before the rows did')
+    # read the rest, so the connection goes back to the pool
+    while body.read(chunk_size):
+        pass
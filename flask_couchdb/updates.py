@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+"""
+
+flask_couchdb.updates
+~~~~~~~~~~~~~~~~~~~~~
+
+Keeping track of the fields of a document that changed since it was loaded,
+and saving only those through an update handler, shared by both `Document`
+classes.
+
+:copyright: 2010 Matthew "LeafStorm" Frazier
+:license:   MIT/X11, see LICENSE for details
+
+"""
+
+from couchdb.http import ResourceNotFound
+from flask_couchdb import codec
+from flask_couchdb.cache import current_manager
+
+__all__ = ['UPDATE_HANDLER', 'install_update_handler']
+
+#: The update handler `install_update_handler` saves. It is sent the
+#: revision the document was loaded with, the fields to set and the fields
+#: to remove, and answers with a conflict if the document has changed since.
+UPDATE_HANDLER = '''\
+function (doc, req) {
+    var body = JSON.parse(req.body);
+    if (!doc) {
+        return [null, {code: 404,
+                       json: {error: 'not_found', reason: 'missing'}}];
+    }
+    if (doc._rev != body._rev) {
+        return [null, {code: 409,
+                       json: {error: 'conflict',
+                              reason: 'Document update conflict.'}}];
+    }
+    for (var key in body.set) {
+        doc[key] = body.set[key];
+    }
+    for (var i = 0; i < body.unset.length; i++) {
+        delete doc[body.unset[i]];
+    }
+    return [doc, {json: {ok: true, id: doc._id}}];
+}'''
+
+
+def snapshot(data):
+    """
+    This returns a deep copy of a document's JSON to compare it with later.
+    It goes through the JSON codec, which is a lot faster than
+    `copy.deepcopy`.
+
+    :param data: The JSON data.
+    """
+    return codec.decode(codec.encode(data))
+
+
+def shallow_snapshot(data):
+    """
+    This returns a copy of a document's JSON to compare it with later, for
+    a document that goes on using `data` itself. Only the lists and
+    dictionaries in it are copied deeply (with `snapshot`) - the other
+    values can't be changed in place, so the copy shares them.
+
+    :param data: The JSON data.
+    """
+    stored = dict(data)
+    for key, value in stored.iteritems():
+        if isinstance(value, (dict, list)):
+            stored[key] = snapshot(value)
+    return stored
+
+
+def field_changes(old, new):
+    """
+    This returns the fields of `new` that are different in `old` (as a
+    dictionary), and the fields of `old` that aren't in `new` anymore (as a
+    list). The ID and revision are left out.
+
+    :param old: The JSON data the document was loaded or last saved with.
+    :param new: Its JSON data now.
+    """
+    fields = dict((key, value) for key, value in new.iteritems()
+                  if key not in ('_id', '_rev') and
+                     (key not in old or old[key] != value))
+    removed = sorted(key for key in old
+                     if key not in new and key not in ('_id', '_rev'))
+    return fields, removed
+
+
+def current_update_handler(partial=None):
+    """
+    This returns the name of the update handler a document being stored
+    should be saved through, or `None` if it should be saved whole.
+
+    :param partial: `True` or `False` to override the manager's
+                    `COUCHDB_UPDATE_HANDLER` setting for this document.
+                    (Without one, documents are always saved whole.)
+    """
+    couch = current_manager()
+    if couch is None or couch.update_handler is None or partial is False:
+        return None
+    return couch.update_handler
+
+
+def install_update_handler(db, handler):
+    """
+    This saves `UPDATE_HANDLER` in the database under the given name, unless
+    it is already there. It returns whether it had to be saved.
+
+    :param db: The database.
+    :param handler: The name of the handler, as ``design/name``.
+    """
+    design, name = handler.split('/', 1)
+    doc_id = '_design/%s' % design
+    doc = db.get(doc_id, {'_id': doc_id})
+    updates = doc.setdefault('updates', {})
+    if updates.get(name) == UPDATE_HANDLER:
+        return False
+    updates[name] = UPDATE_HANDLER
+    doc.setdefault('language', 'javascript')
+    db.save(doc)
+    return True
+
+
+def update_document(db, handler, old, new):
+    """
+    This saves the fields that changed between `old` and `new` through an
+    update handler, and returns the document's new revision. It raises
+    `ResourceConflict` if the document has changed on the server since
+    `old`. If the handler (or the document) is missing, the document is
+    saved whole instead.
+
+    :param db: The database.
+    :param handler: The name of the handler, as ``design/name``.
+    :param old: The JSON data the document was loaded or last saved with.
+    :param new: Its JSON data now.
+    """
+    fields, removed = field_changes(old, new)
+    body = {'_rev': new.get('_rev', old.get('_rev')), 'set': fields,
+            'unset': removed}
+    try:
+        headers, response = db.update_doc(handler, new['_id'], body=body)
+    except ResourceNotFound:
+        return db.save(new)[1]
+    if response is not None:
+        response.close()
+    return headers['X-Couch-Update-NewRev']
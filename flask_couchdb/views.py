@@ -1,10 +1,48 @@
 # -*- coding: utf-8 -*-
 
+import copy
+import time
+from couchdb import json
+from couchdb.client import Row, View
 from couchdb.design import ViewDefinition as OldViewDefinition
+from couchdb.http import CHUNK_SIZE
 from couchdb.mapping import ViewField as OldViewField
 from flask import g
+from flask_couchdb.cache import SequenceCache, current_manager
+from flask_couchdb.streaming import iter_rows
+from flask_couchdb.records import record_class
 
 class ViewDefinition(OldViewDefinition):
+    """
+    This works like `couchdb.design.ViewDefinition`, but uses the
+    thread-local database when one isn't given.
+    
+    If `cache` is set, the view's results are kept in the manager's
+    `ViewCache` (see `COUCHDB_VIEW_CACHE_BYTES`). This is meant for reduce
+    views, which CouchDB can take a while to compute. It can also be
+    turned on or off for a single call by passing `cache` along with the
+    other options.
+    
+    `stale` is the view's default ``stale`` option, such as ``'ok'`` or
+    ``'update_after'``, which lets queries return without waiting for the
+    index to be updated. If it is `None`, the manager's `COUCHDB_VIEW_STALE`
+    setting is used, and `False` means the view is never read stale. A
+    `stale` option given to a single call overrides both (and `False`
+    there turns it off for that call).
+    
+    If `records` is set (or passed to a single call), the rows are returned
+    as read-only records with the fields `document` declares (see
+    `record_class`) instead of being wrapped in the document class, which
+    is much cheaper for long read-only listings. Views declared with
+    `ViewField` know their document class.
+    """
+    def __init__(self, *args, **kwargs):
+        self.cache = kwargs.pop('cache', False)
+        self.stale = kwargs.pop('stale', None)
+        self.records = kwargs.pop('records', False)
+        self.document = kwargs.pop('document', None)
+        super(ViewDefinition, self).__init__(*args, **kwargs)
+    
     def __call__(self, db=None, **options):
         """
         This executes the view with the given database. If a database is not
@@ -13,7 +51,80 @@ class ViewDefinition(OldViewDefinition):
         :param db: The database to use, if necessary.
         :param options: Options to pass to the view.
         """
-        return super(ViewDefinition, self).__call__(db or g.couch.db, **options)
+        cache = options.pop('cache', self.cache)
+        records = options.pop('records', self.records)
+        db = db or g.couch.db
+        couch = current_manager()
+        self._apply_stale(options, couch)
+        results = super(ViewDefinition, self).__call__(db, **options)
+        if records:
+            results.view.wrapper = self._record_wrapper()
+        if cache and couch is not None and couch.view_cache is not None:
+            results.view = CachedView(results.view, couch.view_cache,
+                                      db.resource)
+        return results
+    
+    def call_async(self, db=None, **options):
+        """
+        This works like calling the view, but runs the query on the
+        manager's thread pool (see `CouchDB.submit`). It returns an
+        `AsyncResult` right away, whose `get` method returns the
+        `ViewResults` with their rows already fetched.
+        
+        :param db: The database to use, if necessary.
+        :param options: Options to pass to the view.
+        """
+        return g.couch.submit(fetch_rows, self(db or g.couch.db, **options))
+    
+    def stream(self, db=None, chunk_size=CHUNK_SIZE, **options):
+        """
+        This executes the view and yields its rows one at a time as they
+        are read from the response, instead of reading the whole response
+        first like calling the view does. The memory it uses doesn't grow
+        with the number of rows, which makes it suitable for exporting or
+        processing big views. Rows are wrapped with the view's `wrapper`,
+        just like when calling the view, and `include_docs` works as usual.
+        
+        Stopping halfway through is fine, but it closes the connection
+        instead of returning it to the pool.
+        
+        :param db: The database to use, if necessary.
+        :param chunk_size: The number of bytes to read at a time.
+        :param options: Options to pass to the view.
+        """
+        merged = self.defaults.copy()
+        merged.update(options)
+        merged.pop('cache', None)
+        records = merged.pop('records', self.records)
+        self._apply_stale(merged, current_manager())
+        resource = (db or g.couch.db).resource('_design', self.design,
+                                                '_view', self.name)
+        if 'keys' in merged:
+            keys = merged.pop('keys')
+            _, _, body = resource.post(body={'keys': keys},
+                                       **_encode_options(merged))
+        else:
+            _, _, body = resource.get(**_encode_options(merged))
+        wrapper = self._record_wrapper() if records else self.wrapper or Row
+        for row in iter_rows(body, chunk_size):
+            yield wrapper(Row(row))
+    
+    def _record_wrapper(self):
+        if self.document is None:
+            raise ValueError('records need the document class, but the '
+                             'view %s/%s has none' % (self.design, self.name))
+        return record_class(self.document).from_row
+    
+    def _apply_stale(self, options, couch):
+        if 'stale' in options:
+            if options['stale'] in (None, False):
+                options.pop('stale', None)
+            return
+        stale = self.stale
+        if stale is None and couch is not None:
+            stale = couch.view_stale
+        if stale:
+            options['stale'] = stale
     
     def __getitem__(self, item):
         """
@@ -32,6 +143,93 @@ class ViewDefinition(OldViewDefinition):
         return self()[item]
 
 
+class ViewCache(SequenceCache):
+    """
+    This caches the results of view queries for views that ask for it (see
+    `ViewDefinition`). Results are cached by view and query options, and
+    only returned while the database's ``update_seq`` hasn't changed (see
+    `SequenceCache`), so they are at most `interval` seconds out of date.
+    Looking up results between those checks doesn't make any requests.
+    
+    Instead of a number of entries, the cache is limited to `maxbytes`
+    bytes of results, measured as JSON. The least recently used results
+    are evicted to make room, and results bigger than that are not cached
+    at all. `stats` adds the current `bytes` and `maxbytes` to the usual
+    counters.
+    
+    The manager creates one if `COUCHDB_VIEW_CACHE_BYTES` is set.
+    
+    :param maxbytes: The maximum size of the cached results.
+    :param interval: Seconds between checks of a database's ``update_seq``.
+    """
+    def __init__(self, maxbytes=10 * 1024 * 1024, interval=1.0):
+        SequenceCache.__init__(self, None, interval=interval)
+        self.maxbytes = maxbytes
+        self.bytes = 0
+        self.sizes = {}
+    
+    def put(self, key, value):
+        size = len(json.encode(value))
+        with self.lock:
+            self._forget(key)
+            if size > self.maxbytes:
+                return
+            self.entries[key] = (time.time(), value)
+            self.sizes[key] = size
+            self.bytes += size
+            while self.bytes > self.maxbytes:
+                self._forget(next(iter(self.entries)))
+                self.evictions += 1
+    
+    def discard(self, key):
+        with self.lock:
+            self._forget(key)
+    
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.sizes.clear()
+            self.bytes = 0
+    
+    def stats(self):
+        stats = SequenceCache.stats(self)
+        with self.lock:
+            stats.update(bytes=self.bytes, maxbytes=self.maxbytes)
+        return stats
+    
+    def _forget(self, key):
+        if self.entries.pop(key, None) is not None:
+            self.bytes -= self.sizes.pop(key)
+
+
+class CachedView(View):
+    """
+    This stands in for the view behind a `ViewResults` object and gets its
+    results from a `ViewCache` when it can.
+    
+    :param view: The view to query when the results aren't cached.
+    :param cache: The `ViewCache`.
+    :param db_resource: The database's `couchdb.http.Resource`.
+    """
+    def __init__(self, view, cache, db_resource):
+        View.__init__(self, view.resource, wrapper=view.wrapper)
+        self.view = view
+        self.cache = cache
+        self.db_resource = db_resource
+    
+    def __repr__(self):
+        return '<%s %r>' % (type(self).__name__, self.view)
+    
+    def _exec(self, options):
+        key = (self.resource.url, getattr(self.view, 'map_fun', None),
+               json.encode(sorted(options.items())))
+        seq, data = self.cache.lookup(self.db_resource, key)
+        if data is None:
+            data = self.view._exec(options)
+            self.cache.store(self.db_resource, seq, key, data)
+        return copy.deepcopy(data)
+
+
 # only overridden so it will use our ViewDefinition
 # this should be transparent to the user
 
@@ -40,5 +238,49 @@ class ViewField(OldViewField):
         wrapper = super(ViewField, self).__get__(instance, cls).wrapper
         return ViewDefinition(self.design, self.name, self.map_fun,
                               self.reduce_fun, language=self.language,
-                              wrapper=wrapper, **self.defaults)
+                              wrapper=wrapper, document=cls, **self.defaults)
+
+
+def document_viewdefs(cls):
+    """
+    This returns the view definitions declared on a document class, either
+    directly or through a `ViewField`, including the ones it inherits,
+    sorted by attribute name. It only looks in the ``__dict__`` of every
+    class in the MRO, so unlike going through ``dir`` and ``getattr``, it
+    doesn't run the descriptors of every field and method on the class.
+
+    :param cls: The document class.
+    """
+    items = {}
+    for klass in cls.__mro__:
+        for name, item in vars(klass).items():
+            if name not in items:
+                items[name] = item
+    viewdefs = []
+    for name, item in sorted(items.items()):
+        if isinstance(item, OldViewField):
+            viewdefs.append(item.__get__(None, cls))
+        elif isinstance(item, OldViewDefinition):
+            viewdefs.append(item)
+    return viewdefs
+
+
+def _encode_options(options):
+    retval = {}
+    for name, value in options.items():
+        if name in ('key', 'startkey', 'endkey') \
+                or not isinstance(value, basestring):
+            value = json.encode(value)
+        retval[name] = value
+    return retval
+
+
+def fetch_rows(results):
+    """
+    This runs a view query right away and returns its results.
 
+    :param results: The `ViewResults` of a query.
+    """
+    # ViewResults only run the query the first time `rows` is read
+    results.rows
+    return results
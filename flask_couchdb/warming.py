@@ -0,0 +1,242 @@
+# -*- coding: utf-8 -*-
+"""
+
+flask_couchdb.warming
+~~~~~~~~~~~~~~~~~~~~~
+
+Bringing view indexes up to date in the background, after writes and after
+design documents change.
+
+:copyright: 2010 Matthew "LeafStorm" Frazier
+:license:   MIT/X11, see LICENSE for details
+
+"""
+
+import os
+import time
+import threading
+from couchdb.http import Resource
+from flask_couchdb.design import STAGING_SUFFIX
+
+__all__ = ['IndexWarmer', 'IndexBuild']
+
+
+def warm_index(db, design, view):
+    """
+    This brings the index of a design document up to date, by querying one
+    of its views with ``limit=0``. (CouchDB builds the indexes for all the
+    views in a design document together.) It returns when the index is
+    current.
+
+    :param db: The database.
+    :param design: The design document's name, without ``_design/``.
+    :param view: The name of one of its views.
+    """
+    db.resource('_design', design, '_view', view).get_json(limit=0)
+
+
+class IndexWarmer(object):
+    """
+    This updates view indexes in the background after documents have been
+    written, so that reads using ``stale`` (see `ViewDefinition`) get
+    reasonably fresh results without ever waiting for an index build
+    themselves. `touch` is called after every write, and a background
+    thread queries each design document with ``limit=0`` after `delay`
+    seconds. Writes that happen in the meantime are warmed together.
+
+    :param views: A function that returns a dictionary mapping the names
+                  of the design documents to warm to the name of one of
+                  their views.
+    :param delay: Seconds to wait after a write before warming, so bursts
+                  of writes only warm the indexes once.
+    :param on_error: A function called with ``(db, design, exc)`` when
+                     warming an index fails.
+    """
+    def __init__(self, views, delay=1.0, on_error=None):
+        self.views = views
+        self.delay = delay
+        self.on_error = on_error
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.pending = {}
+        self.pid = None
+        self.thread = None
+        self.touched = self.warmed = self.failed = 0
+
+    def touch(self, db):
+        """
+        This records that documents were written to a database, so its
+        indexes should be warmed.
+
+        :param db: The database.
+        """
+        with self.lock:
+            self.pending[db.resource.url] = db
+            self.touched += 1
+            # the background thread doesn't survive a fork
+            if self.thread is None or self.pid != os.getpid():
+                self.pid = os.getpid()
+                self.thread = threading.Thread(target=self._run)
+                self.thread.daemon = True
+                self.thread.start()
+        self.wakeup.set()
+
+    def stats(self):
+        """
+        This returns a dictionary with the number of databases waiting to
+        be warmed (`pending`) and running totals of writes `touched` and of
+        design documents `warmed` and `failed`.
+        """
+        with self.lock:
+            return {'pending': len(self.pending), 'touched': self.touched,
+                    'warmed': self.warmed, 'failed': self.failed}
+
+    def _run(self):
+        while True:
+            self.wakeup.wait()
+            time.sleep(self.delay)
+            self.wakeup.clear()
+            with self.lock:
+                pending, self.pending = self.pending, {}
+            views = self.views()
+            for db in pending.values():
+                for design, view in sorted(views.items()):
+                    try:
+                        warm_index(db, design, view)
+                    except Exception as e:
+                        with self.lock:
+                            self.failed += 1
+                        if self.on_error is not None:
+                            try:
+                                self.on_error(db, design, e)
+                            except Exception:
+                                pass
+                    else:
+                        with self.lock:
+                            self.warmed += 1
+
+
+class IndexBuild(object):
+    """
+    This builds the indexes of several design documents at the same time,
+    in the background. `CouchDB.sync` returns one when asked to warm the
+    design documents it changed, so the first requests after a deploy
+    don't have to wait for the indexes to be built.
+
+    If the new design documents were saved under staging names (see
+    `STAGING_SUFFIX`), each one is copied over the real design document
+    once its index is ready, and the staging document is deleted. CouchDB
+    shares indexes between design documents with the same views, so the
+    real design document's views switch to the new index at once, and
+    until then they keep using the old one.
+
+    :param db: The database.
+    :param views: A dictionary mapping the names of the design documents to
+                  build to the name of one of their views.
+    :param staged: Whether the design documents were saved under staging
+                   names.
+    :param on_swapped: A function called with the name of every staged
+                       design document once it has replaced the real one.
+
+    `finished` maps the design documents that are done to the seconds they
+    took, and `errors` maps the ones that failed to the exception.
+    """
+    def __init__(self, db, views, staged=False, on_swapped=None):
+        self.db = db
+        self.views = views
+        self.staged = staged
+        self.on_swapped = on_swapped
+        self.lock = threading.Lock()
+        self.results = {}
+        self.finished = {}
+        self.errors = {}
+        self.started = None
+
+    def start(self, submit):
+        """
+        This starts building the indexes.
+
+        :param submit: A function like `CouchDB.submit` that runs a function
+                       in the background and returns an `AsyncResult`.
+        """
+        self.started = time.time()
+        for design, view in self.views.items():
+            self.results[design] = submit(self._build, design, view)
+        return self
+
+    @property
+    def ready(self):
+        """Whether every index has been built (or failed to build)."""
+        with self.lock:
+            return len(self.finished) + len(self.errors) == len(self.views)
+
+    def wait(self, timeout=None):
+        """
+        This waits until every index has been built, or `timeout` seconds
+        have passed, and returns `ready`. Any errors are in `errors`.
+
+        :param timeout: The maximum number of seconds to wait.
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        for result in self.results.values():
+            remaining = None
+            if deadline is not None:
+                remaining = max(deadline - time.time(), 0)
+            result.wait(remaining)
+        return self.ready
+
+    def progress(self):
+        """
+        This returns a dictionary mapping the name of every design document
+        being built to how far along its index is, in percent. It is read
+        from the server's ``_active_tasks``.
+        """
+        tasks = {}
+        for task in self._active_tasks():
+            if task.get('type') == 'indexer' and \
+                    task.get('database') == self.db.name:
+                tasks[task.get('design_document')] = task.get('progress', 0)
+        progress = {}
+        with self.lock:
+            for design in self.views:
+                if design in self.finished or design in self.errors:
+                    progress[design] = 100
+                else:
+                    progress[design] = tasks.get(
+                        '_design/' + self._building(design), 0)
+        return progress
+
+    def _building(self, design):
+        return design + STAGING_SUFFIX if self.staged else design
+
+    def _active_tasks(self):
+        url = self.db.resource.url.rstrip('/').rsplit('/', 1)[0]
+        server = Resource(url, self.db.resource.session)
+        _, _, data = server.get_json('_active_tasks')
+        return data
+
+    def _build(self, design, view):
+        try:
+            warm_index(self.db, self._building(design), view)
+            if self.staged:
+                self._swap(design)
+                if self.on_swapped is not None:
+                    self.on_swapped(design)
+        except Exception as e:
+            with self.lock:
+                self.errors[design] = e
+            raise
+        with self.lock:
+            self.finished[design] = time.time() - self.started
+
+    def _swap(self, design):
+        staging_id = '_design/%s%s' % (design, STAGING_SUFFIX)
+        staged = self.db[staging_id]
+        doc = dict(staged, _id='_design/' + design)
+        current = self.db.get(doc['_id'])
+        if current is None:
+            del doc['_rev']
+        else:
+            doc['_rev'] = current['_rev']
+        self.db.save(doc)
+        self.db.delete(staged)
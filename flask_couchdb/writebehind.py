@@ -0,0 +1,221 @@
+# -*- coding: utf-8 -*-
+"""
+
+flask_couchdb.writebehind
+~~~~~~~~~~~~~~~~~~~~~~~~~
+
+A queue that saves documents in the background, in ``_bulk_docs`` batches.
+
+:copyright: 2010 Matthew "LeafStorm" Frazier
+:license:   MIT/X11, see LICENSE for details
+
+"""
+
+import os
+import copy
+import time
+import threading
+import Queue
+from flask_couchdb.cache import current_manager
+
+__all__ = ['WriteBehindQueue']
+
+_FLUSH = object()
+_STOP = object()
+
+
+class WriteBehindQueue(object):
+    """
+    This collects documents to be saved and writes them from a background
+    thread, in one ``_bulk_docs`` request per batch. A batch is written once
+    it has `batch_size` documents, or `interval` seconds after its first
+    document was queued, whichever comes first.
+
+    The queue holds at most `maxsize` documents. When it is full, `put`
+    blocks until the background thread has caught up, so a burst of writes
+    slows its producers down instead of using unbounded memory. If `timeout`
+    is given, `put` raises `Queue.Full` after waiting that long.
+
+    Since the documents are saved after `put` returns, errors (such as
+    conflicts) can't be raised to the caller. Instead, `on_error` is called
+    with the document and the exception. `on_saved` is called with the
+    database and the document once it has been saved, to update the caches.
+
+    :param batch_size: The maximum number of documents per request.
+    :param interval: The maximum number of seconds a document waits.
+    :param maxsize: The maximum number of documents waiting.
+    :param timeout: Seconds `put` waits for room in the queue, or `None` to
+                    wait forever.
+    :param on_error: A function called with ``(doc, exc)`` for every
+                     document that could not be saved.
+    :param on_saved: A function called with ``(db, doc)`` for every
+                     document that was saved.
+    """
+    def __init__(self, batch_size=100, interval=1.0, maxsize=10000,
+                 timeout=None, on_error=None, on_saved=None):
+        self.batch_size = batch_size
+        self.interval = interval
+        self.maxsize = maxsize
+        self.timeout = timeout
+        self.on_error = on_error
+        self.on_saved = on_saved
+        self.lock = threading.Lock()
+        self.pid = None
+        self.thread = None
+        self.queue = None
+        self.queued = self.written = self.failed = 0
+        self.batches = self.waits = 0
+        self.flush_time = self.max_flush_time = 0.0
+
+    def put(self, db, doc, data, saved):
+        """
+        This queues a document to be saved.
+
+        :param db: The database to save it to.
+        :param doc: The document instance.
+        :param data: The JSON data to send. It is copied, so changes made to
+                     the document after it was queued are not saved.
+        :param saved: A function called with the document and its new ID and
+                      revision once it has been saved.
+        """
+        queue = self._start()
+        item = (db, doc, copy.deepcopy(data), saved)
+        if queue.full():
+            with self.lock:
+                self.waits += 1
+        queue.put(item, True, self.timeout)
+        with self.lock:
+            self.queued += 1
+
+    def flush(self):
+        """
+        This blocks until every document queued so far has been written (or
+        has failed).
+        """
+        if self.queue is None or self.pid != os.getpid():
+            return
+        self.queue.put(_FLUSH)
+        self.queue.join()
+
+    def close(self):
+        """
+        This writes everything that is still queued and stops the background
+        thread. The manager calls this when the process exits.
+        """
+        if self.thread is None or self.pid != os.getpid():
+            return
+        self.queue.put(_STOP)
+        self.thread.join()
+        self.thread = None
+
+    def stats(self):
+        """
+        This returns a dictionary with the current queue `depth` and running
+        totals of documents `queued`, `written` and `failed`, of `batches`
+        written, of `waits` for room in the queue, and the average and
+        maximum time a batch took to write (`avg_flush_time` and
+        `max_flush_time`, in seconds).
+        """
+        with self.lock:
+            return {
+                'depth': self.queue.qsize() if self.queue is not None else 0,
+                'queued': self.queued,
+                'written': self.written,
+                'failed': self.failed,
+                'batches': self.batches,
+                'waits': self.waits,
+                'avg_flush_time': (self.flush_time / self.batches
+                                   if self.batches else 0.0),
+                'max_flush_time': self.max_flush_time,
+            }
+
+    def _start(self):
+        with self.lock:
+            # the background thread doesn't survive a fork
+            if self.thread is None or self.pid != os.getpid():
+                self.pid = os.getpid()
+                self.queue = Queue.Queue(self.maxsize)
+                self.thread = threading.Thread(target=self._run)
+                self.thread.daemon = True
+                self.thread.start()
+            return self.queue
+
+    def _run(self):
+        queue = self.queue
+        stopping = False
+        while not stopping:
+            item = queue.get()
+            batch = []
+            deadline = time.time() + self.interval
+            while True:
+                if item is _STOP:
+                    stopping = True
+                    break
+                if item is _FLUSH:
+                    break
+                batch.append(item)
+                if len(batch) >= self.batch_size:
+                    break
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                try:
+                    item = queue.get(True, remaining)
+                except Queue.Empty:
+                    break
+            if batch:
+                self._write(batch)
+            for _ in range(len(batch) + (item is _FLUSH or item is _STOP)):
+                queue.task_done()
+
+    def _write(self, batch):
+        started = time.time()
+        by_db = {}
+        for item in batch:
+            by_db.setdefault(item[0].resource.url, []).append(item)
+        for items in by_db.values():
+            db = items[0][0]
+            try:
+                outcome = db.update([item[2] for item in items])
+            except Exception as e:
+                outcome = [(False, None, e)] * len(items)
+            for (db, doc, data, saved), (ok, id, rev) in zip(items, outcome):
+                if ok:
+                    saved(doc, id, rev)
+                    with self.lock:
+                        self.written += 1
+                    if self.on_saved is not None:
+                        try:
+                            self.on_saved(db, doc)
+                        except Exception:
+                            pass
+                else:
+                    with self.lock:
+                        self.failed += 1
+                    if self.on_error is not None:
+                        try:
+                            self.on_error(doc, rev)
+                        except Exception:
+                            pass
+        elapsed = time.time() - started
+        with self.lock:
+            self.batches += 1
+            self.flush_time += elapsed
+            self.max_flush_time = max(self.max_flush_time, elapsed)
+
+
+def current_write_behind(defer=None):
+    """
+    This returns the manager's write-behind queue if a document being stored
+    should go through it, or `None` if it should be saved right away.
+
+    :param defer: `True` or `False` to override the manager's
+                  `COUCHDB_WRITE_BEHIND` setting for this document. (Outside
+                  of a request, documents are always saved right away.)
+    """
+    couch = current_manager()
+    if couch is None:
+        return None
+    if defer is None:
+        defer = couch.defer_writes
+    return couch.get_write_behind() if defer else None
@@ -0,0 +1,591 @@
+# -*- coding: utf-8 -*-
+"""
+tests/couchdb_standin.py
+========================
+A small, in-process stand-in for a CouchDB server. It speaks enough of the
+CouchDB HTTP API (documents, ``_all_docs``, ``_bulk_docs``, ``_changes``,
+views and update handlers) for couchdb-python and Flask-CouchDB to talk to it
+over a real socket, which lets the tests exercise connection handling and
+concurrency without a live CouchDB install.
+
+Since it can't run JavaScript, views and update handlers are plain Python
+callables registered with `CouchDBStandIn.add_view` and
+`CouchDBStandIn.add_update`, keyed by design document and name.
+
+Test cases use it through `StandInMixin`, like the ones that need a live
+server use `couchdb.tests.testutil.TempDatabaseMixin`.
+
+:copyright: 2010 Matthew "LeafStorm" Frazier
+:license:   MIT/X11, see LICENSE for details
+"""
+import itertools
+import json
+import threading
+import urllib
+import urlparse
+import uuid
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+import flask
+import flask_couchdb
+
+#: Query parameters that are sent as raw strings rather than JSON.
+RAW_PARAMS = frozenset(['startkey_docid', 'endkey_docid', 'stale', 'update',
+                        'feed', 'filter', 'rev', 'doc_type', 'style'])
+
+_HIGH = (99,)
+
+
+def collate(value):
+    """Return a sort key that follows CouchDB's view collation order."""
+    if value is None:
+        return (0,)
+    if value is False:
+        return (1,)
+    if value is True:
+        return (2,)
+    if isinstance(value, (int, long, float)):
+        return (3, value)
+    if isinstance(value, basestring):
+        return (4, value)
+    if isinstance(value, list):
+        return (5, [collate(v) for v in value])
+    if isinstance(value, dict):
+        if not value:
+            return _HIGH
+        return (6, [(k, collate(v)) for k, v in sorted(value.items())])
+    raise TypeError('cannot collate %r' % (value,))
+
+
+class HTTPError(Exception):
+    def __init__(self, status, error, reason=''):
+        Exception.__init__(self, status, error, reason)
+        self.status = status
+        self.body = {'error': error, 'reason': reason}
+
+
+class Database(object):
+    def __init__(self, name):
+        self.name = name
+        self.docs = {}
+        self.local = {}
+        self.seq = 0
+        self.changes = {}   # docid -> (seq, rev, deleted)
+
+    def info(self):
+        return {'db_name': self.name, 'update_seq': self.seq,
+                'doc_count': len(self.docs)}
+
+    def put(self, docid, body):
+        if docid.startswith('_local/'):
+            current = self.local.get(docid)
+            if current is not None and body.get('_rev') != current['_rev']:
+                raise HTTPError(409, 'conflict', 'Document update conflict.')
+            rev = '0-%d' % (int((current or {'_rev': '0-0'})['_rev']
+                                .split('-')[1]) + 1)
+            body = dict(body, _id=docid, _rev=rev)
+            self.local[docid] = body
+            return rev
+        current = self.docs.get(docid)
+        if current is not None:
+            if body.get('_rev') != current['_rev']:
+                raise HTTPError(409, 'conflict', 'Document update conflict.')
+            generation = int(current['_rev'].split('-')[0])
+        else:
+            if body.get('_rev') and docid in self.changes:
+                raise HTTPError(409, 'conflict', 'Document update conflict.')
+            generation = 0
+        rev = '%d-%s' % (generation + 1, uuid.uuid4().hex)
+        if body.get('_deleted'):
+            if current is None:
+                raise HTTPError(404, 'not_found', 'missing')
+            del self.docs[docid]
+            self._changed(docid, rev, True)
+            return rev
+        doc = dict(body, _id=docid, _rev=rev)
+        self.docs[docid] = doc
+        self._changed(docid, rev, False)
+        return rev
+
+    def delete(self, docid, rev):
+        current = self.docs.get(docid)
+        if current is None:
+            raise HTTPError(404, 'not_found', 'missing')
+        return self.put(docid, {'_rev': rev, '_deleted': True})
+
+    def _changed(self, docid, rev, deleted):
+        self.seq += 1
+        self.changes[docid] = (self.seq, rev, deleted)
+
+
+class CouchDBStandIn(ThreadingMixIn, HTTPServer):
+    """
+    A threaded HTTP server holding CouchDB-like databases in memory. Use
+    `start` to run it in a background thread, and `url` to point a
+    `couchdb.Server` at it. Setting `fail_changes` makes that many requests
+    to ``_changes`` fail, to simulate losing the connection.
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, host='127.0.0.1', port=0):
+        HTTPServer.__init__(self, (host, port), _Handler)
+        self.databases = {}
+        self.views = {}
+        self.updates = {}
+        self.requests = []
+        self.active_tasks = []
+        self.fail_changes = 0
+        self.lock = threading.RLock()
+        self.requests_lock = threading.Lock()
+        self.changed = threading.Condition(self.lock)
+        self.thread = None
+
+    @property
+    def url(self):
+        return 'http://%s:%d/' % self.server_address
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def add_view(self, design, name, map_fun, reduce_fun=None):
+        """
+        Registers a view. `map_fun` is called with each document and should
+        yield ``(key, value)`` pairs; `reduce_fun` is called like a CouchDB
+        reduce function, with ``(keys, values, rereduce)``.
+        """
+        self.views[(design, name)] = (map_fun, reduce_fun)
+
+    def add_update(self, design, name, fun):
+        """
+        Registers an update handler. `fun` is called with ``(doc, body)``
+        and should return ``(new_doc, response)``, like a CouchDB update
+        function.
+        """
+        self.updates[(design, name)] = fun
+
+    def count(self, method=None, path_part=None):
+        """Counts the recorded requests matching a method and path part."""
+        return len([r for r in self.requests
+                    if (method is None or r[0] == method) and
+                       (path_part is None or path_part in r[1])])
+
+
+class StandInMixin(object):
+    """
+    Gives every test a fresh `CouchDBStandIn` (as `couch`), an app that
+    uses it (as `app`), and a manager connected to its `database` (as
+    `manager`, with the database as `db`).
+
+    `config` is added to the app's configuration before the manager is
+    made. The ``(design, name, map_fun[, reduce_fun])`` tuples in `views`
+    are registered with the stand-in, and the classes in `documents` are
+    added to the manager, which is synced if `sync` is set. Override
+    `make_manager` to set the manager up differently.
+    """
+    database = 'flask-couchdb-tests'
+    config = {}
+    views = ()
+    documents = ()
+    sync = False
+
+    def setUp(self):
+        self.couch = CouchDBStandIn().start()
+        for view in self.views:
+            self.couch.add_view(*view)
+        self.app = flask.Flask('flask-couchdb-tests')
+        self.app.config['COUCHDB_SERVER'] = self.couch.url
+        self.app.config['COUCHDB_DATABASE'] = self.database
+        self.app.config.update(self.config)
+        self.manager = self.make_manager()
+        self.db = self.manager.db
+        if self.sync:
+            self.manager.sync(self.app)
+
+    def tearDown(self):
+        self.couch.stop()
+
+    def make_manager(self):
+        manager = flask_couchdb.CouchDB(app=self.app)
+        for cls in self.documents:
+            manager.add_document(cls)
+        manager.connect_db(self.app)
+        return manager
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # buffer each response, so it goes out in as few packets as possible
+    wbufsize = -1
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        self._dispatch('GET')
+
+    def do_HEAD(self):
+        self._dispatch('HEAD')
+
+    def do_PUT(self):
+        self._dispatch('PUT')
+
+    def do_POST(self):
+        self._dispatch('POST')
+
+    def do_DELETE(self):
+        self._dispatch('DELETE')
+
+    def _dispatch(self, method):
+        url = urlparse.urlsplit(self.path)
+        parts = [urllib.unquote(p) for p in url.path.split('/') if p]
+        query = {}
+        for name, value in urlparse.parse_qsl(url.query, True):
+            if name not in RAW_PARAMS:
+                try:
+                    value = json.loads(value)
+                except ValueError:
+                    pass
+            query[name] = value
+        length = int(self.headers.get('content-length') or 0)
+        raw = self.rfile.read(length) if length else ''
+        body = json.loads(raw) if raw else None
+        server = self.server
+        # recorded under a lock of its own, not the databases' one
+        with server.requests_lock:
+            server.requests.append((method, url.path, query))
+        try:
+            result = self._route(method, parts, query, body)
+        except HTTPError as e:
+            return self._send(e.status, e.body, method=method)
+        if isinstance(result, _Stream):
+            return self._send_chunked(result)
+        status, data = result[:2]
+        headers = result[2] if len(result) > 2 else {}
+        self._send(status, data, headers, method)
+
+    def _send(self, status, data, headers=None, method='GET'):
+        payload = json.dumps(data) + '\n' if data is not None else ''
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        if method != 'HEAD':
+            self.wfile.write(payload)
+
+    def _send_chunked(self, stream):
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        for piece in stream:
+            if piece:
+                self.wfile.write('%x\r\n%s\r\n' % (len(piece), piece))
+                if stream.live:
+                    self.wfile.flush()
+        self.wfile.write('0\r\n\r\n')
+
+    def _route(self, method, parts, query, body):
+        server = self.server
+        if not parts:
+            return 200, {'couchdb': 'Welcome', 'version': '1.6.1'}
+        if parts == ['_active_tasks']:
+            return 200, list(server.active_tasks)
+        if parts == ['_all_dbs']:
+            return 200, sorted(server.databases)
+        if parts == ['_uuids']:
+            count = int(query.get('count', 1))
+            return 200, {'uuids': [uuid.uuid4().hex for _ in range(count)]}
+        dbname, rest = parts[0], parts[1:]
+        if rest[:1] == ['_design'] and len(rest) >= 4 and rest[2] == '_view':
+            return self._view(dbname, rest[1], rest[3], query, body)
+        with server.lock:
+            db = server.databases.get(dbname)
+            if not rest:
+                if method == 'PUT':
+                    if db is not None:
+                        raise HTTPError(412, 'file_exists', 'exists')
+                    server.databases[dbname] = Database(dbname)
+                    return 201, {'ok': True}
+                if db is None:
+                    raise HTTPError(404, 'not_found', 'no_db_file')
+                if method == 'DELETE':
+                    del server.databases[dbname]
+                    return 200, {'ok': True}
+                if method == 'POST':
+                    docid = body.get('_id') or uuid.uuid4().hex
+                    rev = db.put(docid, body)
+                    server.changed.notify_all()
+                    return 201, {'ok': True, 'id': docid, 'rev': rev}
+                return 200, db.info()
+            if db is None:
+                raise HTTPError(404, 'not_found', 'no_db_file')
+            head = rest[0]
+            if head == '_all_docs':
+                return self._all_docs(db, query, body)
+            if head == '_bulk_docs':
+                return self._bulk_docs(db, body)
+            if head == '_changes':
+                return self._changes(db, query)
+            if head in ('_ensure_full_commit', '_compact', '_view_cleanup'):
+                return 201, {'ok': True}
+            if head == '_design' and len(rest) >= 4:
+                design, kind, name = rest[1], rest[2], rest[3]
+                if kind == '_update':
+                    docid = rest[4] if len(rest) > 4 else None
+                    return self._update(db, design, name, docid, query, body)
+            docid = '/'.join(rest)
+            return self._document(db, method, docid, query, body)
+
+    def _document(self, db, method, docid, query, body):
+        store = db.local if docid.startswith('_local/') else db.docs
+        if method in ('GET', 'HEAD'):
+            doc = store.get(docid)
+            if doc is None:
+                raise HTTPError(404, 'not_found', 'missing')
+            etag = '"%s"' % doc['_rev']
+            if self.headers.get('if-none-match') == etag:
+                return 304, None, {'ETag': etag}
+            return 200, doc, {'ETag': etag}
+        if method == 'PUT':
+            if body is None:
+                raise HTTPError(400, 'bad_request', 'no body')
+            rev = db.put(docid, body)
+            self.server.changed.notify_all()
+            return 201, {'ok': True, 'id': docid, 'rev': rev}, \
+                {'ETag': '"%s"' % rev}
+        if method == 'DELETE':
+            if docid.startswith('_local/'):
+                db.local.pop(docid, None)
+                return 200, {'ok': True, 'id': docid, 'rev': '0-0'}
+            rev = db.delete(docid, query.get('rev'))
+            self.server.changed.notify_all()
+            return 200, {'ok': True, 'id': docid, 'rev': rev}
+        raise HTTPError(405, 'method_not_allowed', method)
+
+    def _bulk_docs(self, db, body):
+        results = []
+        for doc in body['docs']:
+            docid = doc.get('_id') or uuid.uuid4().hex
+            try:
+                rev = db.put(docid, doc)
+            except HTTPError as e:
+                results.append(dict(e.body, id=docid))
+            else:
+                results.append({'ok': True, 'id': docid, 'rev': rev})
+        self.server.changed.notify_all()
+        return 201, results
+
+    def _all_docs(self, db, query, body):
+        rows = [(doc['_id'], doc['_id'], {'rev': doc['_rev']})
+                for doc in db.docs.values()]
+        if body and 'keys' in body:
+            out = []
+            for key in body['keys']:
+                doc = db.docs.get(key)
+                if doc is None:
+                    out.append({'key': key, 'error': 'not_found'})
+                    continue
+                row = {'id': key, 'key': key, 'value': {'rev': doc['_rev']}}
+                if query.get('include_docs'):
+                    row['doc'] = doc
+                out.append(row)
+            return 200, {'total_rows': len(db.docs), 'offset': 0,
+                         'rows': out}
+        return 200, self._query(db, rows, None, query)
+
+    def _view(self, dbname, design, name, query, body):
+        server = self.server
+        with server.lock:
+            db = server.databases.get(dbname)
+            if db is None:
+                raise HTTPError(404, 'not_found', 'no_db_file')
+            try:
+                map_fun, reduce_fun = server.views[(design, name)]
+            except KeyError:
+                raise HTTPError(404, 'not_found', 'missing_named_view')
+            docs = [doc for doc in db.docs.values()
+                    if not doc['_id'].startswith('_design/')]
+        # the map function runs outside the lock, so a slow one doesn't
+        # hold up other requests
+        rows = []
+        for doc in docs:
+            for key, value in map_fun(doc):
+                rows.append((key, doc['_id'], value))
+        if body and 'keys' in body:
+            query = dict(query, keys=body['keys'])
+        with server.lock:
+            data = self._query(db, rows, reduce_fun, query)
+        return _Stream(data)
+
+    def _query(self, db, rows, reduce_fun, query):
+        descending = bool(query.get('descending'))
+        rows.sort(key=lambda r: (collate(r[0]), r[1]), reverse=descending)
+        if 'key' in query:
+            rows = [r for r in rows if r[0] == query['key']]
+        if 'keys' in query:
+            keyed = []
+            for key in query['keys']:
+                keyed.extend(r for r in rows if r[0] == key)
+            rows = keyed
+        low, high = u'', u'￿' * 4
+        if 'startkey' in query:
+            start = (collate(query['startkey']),
+                     query.get('startkey_docid',
+                               high if descending else low))
+            if descending:
+                rows = [r for r in rows if (collate(r[0]), r[1]) <= start]
+            else:
+                rows = [r for r in rows if (collate(r[0]), r[1]) >= start]
+        if 'endkey' in query:
+            end = (collate(query['endkey']),
+                   query.get('endkey_docid', low if descending else high))
+            if descending:
+                rows = [r for r in rows if (collate(r[0]), r[1]) >= end]
+            else:
+                rows = [r for r in rows if (collate(r[0]), r[1]) <= end]
+        if reduce_fun is not None and query.get('reduce', True):
+            level = query.get('group_level')
+            if query.get('group'):
+                level = None if level is None else level
+                group = lambda k: k
+            elif level is not None:
+                group = lambda k: k[:level] if isinstance(k, list) else k
+            else:
+                group = lambda k: None
+            out = []
+            for key, items in itertools.groupby(rows, lambda r: group(r[0])):
+                items = list(items)
+                value = reduce_fun([[r[0], r[1]] for r in items],
+                                   [r[2] for r in items], False)
+                out.append({'key': key, 'value': value})
+            skip = int(query.get('skip', 0))
+            out = out[skip:]
+            if 'limit' in query:
+                out = out[:int(query['limit'])]
+            return {'rows': out}
+        total = len(rows)
+        skip = int(query.get('skip', 0))
+        rows = rows[skip:]
+        if 'limit' in query:
+            rows = rows[:int(query['limit'])]
+        out = []
+        for key, docid, value in rows:
+            row = {'id': docid, 'key': key, 'value': value}
+            if query.get('include_docs'):
+                row['doc'] = db.docs.get(docid)
+            out.append(row)
+        data = {'total_rows': total, 'offset': skip, 'rows': out}
+        if query.get('update_seq'):
+            data['update_seq'] = db.seq
+        return data
+
+    def _changes(self, db, query):
+        server = self.server
+        if server.fail_changes:
+            server.fail_changes -= 1
+            raise HTTPError(500, 'unknown_error', 'simulated failure')
+        since = int(query.get('since', 0) or 0)
+        timeout = float(query.get('timeout', 60000)) / 1000.0
+        include_docs = query.get('include_docs')
+        if query.get('feed') == 'continuous':
+            return _ChangesStream(server, db, since, timeout, include_docs)
+        if query.get('feed') == 'longpoll':
+            if db.seq <= since:
+                server.changed.wait(timeout)
+        results = _change_rows(db, since, include_docs)
+        if 'limit' in query:
+            results = results[:int(query['limit'])]
+        last_seq = results[-1]['seq'] if results else max(since, db.seq)
+        return 200, {'results': results, 'last_seq': last_seq}
+
+    def _update(self, db, design, name, docid, query, body):
+        try:
+            fun = self.server.updates[(design, name)]
+        except KeyError:
+            raise HTTPError(404, 'not_found', 'missing update handler')
+        doc = db.docs.get(docid) if docid else None
+        new_doc, response = fun(doc and dict(doc), body)
+        headers = {}
+        if new_doc is not None:
+            rev = db.put(new_doc['_id'], new_doc)
+            self.server.changed.notify_all()
+            headers['X-Couch-Update-NewRev'] = rev
+        return 201, response, headers
+
+
+class _Stream(object):
+    """
+    A view response that is sent chunked, one row per line, the way CouchDB
+    sends it.
+    """
+    live = False
+
+    def __init__(self, data):
+        self.data = data
+
+    def __iter__(self):
+        rows = self.data['rows']
+        header = dict((k, v) for k, v in self.data.items() if k != 'rows')
+        head = json.dumps(header)[:-1]
+        yield head + (',' if header else '') + '"rows":[\r\n'
+        for index, row in enumerate(rows):
+            yield (',\r\n' if index else '') + json.dumps(row)
+        yield '\r\n]}\n'
+
+
+class _ChangesStream(_Stream):
+    """
+    A continuous changes feed, sent chunked one change per line as the
+    changes happen. It ends with a ``last_seq`` line once `timeout` seconds
+    pass without a change.
+    """
+    live = True
+
+    def __init__(self, server, db, since, timeout, include_docs):
+        self.server = server
+        self.db = db
+        self.since = since
+        self.timeout = timeout
+        self.include_docs = include_docs
+
+    def __iter__(self):
+        since = self.since
+        while True:
+            with self.server.lock:
+                changes = _change_rows(self.db, since, self.include_docs)
+                if not changes:
+                    self.server.changed.wait(self.timeout)
+                    changes = _change_rows(self.db, since, self.include_docs)
+                last_seq = max(since, self.db.seq)
+            if not changes:
+                yield json.dumps({'last_seq': last_seq}) + '\n'
+                return
+            for change in changes:
+                yield json.dumps(change) + '\n'
+                since = change['seq']
+
+
+def _change_rows(db, since, include_docs):
+    changes = sorted((seq, docid, rev, deleted)
+                     for docid, (seq, rev, deleted) in db.changes.items()
+                     if seq > since)
+    results = []
+    for seq, docid, rev, deleted in changes:
+        change = {'seq': seq, 'id': docid, 'changes': [{'rev': rev}]}
+        if deleted:
+            change['deleted'] = True
+        if include_docs:
+            change['doc'] = db.docs.get(docid) or \
+                {'_id': docid, '_rev': rev, '_deleted': True}
+        results.append(change)
+    return results
@@ -10,18 +10,38 @@ It should be run using Nose. It will attempt to use the CouchDB server at
 override these with the environment variables `FLASKEXT_COUCHDB_SERVER` and
 `FLASKEXT_COUCHDB_DATABASE`.
 
+The test cases built on `couchdb_standin.StandInMixin` run against an
+in-process stand-in instead, so they don't need a CouchDB server.
+
 :copyright: 2010 Matthew "LeafStorm" Frazier
 :license:   MIT/X11, see LICENSE for details
 """
 from __future__ import with_statement
 import os
+import json
+import atexit
+import time
+import threading
 import unittest
+from StringIO import StringIO
+from multiprocessing import TimeoutError
 import couchdb
 import flask
 import flask.ext.couchdb
+import flask_couchdb
 from couchdb.tests import testutil
-from couchdb.http import ResourceNotFound
+from couchdb.client import Row, ViewResults
+from couchdb.http import ResourceConflict, ResourceNotFound
 from datetime import datetime
+from werkzeug.exceptions import BadRequest
+from flask_couchdb import codec, schematics_document
+from flask_couchdb.design import (SYNC_STATE, SYNC_LOCK, design_hashes,
+                                  read_local, write_local,
+                                  acquire_sync_lock, release_sync_lock)
+from flask_couchdb.retry import backoff_delay, MAX_BACKOFF
+from flask_couchdb.streaming import RowScanner, iter_rows
+from flask_couchdb.updates import UPDATE_HANDLER
+from couchdb_standin import StandInMixin, HTTPError
 
 # this should be added to couchdb.tests.testutil.TempDatabaseMixin
 # SERVER = os.environ.get('FLASKEXT_COUCHDB_SERVER', 'http://localhost:5984/')
@@ -92,6 +112,28 @@ class TestFlaskCouchDB(testutil.TempDatabaseMixin, unittest.TestCase):
             assert isinstance(flask.g.couch, flask.ext.couchdb.CouchDB)
             assert isinstance(flask.g.couch.db, couchdb.Database)
     
+    def test_connection_pool(self):
+        self.app.config['COUCHDB_SERVER'] = self.server.resource.url
+        self.app.config['COUCHDB_DATABASE'] = self.db.name
+        self.app.config['COUCHDB_POOL_SIZE'] = 2
+        manager = flask.ext.couchdb.CouchDB(app=self.app)
+        db = manager.connect_db(self.app)
+        for d in SAMPLE_DATA:
+            db.save(d)
+        def load():
+            for i in range(10):
+                assert db['a']['username'] == 'steve'
+        threads = [threading.Thread(target=load) for i in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        stats = manager.pool_stats()
+        assert stats['maxsize'] == 2
+        assert stats['in_use'] == 0
+        assert stats['created'] <= 2
+        assert stats['idle'] == stats['created']
+    
     def test_add_viewdef(self):
         vd = flask.ext.couchdb.ViewDefinition('tests', 'all', '''\
              function(doc) {
@@ -108,6 +150,25 @@ class TestFlaskCouchDB(testutil.TempDatabaseMixin, unittest.TestCase):
         assert viewdefs[1].name == 'by_author'
         assert viewdefs[2].name == 'tagged'
     
+    def test_add_document_inherited(self):
+        class FeaturedPost(BlogPost):
+            featured = flask.ext.couchdb.ViewField('blog', '''\
+            function (doc) {
+                if (doc.doc_type == 'blogpost' && doc.featured) {
+                    emit(doc._id, doc);
+                };
+            }''')
+        self.manager.add_document(FeaturedPost)
+        viewdefs = self.manager.doc_viewdefs[FeaturedPost]
+        assert [d.name for d in viewdefs] == ['all_posts', 'by_author',
+                                              'featured', 'tagged']
+        assert viewdefs[0].wrapper is not None
+        self.manager.doc_viewdefs.clear()
+        self.manager.add_all_documents(BlogPost)
+        assert list(self.manager.doc_viewdefs) == [FeaturedPost]
+        self.manager.add_all_documents()
+        assert BlogPost in self.manager.doc_viewdefs
+    
     def test_sync(self):
         self.manager.add_document(BlogPost)
         self.manager.sync(self.app)
@@ -130,6 +191,133 @@ class TestFlaskCouchDB(testutil.TempDatabaseMixin, unittest.TestCase):
             assert post.title == 'Hello'
             assert post.doc_type == 'blogpost'
     
+    def test_identity_map(self):
+        self.app.config['COUCHDB_IDENTITY_MAP'] = True
+        with self.app.test_request_context('/'):
+            self.app.preprocess_request()
+            post = BlogPost(dict(title='Hello', text='Hello, world!',
+                            author='Steve Person'))
+            post.id = 'hello'
+            post.store()
+            assert BlogPost.load('hello') is post
+            assert BlogPost.load('hello') is BlogPost.load('hello')
+        with self.app.test_request_context('/'):
+            self.app.preprocess_request()
+            assert len(flask.g.couch.identity_map) == 0
+    
+    def test_document_cache(self):
+        cache = flask.ext.couchdb.DocumentCache(10)
+        self.manager.document_cache = cache
+        with self.app.test_request_context('/'):
+            self.app.preprocess_request()
+            post = BlogPost(dict(title='Hello', text='Hello, world!',
+                            author='Steve Person'))
+            post.id = 'hello'
+            post.store()
+            first = BlogPost.load('hello')
+            second = BlogPost.load('hello')
+            assert first is not second
+            assert second.title == 'Hello'
+            assert cache.stats()['misses'] == 1
+            assert cache.stats()['hits'] == 1
+            second.title = 'Changed'
+            second.store()
+            assert BlogPost.load('hello').title == 'Changed'
+            raw = flask.g.couch.db['hello']
+            raw['title'] = 'Raw'
+            flask.g.couch.db['hello'] = raw
+            assert BlogPost.load('hello').title == 'Raw'
+            assert cache.stats()['misses'] == 3
+    
+    def test_load_many(self):
+        with self.app.test_request_context('/'):
+            self.app.preprocess_request()
+            for post in SAMPLE_POSTS:
+                post.store()
+            posts = BlogPost.load_many(['3', 'missing', '1', '2'],
+                                       batch_size=2)
+            assert [p and p.id for p in posts] == ['3', None, '1', '2']
+            assert all(isinstance(p, BlogPost) for p in posts if p)
+            assert posts[0].title == 'N3'
+            assert BlogPost.load_many([]) == []
+    
+    def test_store_and_delete_many(self):
+        with self.app.test_request_context('/'):
+            self.app.preprocess_request()
+            posts = [BlogPost(dict(title='N%d' % n, text='number %d' % n,
+                                   author='Foo', id='bulk%d' % n))
+                     for n in range(5)]
+            result = BlogPost.store_many(posts, batch_size=2)
+            assert result.ok
+            assert len(result.succeeded) == 5
+            assert all(post.rev is not None for post in posts)
+            stale = BlogPost.load('bulk0')
+            posts[0].title = 'Changed'
+            posts[0].store()
+            stale.title = 'Conflicting'
+            result = BlogPost.store_many([posts[1], stale])
+            assert result.succeeded == [posts[1]]
+            assert result.conflicts == [stale]
+            result = BlogPost.delete_many(posts)
+            assert result.ok
+            assert 'bulk0' not in flask.g.couch.db
+    
+    def test_write_behind(self):
+        errors = []
+        self.manager.on_write_error(lambda doc, exc: errors.append(doc))
+        self.manager.defer_writes = True
+        with self.app.test_request_context('/'):
+            self.app.preprocess_request()
+            posts = [BlogPost(dict(title='N%d' % n, text='number %d' % n,
+                                   author='Foo', id='later%d' % n))
+                     for n in range(3)]
+            for post in posts:
+                post.store()
+            flask.g.couch.flush()
+            assert all(post.rev is not None for post in posts)
+            assert BlogPost.load('later1').title == 'N1'
+            stale = BlogPost.load('later0')
+            posts[0].title = 'Changed'
+            posts[0].store(defer=False)
+            stale.text = 'Stale'
+            stale.store()
+            flask.g.couch.flush()
+            assert errors == [stale]
+            stats = flask.g.couch.write_behind.stats()
+            assert stats['depth'] == 0
+            assert stats['written'] == 3
+            assert stats['failed'] == 1
+    
+    def test_write_behind_caches(self):
+        self.manager.document_cache = flask.ext.couchdb.DocumentCache(10)
+        self.manager.defer_writes = True
+        self.manager.get_write_behind().interval = 60
+        key = (self.db.resource.url, 'cached')
+        with self.app.test_request_context('/'):
+            self.app.preprocess_request()
+            BlogPost(dict(title='Cached', id='cached')).store(defer=False)
+            post = BlogPost.load('cached')
+            assert key in self.manager.document_cache.entries
+            post.title = 'Queued'
+            post.store()
+            # still the current revision until the write goes through
+            assert key in self.manager.document_cache.entries
+            flask.g.couch.flush()
+            assert key not in self.manager.document_cache.entries
+            assert self.db['cached']['title'] == 'Queued'
+    
+    def test_write_behind_teardown(self):
+        self.app.config['COUCHDB_WRITE_BEHIND_FLUSH_ON_TEARDOWN'] = True
+        self.manager.defer_writes = True
+        self.manager.get_write_behind().interval = 60
+        with self.app.test_request_context('/'):
+            self.app.preprocess_request()
+            BlogPost(dict(title='Torn down', id='teardown')).store()
+            assert 'teardown' not in self.db
+        assert self.db['teardown']['title'] == 'Torn down'
+        self.manager.close()
+        assert self.manager.write_behind.thread is None
+    
     def test_loading_nonexistent(self):
         with self.app.test_request_context('/'):
             self.app.preprocess_request()
@@ -201,8 +389,1444 @@ class TestFlaskCouchDB(testutil.TempDatabaseMixin, unittest.TestCase):
             assert page2.items[0].id == '0006'
             assert isinstance(page2.prev, basestring)
             assert isinstance(page2.prev, basestring)
+    
+    def test_lazy_page_items(self):
+        paginate = flask.ext.couchdb.paginate
+        self.manager.add_document(BlogPost)
+        self.manager.sync(self.app)
+        with self.app.test_request_context('/'):
+            self.app.preprocess_request()
+            flask.g.couch.db.update(POSTS_FOR_PAGINATION)
+            
+            wrapped = []
+            view = BlogPost.all_posts()
+            wrapper = view.view.wrapper
+            view.view.wrapper = lambda row: wrapped.append(row) or wrapper(row)
+            page = paginate(view, 10)
+            assert len(page.items) == 10
+            assert wrapped == []
+            assert page.items[3].id == '0004'
+            assert page.items[3] is page.items[3]
+            assert len(wrapped) == 1
+            assert [post.id for post in page.items[:2]] == ['0001', '0002']
+            assert [post.id for post in page.items][-1] == '0010'
+            assert len(wrapped) == 10
+            
+            page = paginate(BlogPost.all_posts(), 5, fields=['title'])
+            post = page.items[0]
+            assert isinstance(post, BlogPost)
+            assert post.id == '0001'
+            assert post.title == 'N1'
+            assert post.text is None
+    
+    def test_paging_modes(self):
+        paginate = flask.ext.couchdb.paginate
+        self.manager.add_document(BlogPost)
+        self.manager.sync(self.app)
+        with self.app.test_request_context('/'):
+            self.app.preprocess_request()
+            flask.g.couch.db.update(POSTS_FOR_PAGINATION)
+            
+            def walk(**options):
+                pages = [paginate(BlogPost.all_posts(), 7, **options)]
+                while pages[-1].next is not None:
+                    pages.append(paginate(BlogPost.all_posts(), 7,
+                                          pages[-1].next, **options))
+                return pages
+            
+            expected = walk()
+            assert len(expected) == 8
+            for options in (dict(concurrent=True), dict(carry_prev=True),
+                            dict(concurrent=True, carry_prev=True)):
+                pages = walk(**options)
+                assert [[p.id for p in page.items] for page in pages] == \
+                    [[p.id for p in page.items] for page in expected]
+                for page, prev in zip(pages[1:], pages):
+                    back = paginate(BlogPost.all_posts(), 7, page.prev,
+                                    **options)
+                    assert [p.id for p in back.items] == \
+                        [p.id for p in prev.items]
+    
+    def test_iterate_view(self):
+        iterate_view = flask.ext.couchdb.iterate_view
+        self.manager.add_document(BlogPost)
+        self.manager.sync(self.app)
+        with self.app.test_request_context('/'):
+            self.app.preprocess_request()
+            flask.g.couch.db.update(POSTS_FOR_PAGINATION)
+            expected = ['%04d' % n for n in range(1, 51)]
             
+            posts = list(iterate_view(BlogPost.all_posts(), 7))
+            assert all(isinstance(post, BlogPost) for post in posts)
+            assert [post.id for post in posts] == expected
+            posts = iterate_view(BlogPost.all_posts(), 7, prefetch=True)
+            assert [post.id for post in posts] == expected
+            posts = iterate_view(BlogPost.all_posts(descending=True), 10)
+            assert [post.id for post in posts] == expected[::-1]
+            posts = iterate_view(BlogPost.all_posts(skip=2, limit=20), 6)
+            assert [post.id for post in posts] == expected[2:22]
     
     def test_paging_keys(self):
         pass
 
+
+# The test cases below run against the in-process CouchDB stand-in.
+
+ALL_SIGNATURES = '''\
+function (doc) {
+    if (doc.doc_type == 'signature') {
+        emit(doc._id, doc);
+    };
+}'''
+
+BY_AUTHOR = '''\
+function (doc) {
+    if (doc.doc_type == 'signature') {
+        emit(doc.author, doc);
+    };
+}'''
+
+SIGNATURE_IDS = '''\
+function (doc) {
+    if (doc.doc_type == 'signature') {
+        emit(doc._id, null);
+    };
+}'''
+
+
+class Signature(flask_couchdb.Document):
+    doc_type = 'signature'
+    
+    message = flask_couchdb.TextField()
+    author = flask_couchdb.TextField()
+    time = flask_couchdb.DateTimeField()
+    
+    all = flask_couchdb.ViewField('guestbook', ALL_SIGNATURES)
+    by_author = flask_couchdb.ViewField('guestbook', BY_AUTHOR, stale='ok')
+    fresh = flask_couchdb.ViewField('guestbook', ALL_SIGNATURES, stale=False)
+    listing = flask_couchdb.ViewField('guestbook', SIGNATURE_IDS,
+                                      include_docs=True)
+
+
+class Post(schematics_document.Document):
+    title = schematics_document.StringType()
+    body = schematics_document.StringType()
+    created = schematics_document.DateTimeType()
+    tags = schematics_document.ListType(schematics_document.StringType())
+    
+    all = flask_couchdb.ViewField('blog', '''\
+    function (doc) {
+        if (doc.doc_type == 'Post') {
+            emit(doc._id, doc);
+        };
+    }''')
+
+
+def emit_signatures(key, value=lambda doc: doc):
+    # what the views on Signature do
+    def map_fun(doc):
+        if doc.get('doc_type') == 'signature':
+            return [(doc.get(key), value(doc))]
+        return []
+    return map_fun
+
+
+SIGNATURE_VIEWS = [
+    ('guestbook', 'all', emit_signatures('_id')),
+    ('guestbook', 'by_author', emit_signatures('author')),
+    ('guestbook', 'fresh', emit_signatures('_id')),
+    ('guestbook', 'listing', emit_signatures('_id', lambda doc: None)),
+]
+
+
+def store_signatures(app, count, **fields):
+    with app.test_request_context('/'):
+        app.preprocess_request()
+        Signature.store_many([
+            Signature(dict(fields, message='Hi %d' % n, id='sig%02d' % n))
+            for n in range(count)])
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.time() + timeout
+    while not condition():
+        if time.time() > deadline:
+            raise AssertionError('timed out')
+        time.sleep(0.02)
+
+
+class TestAddAllDocuments(StandInMixin, unittest.TestCase):
+    database = 'registry-tests'
+    
+    def test_add_all_documents(self):
+        class Guest(Signature):
+            guests = flask_couchdb.ViewField('guestbook', SIGNATURE_IDS)
+        self.manager.add_all_documents(Signature)
+        assert list(self.manager.doc_viewdefs) == [Guest]
+        assert [d.name for d in self.manager.doc_viewdefs[Guest]] == \
+            ['all', 'by_author', 'fresh', 'guests', 'listing']
+        self.manager.add_all_documents()
+        assert Signature in self.manager.doc_viewdefs
+        assert Post in self.manager.doc_viewdefs
+        self.manager.sync(self.app)
+        assert 'guests' in self.db['_design/guestbook']['views']
+        assert 'all' in self.db['_design/blog']['views']
+
+
+class Comment(schematics_document.Document):
+    text = schematics_document.StringType(required=True)
+
+
+class TestAsync(StandInMixin, unittest.TestCase):
+    database = 'async-tests'
+    config = {'COUCHDB_WORKERS': 4}
+    views = SIGNATURE_VIEWS
+    documents = [Signature]
+    sync = True
+    
+    def test_submit_runs_in_context(self):
+        with self.app.test_request_context('/'):
+            self.app.preprocess_request()
+            result = flask.g.couch.submit(lambda: flask.g.couch)
+            assert result.get(5) is self.manager
+    
+    def test_load_and_store(self):
+        with self.app.test_request_context('/'):
+            self.app.preprocess_request()
+            pending = [Signature(dict(message='Hi %d' % n, author='Steve',
+                                      id='sig%d' % n)).store_async()
+                       for n in range(20)]
+            stored = [result.get(5) for result in pending]
+            assert all(sig.rev is not None for sig in stored)
+            pending = [Signature.load_async('sig%d' % n) for n in range(20)]
+            loaded = [result.get(5) for result in pending]
+            assert [sig.message for sig in loaded] == \
+                ['Hi %d' % n for n in range(20)]
+            assert Signature.load_async('missing').get(5) is None
+    
+    def test_errors_are_raised_by_get(self):
+        with self.app.test_request_context('/'):
+            self.app.preprocess_request()
+            Comment(dict(_id='c', text='First')).store()
+            result = Comment(dict(_id='c', text='Second')).store_async()
+            self.assertRaises(ResourceConflict, result.get, 5)
+            comment = Comment.load_async('c').get(5)
+            assert comment.text == 'First'
+    
+    def test_views_and_pagination(self):
+        with self.app.test_request_context('/'):
+            self.app.preprocess_request()
+            Signature.store_many([
+                Signature(dict(message='Hi %d' % n, author='Steve',
+                               id='sig%02d' % n)) for n in range(12)])
+            results = Signature.all.call_async().get(5)
+            assert len(results.rows) == 12
+            assert isinstance(results.rows[0], Signature)
+            page1 = flask_couchdb.paginate_async(Signature.all(), 5).get(5)
+            page2 = flask_couchdb.paginate_async(Signature.all(), 5,
+                                                 page1.next).get(5)
+            assert [sig.id for sig in page2.items] == \
+                ['sig%02d' % n for n in range(5, 10)]
+            assert page2.prev is not None
+    
+    def test_pagination_modes(self):
+        with self.app.test_request_context('/'):
+            self.app.preprocess_request()
+            Signature.store_many([
+                Signature(dict(message='Hi %d' % n, author='Steve',
+                               id='sig%02d' % n)) for n in range(12)])
+            page1 = flask_couchdb.paginate(Signature.all(), 5,
+                                           carry_prev=True)
+            before = self.couch.count('GET', '_view')
+            page2 = flask_couchdb.paginate(Signature.all(), 5, page1.next,
+                                           carry_prev=True)
+            assert self.couch.count('GET', '_view') == before + 1
+            assert [sig.id for sig in page2.items] == \
+                ['sig%02d' % n for n in range(5, 10)]
+            back = flask_couchdb.paginate(Signature.all(), 5, page2.prev,
+                                          concurrent=True)
+            assert [sig.id for sig in back.items] == \
+                ['sig%02d' % n for n in range(5)]
+            assert back.prev is None
+    
+    def test_concurrent_pagination_on_the_pool(self):
+        with self.app.test_request_context('/'):
+            self.app.preprocess_request()
+            Signature.store_many([
+                Signature(dict(message='Hi %d' % n, author='Steve',
+                               id='sig%02d' % n)) for n in range(12)])
+            page1 = flask_couchdb.paginate(Signature.all(), 5)
+            # more pages in flight than the pool has threads
+            pending = [flask_couchdb.paginate_async(Signature.all(), 5,
+                                                    page1.next,
+                                                    concurrent=True)
+                       for n in range(8)]
+            pages = [result.get(5) for result in pending]
+            assert all([sig.id for sig in page.items] ==
+                       ['sig%02d' % n for n in range(5, 10)]
+                       for page in pages)
+            assert all(page.prev is not None for page in pages)
+    
+    def test_gather(self):
+        with self.app.test_request_context('/'):
+            self.app.preprocess_request()
+            Signature.store_many([
+                Signature(dict(message='Hi %d' % n, author='Steve',
+                               id='sig%02d' % n)) for n in range(3)])
+            def fail():
+                raise ValueError('broken')
+            rows, sig, missing, error = flask.g.couch.gather(
+                Signature.all(),
+                lambda: Signature.load('sig01'),
+                lambda: Signature.load('missing'),
+                fail)
+            assert [r.id for r in rows] == ['sig00', 'sig01', 'sig02']
+            assert sig.message == 'Hi 1'
+            assert missing is None
+            assert isinstance(error, ValueError)
+            slow, fast = flask.g.couch.gather(lambda: time.sleep(2),
+                                              lambda: 'done', timeout=0.5)
+            assert isinstance(slow, TimeoutError)
+            assert fast == 'done'
+    
+    def test_gather_on_the_pool(self):
+        with self.app.test_request_context('/'):
+            self.app.preprocess_request()
+            store_signatures(self.app, 3)
+            def nested():
+                return flask.g.couch.gather(Signature.all(),
+                                            lambda: Signature.load('sig01'))
+            # more of them than the pool has threads
+            pending = [flask.g.couch.submit(nested) for n in range(8)]
+            for result in pending:
+                rows, sig = result.get(5)
+                assert len(rows) == 3
+                assert sig.message == 'Hi 1'
+
+
+class TestRowScanner(unittest.TestCase):
+    rows = [
+        {'id': 'a', 'key': 'brace { in a "string"', 'value': None},
+        {'id': 'b', 'key': ['nested', {'x': [1, {}]}], 'value': '}\\'},
+        {'id': u'cé', 'key': None, 'value': {'doc': '", "rows": ['}},
+    ]
+    
+    def response(self):
+        return json.dumps({'total_rows': 3, 'offset': 0, 'rows': self.rows},
+                          ensure_ascii=False).encode('utf-8')
+    
+    def test_byte_at_a_time(self):
+        scanner = RowScanner()
+        rows = []
+        for char in self.response():
+            rows.extend(scanner.feed(char))
+        assert rows == self.rows
+        assert scanner.done
+        assert scanner.buffer == ''
+    
+    def test_iter_rows(self):
+        body = StringIO(self.response())
+        assert list(iter_rows(body, 7)) == self.rows
+        assert body.read() == ''
+    
+    def test_truncated(self):
+        response = self.response()
+        body = StringIO(response[:response.index('"value": {')])
+        self.assertRaises(ValueError, list, iter_rows(body))
+
+
+class TestStreaming(StandInMixin, unittest.TestCase):
+    database = 'streaming-tests'
+    views = SIGNATURE_VIEWS
+    documents = [Signature]
+    sync = True
+    
+    def test_stream(self):
+        with self.app.test_request_context('/'):
+            self.app.preprocess_request()
+            Signature.store_many([
+                Signature(dict(message='Hi %d' % n, author='Steve',
+                               id='sig%04d' % n)) for n in range(3000)])
+            count = 0
+            for n, sig in enumerate(Signature.listing.stream(chunk_size=512)):
+                assert isinstance(sig, Signature)
+                assert sig.id == 'sig%04d' % n
+                assert sig.message == 'Hi %d' % n
+                count += 1
+            assert count == 3000
+            plain = flask_couchdb.ViewDefinition('guestbook', 'listing', '')
+            rows = list(plain.stream(startkey='sig0100', limit=3))
+            assert [row.id for row in rows] == ['sig0100', 'sig0101',
+                                                'sig0102']
+            assert rows[0].value is None
+            rows = list(Signature.listing.stream(keys=['sig0007', 'sig2999']))
+            assert [sig.message for sig in rows] == ['Hi 7', 'Hi 2999']
+    
+    def test_stop_early(self):
+        with self.app.test_request_context('/'):
+            self.app.preprocess_request()
+            Signature.store_many([
+                Signature(dict(message='Hi %d' % n, author='Steve',
+                               id='sig%04d' % n)) for n in range(100)])
+            for sig in Signature.listing.stream():
+                break
+            assert Signature.load('sig0050').message == 'Hi 50'
+
+
+def count_by_author(doc):
+    if doc.get('doc_type') == 'signature':
+        return [(doc.get('author'), 1)]
+    return []
+
+
+def sum_values(keys, values, rereduce):
+    return sum(values)
+
+
+signatures_by_author = flask_couchdb.ViewDefinition('guestbook',
+    'count_by_author', '''\
+    function (doc) {
+        if (doc.doc_type == 'signature') {
+            emit(doc.author, 1);
+        };
+    }''', '_sum', group=True, cache=True)
+
+
+class TestPageCache(StandInMixin, unittest.TestCase):
+    database = 'caching-tests'
+    config = {'COUCHDB_PAGE_CACHE_SIZE': 100,
+              'COUCHDB_PAGE_CACHE_INTERVAL': 0.3}
+    views = SIGNATURE_VIEWS
+    documents = [Signature]
+    sync = True
+    
+    def setUp(self):
+        StandInMixin.setUp(self)
+        store_signatures(self.app, 12, author='Steve')
+    
+    def test_hits_make_no_requests(self):
+        with self.app.test_request_context('/'):
+            self.app.preprocess_request()
+            page1 = flask_couchdb.paginate(Signature.all(), 5)
+            page2 = flask_couchdb.paginate(Signature.all(), 5, page1.next)
+            before = len(self.couch.requests)
+            again = flask_couchdb.paginate(Signature.all(), 5, page1.next)
+            assert len(self.couch.requests) == before
+            assert [sig.id for sig in again.items] == \
+                [sig.id for sig in page2.items]
+            assert isinstance(again.items[0], Signature)
+            assert (again.next, again.prev) == (page2.next, page2.prev)
+            # changing a cached item doesn't change the cache
+            again.items[0].message = 'Changed'
+            third = flask_couchdb.paginate(Signature.all(), 5, page1.next)
+            assert third.items[0].message == 'Hi 5'
+            assert self.manager.page_cache.stats()['hits'] == 2
+            # different options are cached separately
+            flask_couchdb.paginate(Signature.all(descending=True), 5)
+            assert self.couch.count('GET', '_view') == 4
+            flask_couchdb.paginate(Signature.all(), 5, cache=False)
+            assert self.couch.count('GET', '_view') == 5
+    
+    def test_invalidation(self):
+        with self.app.test_request_context('/'):
+            self.app.preprocess_request()
+            assert len(flask_couchdb.paginate(Signature.all(), 20).items) \
+                == 12
+            # stored through a document class, seen right away
+            Signature(dict(message='New', id='sig50')).store()
+            assert len(flask_couchdb.paginate(Signature.all(), 20).items) \
+                == 13
+            # stored behind its back, seen after the interval
+            flask.g.couch.db.save({'_id': 'sig51', 'doc_type': 'signature'})
+            assert len(flask_couchdb.paginate(Signature.all(), 20).items) \
+                == 13
+            time.sleep(0.4)
+            assert len(flask_couchdb.paginate(Signature.all(), 20).items) \
+                == 14
+
+
+class TestViewCache(StandInMixin, unittest.TestCase):
+    database = 'caching-tests'
+    config = {'COUCHDB_VIEW_CACHE_BYTES': 2000,
+              'COUCHDB_VIEW_CACHE_INTERVAL': 0.3}
+    views = SIGNATURE_VIEWS + [
+        ('guestbook', 'count_by_author', count_by_author, sum_values)]
+    documents = [Signature]
+    
+    def setUp(self):
+        StandInMixin.setUp(self)
+        self.manager.add_viewdef(signatures_by_author)
+        self.manager.sync(self.app)
+        with self.app.test_request_context('/'):
+            self.app.preprocess_request()
+            Signature.store_many([
+                Signature(dict(message='Hi %d' % n, id='sig%02d' % n,
+                               author='Author %d' % (n % 3)))
+                for n in range(12)])
+    
+    def counts(self, **options):
+        return dict((row.key, row.value)
+                    for row in signatures_by_author(**options))
+    
+    def test_cached_reduce(self):
+        with self.app.test_request_context('/'):
+            self.app.preprocess_request()
+            expected = {'Author 0': 4, 'Author 1': 4, 'Author 2': 4}
+            assert self.counts() == expected
+            assert self.couch.count('GET', '_view') == 1
+            assert self.counts() == expected
+            assert self.couch.count('GET', '_view') == 1
+            assert self.counts(group=False) == {None: 12}
+            assert self.counts(cache=False) == expected
+            assert self.couch.count('GET', '_view') == 3
+            stats = self.manager.view_cache.stats()
+            assert (stats['hits'], stats['misses']) == (1, 2)
+            assert 0 < stats['bytes'] <= stats['maxbytes']
+            # views that don't ask for it aren't cached
+            assert len(Signature.all().rows) == 12
+            assert len(Signature.all().rows) == 12
+            assert self.couch.count('GET', '_view') == 5
+            assert len(Signature.all(cache=True, limit=2).rows) == 2
+            assert len(Signature.all(cache=True, limit=2).rows) == 2
+            assert self.couch.count('GET', '_view') == 6
+            # results over the memory budget aren't cached
+            assert len(Signature.all(cache=True).rows) == 12
+            assert len(Signature.all(cache=True).rows) == 12
+            assert self.couch.count('GET', '_view') == 8
+    
+    def test_invalidation(self):
+        with self.app.test_request_context('/'):
+            self.app.preprocess_request()
+            assert self.counts()['Author 0'] == 4
+            Signature(dict(message='New', author='Author 0',
+                           id='sig50')).store()
+            assert self.counts()['Author 0'] == 5
+            flask.g.couch.db.save({'_id': 'sig51', 'doc_type': 'signature',
+                                   'author': 'Author 0'})
+            assert self.counts()['Author 0'] == 5
+            time.sleep(0.4)
+            assert self.counts()['Author 0'] == 6
+    
+    def test_memory_budget(self):
+        cache = flask_couchdb.ViewCache(maxbytes=100)
+        cache.put('a', 'x' * 40)
+        cache.put('b', 'x' * 40)
+        assert cache.stats()['bytes'] == 84
+        cache.get('a')
+        cache.put('c', 'x' * 40)
+        assert 'a' in cache and 'c' in cache and 'b' not in cache
+        assert cache.stats()['evictions'] == 1
+        cache.put('d', 'x' * 200)
+        assert 'd' not in cache
+        cache.discard('a')
+        cache.clear()
+        assert cache.stats()['bytes'] == 0
+
+
+THREADS = 16
+ROUNDS = 10
+
+
+class TestPaginationThreads(StandInMixin, unittest.TestCase):
+    database = 'thread-tests'
+    config = {'COUCHDB_POOL_SIZE': THREADS}
+    views = SIGNATURE_VIEWS
+    documents = [Signature]
+    sync = True
+    
+    def setUp(self):
+        StandInMixin.setUp(self)
+        store_signatures(self.app, 30, author='Steve')
+    
+    def test_view_is_not_changed(self):
+        with self.app.test_request_context('/'):
+            self.app.preprocess_request()
+            view = Signature.all()
+            flask_couchdb.paginate(view, 5)
+            assert all(isinstance(sig, Signature) for sig in view)
+    
+    def test_bad_start(self):
+        with self.app.test_request_context('/'):
+            self.app.preprocess_request()
+            for start in ('not json', '42', '["only a key"]'):
+                self.assertRaises(BadRequest, flask_couchdb.paginate,
+                                  Signature.all(), 5, start)
+    
+    def test_many_threads(self):
+        with self.app.test_request_context('/'):
+            self.app.preprocess_request()
+            shared = Signature.all()
+        errors = []
+    
+        def paginate(number):
+            with self.app.test_request_context('/'):
+                self.app.preprocess_request()
+                try:
+                    for _ in range(ROUNDS):
+                        start, ids = None, []
+                        while True:
+                            page = flask_couchdb.paginate(
+                                shared, 7, start, concurrent=bool(number % 2))
+                            for item in page.items:
+                                assert isinstance(item, Signature), item
+                                ids.append(item.id)
+                            if page.next is None:
+                                break
+                            start = page.next
+                        assert ids == ['sig%02d' % n for n in range(30)]
+                        # using the shared view directly still wraps rows
+                        rows = ViewResults(shared.view, {'limit': 2}).rows
+                        assert all(isinstance(row, Signature) for row in rows)
+                except Exception as e:
+                    errors.append(e)
+    
+        threads = [threading.Thread(target=paginate, args=(n,))
+                   for n in range(THREADS)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert errors == []
+        assert shared.view.wrapper is not Row
+
+
+class TestStaleViews(StandInMixin, unittest.TestCase):
+    database = 'stale-tests'
+    config = {'COUCHDB_VIEW_STALE': 'update_after',
+              'COUCHDB_INDEX_WARMER': True,
+              'COUCHDB_INDEX_WARMER_DELAY': 0.1}
+    views = SIGNATURE_VIEWS
+    documents = [Signature]
+    sync = True
+    
+    def stale_of_last_query(self):
+        views = [query for method, path, query in self.couch.requests
+                 if '_view' in path]
+        return views[-1].get('stale')
+    
+    def test_stale_policies(self):
+        with self.app.test_request_context('/'):
+            self.app.preprocess_request()
+            list(Signature.all())
+            assert self.stale_of_last_query() == 'update_after'
+            list(Signature.by_author())
+            assert self.stale_of_last_query() == 'ok'
+            list(Signature.fresh())
+            assert self.stale_of_last_query() is None
+            list(Signature.all(stale='ok'))
+            assert self.stale_of_last_query() == 'ok'
+            list(Signature.by_author(stale=False))
+            assert self.stale_of_last_query() is None
+            list(Signature.all.stream())
+            assert self.stale_of_last_query() == 'update_after'
+            flask_couchdb.paginate(Signature.by_author(), 5)
+            assert self.stale_of_last_query() == 'ok'
+    
+    def test_index_warmer(self):
+        with self.app.test_request_context('/'):
+            self.app.preprocess_request()
+            assert list(self.manager.index_views()) == ['guestbook']
+            for n in range(5):
+                Signature(dict(message='Hi %d' % n, id='sig%d' % n)).store()
+            time.sleep(0.5)
+            warmed = [query for method, path, query in self.couch.requests
+                      if path.startswith('/stale-tests/_design/guestbook/')]
+            assert warmed == [{'limit': 0}]
+            stats = self.manager.index_warmer.stats()
+            assert stats['touched'] == 5
+            assert stats['warmed'] == 1
+            assert stats['pending'] == 0
+    
+    def test_index_warmer_errors(self):
+        failures = []
+        self.manager.on_warm_error(
+            lambda db, design, exc: failures.append((design, exc)))
+        # the views are gone, so querying them fails
+        self.couch.views.clear()
+        with self.app.test_request_context('/'):
+            self.app.preprocess_request()
+            Signature(dict(message='Hi', id='sig0')).store()
+            time.sleep(0.5)
+        assert [design for design, exc in failures] == ['guestbook']
+        assert isinstance(failures[0][1], ResourceNotFound)
+        assert self.manager.index_warmer.stats()['failed'] == 1
+
+
+#: Set to let the indexes of `TestSyncWarming` be built.
+INDEXING = threading.Event()
+
+
+def gated_map(doc):
+    INDEXING.wait(5)
+    if doc.get('doc_type') == 'signature':
+        return [(doc['_id'], doc)]
+    return []
+
+
+class TestSyncWarming(StandInMixin, unittest.TestCase):
+    database = 'warming-tests'
+    views = [(design, 'all', gated_map)
+             for design in ('guestbook', 'guestbook-staging', 'authors')]
+    
+    def setUp(self):
+        INDEXING.clear()
+        StandInMixin.setUp(self)
+        self.manager.add_viewdef(flask_couchdb.ViewDefinition(
+            'guestbook', 'all', ALL_SIGNATURES))
+        for n in range(6):
+            self.db.save({'_id': 'sig%d' % n, 'doc_type': 'signature',
+                          'author': 'Steve'})
+    
+    def tearDown(self):
+        INDEXING.set()
+        StandInMixin.tearDown(self)
+    
+    def test_warm(self):
+        assert self.manager.sync(self.app) is None
+        self.manager.add_viewdef(flask_couchdb.ViewDefinition(
+            'authors', 'all', BY_AUTHOR))
+        self.couch.active_tasks = [{'type': 'indexer',
+                                    'database': 'warming-tests',
+                                    'design_document': '_design/authors',
+                                    'progress': 40}]
+        build = self.manager.sync(self.app, warm=True)
+        # only the design document that changed is built
+        assert build.views == {'authors': 'all'}
+        assert not build.ready
+        assert build.progress() == {'authors': 40}
+        INDEXING.set()
+        assert build.wait(5)
+        assert build.progress() == {'authors': 100}
+        assert build.errors == {}
+        warmed = [query for method, path, query in self.couch.requests
+                  if path == '/warming-tests/_design/authors/_view/all']
+        assert warmed == [{'limit': 0}]
+    
+    def test_staged(self):
+        self.manager.sync(self.app)
+        db = self.manager.db
+        old_rev = db['_design/guestbook']['_rev']
+        self.manager.general_viewdefs = [flask_couchdb.ViewDefinition(
+            'guestbook', 'all', BY_AUTHOR)]
+        build = self.manager.sync(self.app, staged=True)
+        assert build.views == {'guestbook': 'all'}
+        # until the index is built, the old design document stays in place
+        assert db['_design/guestbook']['_rev'] == old_rev
+        assert db['_design/guestbook']['views']['all']['map'] == \
+            ALL_SIGNATURES
+        assert db['_design/guestbook-staging']['views']['all']['map'] == \
+            BY_AUTHOR
+        INDEXING.set()
+        assert build.wait(5)
+        assert build.errors == {}
+        assert db['_design/guestbook']['views']['all']['map'] == BY_AUTHOR
+        assert db.get('_design/guestbook-staging') is None
+        # syncing again doesn't change anything
+        assert self.manager.sync(self.app, staged=True).views == {}
+    
+    def test_staged_hash_recorded_after_swap(self):
+        self.app.config['COUCHDB_SYNC_INCREMENTAL'] = True
+        INDEXING.set()
+        self.manager.sync(self.app)
+        db = self.manager.db
+        old_hash = read_local(db, SYNC_STATE)['hashes']['guestbook']
+        self.manager.general_viewdefs = [flask_couchdb.ViewDefinition(
+            'guestbook', 'all', BY_AUTHOR)]
+        new_hash = design_hashes(self.manager.general_viewdefs)['guestbook']
+        # the staged index can't be built, so it is never swapped in
+        del self.couch.views[('guestbook-staging', 'all')]
+        build = self.manager.sync(self.app, staged=True)
+        assert build.wait(5)
+        assert 'guestbook' in build.errors
+        assert read_local(db, SYNC_STATE)['hashes']['guestbook'] == old_hash
+        # so the next sync stages it again
+        self.couch.add_view('guestbook-staging', 'all', gated_map)
+        build = self.manager.sync(self.app, staged=True)
+        assert build.views == {'guestbook': 'all'}
+        assert build.wait(5)
+        assert build.errors == {}
+        assert read_local(db, SYNC_STATE)['hashes']['guestbook'] == new_hash
+
+
+class TestIncrementalSync(StandInMixin, unittest.TestCase):
+    database = 'sync-tests'
+    config = {'COUCHDB_SYNC_INCREMENTAL': True}
+    
+    def make_manager(self):
+        manager = StandInMixin.make_manager(self)
+        manager.add_viewdef(flask_couchdb.ViewDefinition(
+            'guestbook', 'all', ALL_SIGNATURES))
+        manager.add_viewdef(flask_couchdb.ViewDefinition(
+            'authors', 'all', BY_AUTHOR))
+        return manager
+    
+    def design_requests(self):
+        requests = [(method, path) for method, path, query
+                    in self.couch.requests if '/_design/' in path]
+        del self.couch.requests[:]
+        return requests
+    
+    def test_unchanged_designs_are_skipped(self):
+        self.manager.sync(self.app)
+        db = self.manager.db
+        assert db['_design/guestbook']['views']['all']['map'] == \
+            ALL_SIGNATURES
+        assert sorted(read_local(db, SYNC_STATE)['hashes']) == \
+            ['authors', 'guestbook']
+        self.design_requests()
+        self.manager.sync(self.app)
+        assert self.design_requests() == []
+        # only the design document that changed is fetched and saved
+        self.manager.general_viewdefs[0] = flask_couchdb.ViewDefinition(
+            'guestbook', 'all', BY_AUTHOR)
+        self.manager.sync(self.app)
+        requests = self.design_requests()
+        assert requests
+        assert all(path.endswith('/_design/guestbook')
+                   for method, path in requests)
+        assert db['_design/guestbook']['views']['all']['map'] == BY_AUTHOR
+        # callbacks run either way
+        synced = []
+        self.manager.on_sync(synced.append)
+        self.manager.sync(self.app)
+        assert len(synced) == 1
+    
+    def test_force(self):
+        self.manager.sync(self.app)
+        db = self.manager.db
+        doc = db['_design/authors']
+        doc['views']['all']['map'] = ALL_SIGNATURES
+        db.save(doc)
+        self.manager.sync(self.app)
+        assert db['_design/authors']['views']['all']['map'] == ALL_SIGNATURES
+        self.manager.sync(self.app, force=True)
+        assert db['_design/authors']['views']['all']['map'] == BY_AUTHOR
+    
+    def test_not_incremental(self):
+        self.app.config['COUCHDB_SYNC_INCREMENTAL'] = False
+        self.manager.sync(self.app)
+        self.design_requests()
+        self.manager.sync(self.app)
+        assert self.design_requests()
+        assert read_local(self.manager.db, SYNC_STATE) is None
+    
+    def test_waits_for_lock(self):
+        db = self.manager.db
+        lock = acquire_sync_lock(db, 60)
+        assert lock is not None
+        assert acquire_sync_lock(db, 60) is None
+        other = self.make_manager()
+        done = []
+        thread = threading.Thread(
+            target=lambda: done.append(other.sync(self.app)))
+        thread.start()
+        time.sleep(0.3)
+        # nothing is written while another process holds the lock
+        assert not done
+        assert db.get('_design/guestbook') is None
+        # the lock holder syncs, so the waiting one has nothing left to do
+        viewdefs = tuple(self.manager.all_viewdefs())
+        flask_couchdb.ViewDefinition.sync_many(db, viewdefs)
+        write_local(db, SYNC_STATE, {'hashes': design_hashes(viewdefs)})
+        self.design_requests()
+        release_sync_lock(db, lock)
+        thread.join(5)
+        assert done == [None]
+        assert self.design_requests() == []
+    
+    def test_abandoned_lock(self):
+        self.app.config['COUCHDB_SYNC_LOCK_TIMEOUT'] = 0.2
+        db = self.manager.db
+        assert acquire_sync_lock(db, 0.2) is not None
+        started = time.time()
+        self.manager.sync(self.app)
+        assert time.time() - started >= 0.2
+        assert db['_design/guestbook']['views']['all']['map'] == \
+            ALL_SIGNATURES
+        assert read_local(db, SYNC_LOCK)['expires'] == 0
+    
+    def test_lock_wait_timeout(self):
+        self.app.config['COUCHDB_SYNC_LOCK_WAIT'] = 0.3
+        db = self.manager.db
+        lock = acquire_sync_lock(db, 60)
+        started = time.time()
+        self.assertRaises(flask_couchdb.SyncLockTimeout, self.manager.sync,
+                          self.app)
+        assert 0.3 <= time.time() - started < 2
+        assert db.get('_design/guestbook') is None
+        # the lock is still held by its owner
+        assert read_local(db, SYNC_LOCK)['_rev'] == lock['_rev']
+
+
+class TestChangesFeed(StandInMixin, unittest.TestCase):
+    database = 'changes-tests'
+    feed = 'longpoll'
+    
+    def setUp(self):
+        self.config = {'COUCHDB_CHANGES_FEED': self.feed,
+                       'COUCHDB_CHANGES_BATCH_SIZE': 5,
+                       'COUCHDB_CHANGES_INTERVAL': 0.05,
+                       'COUCHDB_CHANGES_TIMEOUT': 0.5,
+                       'COUCHDB_CHANGES_RETRY_DELAY': 0.05}
+        StandInMixin.setUp(self)
+    
+    def tearDown(self):
+        if self.manager.changes_feed is not None:
+            self.manager.changes_feed.stop(5)
+        StandInMixin.tearDown(self)
+    
+    def make_manager(self):
+        manager = StandInMixin.make_manager(self)
+        self.signatures = []
+        self.everything = []
+        self.batches = []
+        manager.on_changes(self.record_signatures, doc_type=Signature.doc_type)
+        manager.on_changes(self.record_everything)
+        return manager
+    
+    def record_signatures(self, changes):
+        assert flask.g.couch is self.manager
+        self.signatures.extend(change['doc']['message'] for change in changes)
+    
+    def record_everything(self, changes):
+        self.batches.append(len(changes))
+        self.everything.extend(change['id'] for change in changes)
+    
+    def sign(self, start, stop):
+        for n in range(start, stop):
+            Signature(dict(message='Hi %d' % n, id='sig%02d' % n)).store(
+                self.db)
+    
+    def test_follow(self):
+        self.sign(0, 3)
+        feed = self.manager.follow_changes()
+        assert self.manager.follow_changes() is feed
+        wait_for(lambda: len(self.everything) == 3)
+        self.db.save({'_id': 'other', 'doc_type': 'other'})
+        self.sign(3, 12)
+        wait_for(lambda: len(self.everything) == 13)
+        assert sorted(self.signatures) == sorted('Hi %d' % n
+                                                 for n in range(12))
+        assert 'other' in self.everything
+        assert max(self.batches) <= 5
+        wait_for(lambda: feed.stats()['checkpoint'] == 13)
+        assert read_local(self.db, 'flask-couchdb-changes')['since'] == 13
+        stats = feed.stats()
+        assert stats['received'] == stats['handled'] == 13
+        assert stats['failed'] == stats['reconnects'] == 0
+    
+    def test_follow_with_init_app(self):
+        app = flask.Flask(__name__)
+        app.config.update(self.config,
+                          COUCHDB_SERVER=self.app.config['COUCHDB_SERVER'],
+                          COUCHDB_DATABASE=self.database)
+        manager = flask_couchdb.CouchDB()
+        manager.init_app(app)
+        handled, errors = [], []
+        manager.on_changes(lambda changes: handled.append(
+            flask.has_app_context() and flask.g.couch is manager))
+        manager.on_change_error(lambda changes, exc: errors.append(exc))
+        self.sign(0, 3)
+        with app.app_context():
+            feed = manager.follow_changes()
+        try:
+            wait_for(lambda: handled)
+            assert all(handled)
+            assert errors == []
+        finally:
+            feed.stop(5)
+    
+    def test_resume_from_checkpoint(self):
+        self.sign(0, 4)
+        feed = self.manager.follow_changes()
+        wait_for(lambda: feed.stats()['checkpoint'] == 4)
+        feed.stop(5)
+        assert not feed.running
+        self.sign(4, 6)
+        first = self.everything
+        self.manager = self.make_manager()
+        self.manager.follow_changes()
+        wait_for(lambda: len(self.everything) == 2)
+        assert len(first) == 4
+        assert self.everything == ['sig04', 'sig05']
+    
+    def test_reconnect(self):
+        errors = []
+        self.manager.on_change_error(lambda changes, e: errors.append(e))
+        self.couch.fail_changes = 2
+        feed = self.manager.follow_changes()
+        self.sign(0, 3)
+        wait_for(lambda: len(self.everything) == 3)
+        assert feed.stats()['reconnects'] == 2
+        assert len(errors) == 2
+        # a failed request picks up after the last change that was read
+        self.couch.fail_changes = 1
+        self.sign(3, 5)
+        wait_for(lambda: len(self.everything) == 5)
+        assert self.everything == ['sig%02d' % n for n in range(5)]
+    
+    def test_handler_errors(self):
+        errors = []
+        self.manager.on_change_error(
+            lambda changes, e: errors.append((len(changes), e)))
+        def fail(changes):
+            raise ValueError('oops')
+        self.manager.on_changes(fail, doc_type='signature')
+        feed = self.manager.follow_changes()
+        self.sign(0, 2)
+        wait_for(lambda: feed.stats()['checkpoint'] == 2)
+        assert self.everything == ['sig00', 'sig01']
+        assert sum(n for n, e in errors) == 2
+        assert feed.stats()['failed'] == len(errors)
+    
+    def test_backpressure(self):
+        self.app.config['COUCHDB_CHANGES_MAX_PENDING'] = 1
+        release = threading.Event()
+        self.manager.on_changes(lambda changes: release.wait(5))
+        self.sign(0, 30)
+        feed = self.manager.follow_changes()
+        time.sleep(0.5)
+        stats = feed.stats()
+        # one batch is being handled and one is waiting, and the feed stops
+        # reading once the queue of batch_size * max_pending changes is full
+        assert stats['handled'] == 0
+        assert stats['waits'] == 1
+        assert stats['received'] <= 5 + 5 + 5 + 1
+        release.set()
+        wait_for(lambda: feed.stats()['checkpoint'] == 30)
+        assert len(self.everything) == 30
+
+
+class TestContinuousChangesFeed(TestChangesFeed):
+    feed = 'continuous'
+
+
+class CountingCodec(object):
+    def __init__(self):
+        self.decoded = self.encoded = 0
+    
+    def decode(self, data):
+        self.decoded += 1
+        return json.loads(data)
+    
+    def encode(self, obj):
+        self.encoded += 1
+        return unicode(json.dumps(obj, ensure_ascii=False))
+
+class TestJSONCodec(StandInMixin, unittest.TestCase):
+    database = 'codec-tests'
+    views = SIGNATURE_VIEWS
+    documents = [Signature]
+    
+    def setUp(self):
+        self.codec = CountingCodec()
+        self.config = {'COUCHDB_JSON': (self.codec.decode, self.codec.encode)}
+        StandInMixin.setUp(self)
+    
+    def tearDown(self):
+        codec.use('json')
+        StandInMixin.tearDown(self)
+    
+    def test_requests_and_tokens(self):
+        with self.app.test_request_context('/'):
+            self.app.preprocess_request()
+            for n in range(5):
+                Signature(dict(message=u'H\xe9 %d' % n,
+                               id='sig%d' % n)).store()
+            assert self.codec.encoded >= 5
+            assert self.codec.decoded >= 5
+            assert Signature.load('sig0').message == u'H\xe9 0'
+            decoded = self.codec.decoded
+            page = flask_couchdb.paginate(Signature.all(), 2)
+            assert self.codec.decoded > decoded
+            assert page.next == codec.encode(['sig2', 'sig2'])
+            decoded = self.codec.decoded
+            page = flask_couchdb.paginate(Signature.all(), 2, page.next)
+            assert [s.id for s in page.items] == ['sig2', 'sig3']
+            assert json.loads(page.prev) == ['sig0', 'sig0']
+            assert self.codec.decoded > decoded
+    
+    def test_named_codecs(self):
+        codec.use('json')
+        assert codec.decode(codec.encode({'a': u'\xe9'})) == {'a': u'\xe9'}
+        assert isinstance(codec.encode([1]), unicode)
+        self.assertRaises(ValueError, codec.use, 'no-such-json')
+    
+    def test_floats_round_trip(self):
+        values = [0.1, 0.5, 3.141592653589793, 1234.56789012345, 1e-07,
+                  2.5e+20, -42.125]
+        for name in sorted(codec.CODECS):
+            try:
+                codec.use(name)
+            except ImportError:
+                continue
+            assert codec.decode(codec.encode(values)) == values, name
+            doc = Signature(dict(message='Hi', id='sig-%s' % name))
+            doc._data['score'] = 1234.56789012345
+            doc.store(self.db)
+            assert self.db[doc.id]['score'] == 1234.56789012345, name
+            assert Signature.load(doc.id, self.db).changed_fields() == []
+
+
+class Visitor(flask_couchdb.Document):
+    doc_type = 'signature'
+    
+    message = flask_couchdb.TextField()
+    author = flask_couchdb.TextField(name='by')
+    time = flask_couchdb.DateTimeField()
+    
+    all = flask_couchdb.ViewField('guestbook', ALL_SIGNATURES)
+    listing = flask_couchdb.ViewField('guestbook', SIGNATURE_IDS,
+                                      include_docs=True, records=True)
+
+
+class TestRecords(StandInMixin, unittest.TestCase):
+    database = 'records-tests'
+    views = SIGNATURE_VIEWS + [
+        ('blog', 'all', lambda doc:
+            [(doc['_id'], doc)] if doc.get('doc_type') == 'Post' else [])]
+    documents = [Visitor, Post]
+    
+    def setUp(self):
+        StandInMixin.setUp(self)
+        for n in range(5):
+            self.db.save({'_id': 'sig%d' % n, 'doc_type': 'signature',
+                          'message': 'Hi %d' % n, 'by': 'Steve',
+                          'time': '2010-06-01T12:00:0%dZ' % n})
+        for n in range(3):
+            Post(dict(_id='post%d' % n, title='Post %d' % n,
+                      tags=['a'])).store(self.db)
+    
+    def test_records(self):
+        with self.app.test_request_context('/'):
+            self.app.preprocess_request()
+            records = list(Visitor.all(records=True))
+            record = records[0]
+            assert type(record).__name__ == 'VisitorRecord'
+            assert record._fields == ('id', 'rev', 'author', 'message',
+                                      'time')
+            assert record.id == 'sig0'
+            assert record.rev.startswith('1-')
+            assert record.author == 'Steve'
+            assert record.message == 'Hi 0'
+            # values aren't converted
+            assert record.time == '2010-06-01T12:00:00Z'
+            assert not hasattr(record, '__dict__')
+            self.assertRaises(AttributeError, setattr, record, 'message', '')
+            self.assertRaises(AttributeError, setattr, record, 'other', '')
+            assert record == list(Visitor.all(records=True))[0]
+            assert record._asdict()['message'] == 'Hi 0'
+            # without records, the view returns documents as usual
+            assert isinstance(list(Visitor.all())[0], Visitor)
+    
+    def test_records_by_default(self):
+        with self.app.test_request_context('/'):
+            self.app.preprocess_request()
+            records = list(Visitor.listing())
+            assert [r.message for r in records] == \
+                ['Hi %d' % n for n in range(5)]
+            assert isinstance(list(Visitor.listing(records=False))[0],
+                              Visitor)
+            assert [r.id for r in Visitor.listing.stream()] == \
+                ['sig%d' % n for n in range(5)]
+            page = flask_couchdb.paginate(Visitor.listing(), 2)
+            assert [r.id for r in page.items] == ['sig0', 'sig1']
+            assert type(page.items[0]).__name__ == 'VisitorRecord'
+    
+    def test_paginate_fields_by_attribute(self):
+        with self.app.test_request_context('/'):
+            self.app.preprocess_request()
+            page = flask_couchdb.paginate(Visitor.all(), 2,
+                                          fields=['author'])
+            visitor = page.items[0]
+            assert isinstance(visitor, Visitor)
+            assert visitor.author == 'Steve'
+            assert visitor.message is None
+    
+    def test_schematics_records(self):
+        with self.app.test_request_context('/'):
+            self.app.preprocess_request()
+            records = list(Post.all(records=True))
+            assert records[0]._fields == ('id', 'rev', 'body', 'created',
+                                          'doc_type', 'tags', 'title')
+            assert records[0].title == 'Post 0'
+            assert records[0].tags == ['a']
+            assert records[0].doc_type == 'Post'
+    
+    def test_no_document_class(self):
+        view = flask_couchdb.ViewDefinition('guestbook', 'all', '')
+        with self.app.test_request_context('/'):
+            self.app.preprocess_request()
+            self.assertRaises(ValueError, view, records=True)
+
+
+def partial_update(doc, body):
+    # what UPDATE_HANDLER does
+    if doc is None:
+        raise HTTPError(404, 'not_found', 'missing')
+    if doc['_rev'] != body['_rev']:
+        raise HTTPError(409, 'conflict', 'Document update conflict.')
+    doc.update(body['set'])
+    for key in body['unset']:
+        doc.pop(key, None)
+    return doc, {'ok': True, 'id': doc['_id']}
+
+class TestPartialUpdates(StandInMixin, unittest.TestCase):
+    database = 'partial-tests'
+    config = {'COUCHDB_UPDATE_HANDLER': 'docs/partial'}
+    
+    def setUp(self):
+        StandInMixin.setUp(self)
+        self.couch.add_update('docs', 'partial', partial_update)
+        self.db.save({'_id': 'sig', 'doc_type': 'signature',
+                      'message': 'Hello', 'author': 'Steve',
+                      'time': '2010-06-01T12:00:00Z', 'big': 'x' * 10000})
+        self.db.save({'_id': 'post', 'doc_type': 'Post', 'title': 'Hello',
+                      'body': 'x' * 10000, 'tags': ['a'],
+                      'created': '2010-06-01T12:00:00Z'})
+    
+    def writes(self):
+        return [r for r in self.couch.requests if r[0] in ('PUT', 'POST')]
+    
+    def test_unchanged_documents(self):
+        with self.app.test_request_context('/'):
+            self.app.preprocess_request()
+            sig = Signature.load('sig')
+            post = Post.load('post')
+            assert sig.changed_fields() == []
+            assert post.changed_fields() == []
+            writes = len(self.writes())
+            sig.store()
+            post.store()
+            assert Signature.store_many([sig]).ok
+            assert Post.store_many([post]).ok
+            assert len(self.writes()) == writes
+            assert sig.rev == self.db['sig']['_rev']
+            new = Signature(dict(message='New'))
+            assert new.changed_fields() == sorted(new._data)
+            assert 'message' in new.changed_fields()
+    
+    def test_changes_in_place(self):
+        class Note(schematics_document.Document):
+            extra = schematics_document.BaseType()
+        sig = Signature.wrap({'_id': 'sig', 'doc_type': 'signature',
+                              'message': 'Hi', 'extra': {'a': [1]}})
+        sig._data['extra']['a'].append(2)
+        assert sig.changed_fields() == ['extra']
+        data = {'_id': 'post', 'doc_type': 'Post', 'tags': ['a']}
+        post = Post.wrap(data)
+        # the JSON is kept as it is, since the document has copies
+        assert post._loaded is data
+        post.tags.append('b')
+        assert post.changed_fields() == ['tags']
+        assert data['tags'] == ['a']
+        note = Note.wrap({'_id': 'note', 'doc_type': 'Note',
+                          'extra': {'a': 1}})
+        note.extra['a'] = 2
+        assert note.changed_fields() == ['extra']
+    
+    def test_partial_update(self):
+        with self.app.test_request_context('/'):
+            self.app.preprocess_request()
+            sig = Signature.load('sig')
+            sig.message = 'Goodbye'
+            del sig._data['author']
+            assert sig.changed_fields() == ['author', 'message']
+            sig.store()
+            assert self.writes()[-1][1].endswith('/_update/partial/sig')
+            stored = self.db['sig']
+            assert stored['_rev'] == sig.rev
+            assert stored['message'] == 'Goodbye'
+            assert 'author' not in stored
+            assert stored['big'] == 'x' * 10000
+            assert sig.changed_fields() == []
+            post = Post.load('post')
+            post.tags.append('b')
+            assert post.changed_fields() == ['tags']
+            post.store()
+            assert self.writes()[-1][1].endswith('/_update/partial/post')
+            stored = self.db['post']
+            assert stored['_rev'] == post.rev
+            assert stored['tags'] == ['a', 'b']
+            assert stored['created'] == '2010-06-01T12:00:00Z'
+            writes = len(self.writes())
+            post.store()
+            assert len(self.writes()) == writes
+    
+    def test_conflict(self):
+        with self.app.test_request_context('/'):
+            self.app.preprocess_request()
+            sig = Signature.load('sig')
+            other = self.db['sig']
+            other['author'] = 'Fred'
+            self.db.save(other)
+            sig.message = 'Goodbye'
+            self.assertRaises(ResourceConflict, sig.store)
+            assert self.db['sig']['message'] == 'Hello'
+    
+    def test_whole_documents(self):
+        with self.app.test_request_context('/'):
+            self.app.preprocess_request()
+            sig = Signature.load('sig')
+            sig.message = 'Goodbye'
+            sig.store(partial=False)
+            assert self.writes()[-1][1].endswith('/sig')
+            assert '_update' not in self.writes()[-1][1]
+            post = Post.load('post')
+            post.title = 'Goodbye'
+            assert Post.store_many([post]).ok
+            assert self.writes()[-1][1].endswith('/_bulk_docs')
+            assert self.db['post']['title'] == 'Goodbye'
+            assert post.changed_fields() == []
+            # a new document is always saved whole
+            Signature(dict(id='new', message='New')).store()
+            assert self.writes()[-1][1].endswith('/new')
+    
+    def test_missing_handler(self):
+        self.couch.updates.clear()
+        with self.app.test_request_context('/'):
+            self.app.preprocess_request()
+            post = Post.load('post')
+            post.title = 'Goodbye'
+            post.store()
+            assert self.db['post']['title'] == 'Goodbye'
+            assert self.db['post']['_rev'] == post.rev
+    
+    def test_sync_installs_handler(self):
+        self.manager.sync(self.app)
+        design = self.db['_design/docs']
+        assert design['updates']['partial'] == UPDATE_HANDLER
+        rev = design['_rev']
+        self.manager.sync(self.app)
+        assert self.db['_design/docs']['_rev'] == rev
+
+
+class Counter(flask_couchdb.Document):
+    doc_type = 'counter'
+    
+    count = flask_couchdb.IntegerField(default=0)
+
+
+class Total(schematics_document.Document):
+    count = schematics_document.IntType(default=0)
+
+class TestUpdateRetries(StandInMixin, unittest.TestCase):
+    database = 'retry-tests'
+    config = {'COUCHDB_IDENTITY_MAP': True}
+    
+    def setUp(self):
+        StandInMixin.setUp(self)
+        self.db.save({'_id': 'hits', 'doc_type': 'counter', 'count': 1})
+        self.db.save({'_id': 'total', 'doc_type': 'Total', 'count': 10})
+    
+    def increment(self, conflicts):
+        # another client saves the document before the first `conflicts`
+        # attempts are stored
+        calls = []
+        def fn(doc):
+            calls.append(doc.count)
+            if len(calls) <= conflicts:
+                other = self.db[doc.id]
+                other['count'] += 1
+                self.db.save(other)
+            doc.count += 1
+        return fn, calls
+    
+    def test_retry_after_conflict(self):
+        with self.app.test_request_context('/'):
+            self.app.preprocess_request()
+            stale = Counter.load('hits')
+            fn, calls = self.increment(2)
+            delays = []
+            doc = Counter.update('hits', fn,
+                                 backoff=lambda n: delays.append(n) or 0)
+            assert calls == [1, 2, 3]
+            assert delays == [0, 1]
+            assert doc.count == 4
+            assert self.db['hits']['count'] == 4
+            assert self.db['hits']['_rev'] == doc.rev
+            assert Counter.load('hits') is doc
+            assert stale.count == 1
+            fn, calls = self.increment(1)
+            doc = Total.update('total', fn, backoff=0)
+            assert calls == [10, 11]
+            assert self.db['total']['count'] == 12
+            stats = self.manager.conflict_stats.stats()
+            assert stats['counter'] == {
+                'updates': 1, 'attempts': 3, 'conflicts': 2, 'failed': 0,
+                'max_conflicts': 2, 'conflict_rate': 2 / 3.0}
+            assert stats['Total']['conflict_rate'] == 0.5
+    
+    def test_retries_run_out(self):
+        with self.app.test_request_context('/'):
+            self.app.preprocess_request()
+            fn, calls = self.increment(10)
+            self.assertRaises(ResourceConflict, Counter.update, 'hits', fn,
+                              retries=2, backoff=0)
+            assert len(calls) == 3
+            assert self.db['hits']['count'] == 4
+            Counter.update('hits', self.increment(0)[0])
+            stats = self.manager.conflict_stats.stats()['counter']
+            assert stats['updates'] == 2
+            assert stats['attempts'] == 4
+            assert stats['failed'] == 1
+            self.manager.conflict_stats.reset()
+            assert self.manager.conflict_stats.stats() == {}
+    
+    def test_missing_documents(self):
+        with self.app.test_request_context('/'):
+            self.app.preprocess_request()
+            fn, calls = self.increment(0)
+            doc = Counter.update('new', fn)
+            assert calls == [0]
+            assert self.db['new']['count'] == 1
+            assert self.db['new']['doc_type'] == 'counter'
+            # created by someone else at the same time
+            def create(doc):
+                if doc.rev is None:
+                    self.db.save({'_id': 'other', 'doc_type': 'Total',
+                                  'count': 5})
+                doc.count += 1
+            doc = Total.update('other', create, backoff=0)
+            assert doc.count == 6
+            assert self.db['other']['count'] == 6
+    
+    def test_write_behind(self):
+        self.app.config['COUCHDB_WRITE_BEHIND'] = True
+        manager = flask_couchdb.CouchDB(app=self.app)
+        manager.connect_db(self.app)
+        with self.app.test_request_context('/'):
+            self.app.preprocess_request()
+            doc = Counter.update('hits', self.increment(1)[0], backoff=0)
+            # stored right away, so conflicts can be retried
+            assert self.db['hits']['count'] == 3
+            assert self.db['hits']['_rev'] == doc.rev
+            assert manager.conflict_stats.stats()['counter']['conflicts'] == 1
+        manager.write_behind.close()
+    
+    def test_write_behind_disabled(self):
+        def hooks():
+            return [h for h in atexit._exithandlers if h[0] == manager.close]
+        manager = flask_couchdb.CouchDB()
+        manager.init_app(self.app)
+        manager.init_app(self.app)
+        assert manager.write_behind is None
+        assert hooks() == []
+        # queued anyway when asked to, and only closed once at exit
+        manager.connect_db(self.app)
+        with self.app.test_request_context('/'):
+            self.app.preprocess_request()
+            Counter(dict(count=1, id='deferred')).store(defer=True)
+            Counter(dict(count=2, id='again')).store(defer=True)
+            manager.flush()
+        assert self.db['deferred']['count'] == 1
+        manager.init_app(self.app)
+        assert len(hooks()) == 1
+        manager.close()
+        atexit._exithandlers.remove(hooks()[0])
+    
+    def test_backoff_delay(self):
+        for attempt in range(10):
+            delay = backoff_delay(0.1, attempt)
+            assert 0 <= delay <= min(MAX_BACKOFF, 0.1 * 2 ** attempt)
+        assert backoff_delay(lambda n: n * 2, 3) == 6
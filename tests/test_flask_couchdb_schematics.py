@@ -10,6 +10,9 @@ It should be run using Nose. It will attempt to use the CouchDB server at
 override these with the environment variables `FLASKEXT_COUCHDB_SERVER` and
 `FLASKEXT_COUCHDB_DATABASE`.
 
+The test cases built on `couchdb_standin.StandInMixin` run against an
+in-process stand-in instead, so they don't need a CouchDB server.
+
 :copyright: 2010 Matthew "LeafStorm" Frazier
 :license:   MIT/X11, see LICENSE for details
 """
@@ -20,8 +23,16 @@ import couchdb
 import flask
 import flask.ext.couchdb
 from couchdb.tests import testutil
-from couchdb.http import ResourceNotFound
+from couchdb.http import ResourceConflict, ResourceNotFound
+from couchdb_schematics.document import Document as BaseDocument
 from datetime import datetime
+from schematics.exceptions import DataError
+from schematics.transforms import whitelist
+from flask_couchdb import schematics_document
+from flask_couchdb.schematics_document import (StringType, IntType,
+                                               DateTimeType, ListType,
+                                               DictType, ModelType)
+from couchdb_standin import StandInMixin
 
 # this should be added to couchdb.tests.testutil.TempDatabaseMixin
 # SERVER = os.environ.get('FLASKEXT_COUCHDB_SERVER', 'http://localhost:5984/')
@@ -129,6 +140,110 @@ class TestFlaskCouchDBWithSchematics(testutil.TempDatabaseMixin, unittest.TestCa
             assert post.title == 'Hello'
             assert post.doc_type == 'BlogPost'
     
+    def test_identity_map(self):
+        self.app.config['COUCHDB_IDENTITY_MAP'] = True
+        with self.app.test_request_context('/'):
+            self.app.preprocess_request()
+            post = BlogPost(dict(title='Hello', text='Hello, world!',
+                            author='Steve Person'))
+            post.id = 'hello'
+            post.store()
+            assert BlogPost.load('hello') is post
+            assert BlogPost.load('hello') is BlogPost.load('hello')
+            post.delete_instance()
+            assert BlogPost.load('hello') is None
+        with self.app.test_request_context('/'):
+            self.app.preprocess_request()
+            assert len(flask.g.couch.identity_map) == 0
+    
+    def test_document_cache(self):
+        cache = flask.ext.couchdb.DocumentCache(10)
+        self.manager.document_cache = cache
+        with self.app.test_request_context('/'):
+            self.app.preprocess_request()
+            post = BlogPost(dict(title='Hello', text='Hello, world!',
+                            author='Steve Person'))
+            post.id = 'hello'
+            post.store()
+            first = BlogPost.load('hello')
+            second = BlogPost.load('hello')
+            assert first is not second
+            assert second.title == 'Hello'
+            assert cache.stats()['misses'] == 1
+            assert cache.stats()['hits'] == 1
+            second.title = 'Changed'
+            second.store()
+            assert BlogPost.load('hello').title == 'Changed'
+            raw = flask.g.couch.db['hello']
+            raw['title'] = 'Raw'
+            flask.g.couch.db['hello'] = raw
+            assert BlogPost.load('hello').title == 'Raw'
+            assert cache.stats()['misses'] == 3
+    
+    def test_load_many(self):
+        with self.app.test_request_context('/'):
+            self.app.preprocess_request()
+            for post in SAMPLE_POSTS:
+                post.store()
+            posts = BlogPost.load_many(['3', 'missing', '1', '2'],
+                                       batch_size=2)
+            assert [p and p.id for p in posts] == ['3', None, '1', '2']
+            assert all(isinstance(p, BlogPost) for p in posts if p)
+            assert posts[0].title == 'N3'
+            assert BlogPost.load_many([]) == []
+    
+    def test_store_and_delete_many(self):
+        with self.app.test_request_context('/'):
+            self.app.preprocess_request()
+            posts = [BlogPost(dict(title='N%d' % n, text='number %d' % n,
+                                   author='Foo', id='bulk%d' % n))
+                     for n in range(5)]
+            result = BlogPost.store_many(posts, batch_size=2)
+            assert result.ok
+            assert len(result.succeeded) == 5
+            assert all(post.rev is not None for post in posts)
+            stale = BlogPost.load('bulk0')
+            posts[0].title = 'Changed'
+            posts[0].store()
+            stale.title = 'Conflicting'
+            result = BlogPost.store_many([posts[1], stale])
+            assert result.succeeded == [posts[1]]
+            assert result.conflicts == [stale]
+            result = BlogPost.delete_many(posts)
+            assert result.ok
+            assert 'bulk0' not in flask.g.couch.db
+            invalid = BlogPost(dict(title='Bad', id='bad'))
+            invalid.tags = 'not a list'
+            result = BlogPost.store_many([invalid])
+            assert not result.ok
+            assert 'bad' not in flask.g.couch.db
+    
+    def test_write_behind(self):
+        errors = []
+        self.manager.on_write_error(lambda doc, exc: errors.append(doc))
+        self.manager.defer_writes = True
+        with self.app.test_request_context('/'):
+            self.app.preprocess_request()
+            posts = [BlogPost(dict(title='N%d' % n, text='number %d' % n,
+                                   author='Foo', id='later%d' % n))
+                     for n in range(3)]
+            for post in posts:
+                post.store()
+            flask.g.couch.flush()
+            assert all(post.rev is not None for post in posts)
+            assert BlogPost.load('later1').title == 'N1'
+            stale = BlogPost.load('later0')
+            posts[0].title = 'Changed'
+            posts[0].store(defer=False)
+            stale.text = 'Stale'
+            stale.store()
+            flask.g.couch.flush()
+            assert errors == [stale]
+            stats = flask.g.couch.write_behind.stats()
+            assert stats['depth'] == 0
+            assert stats['written'] == 3
+            assert stats['failed'] == 1
+    
     def test_loading_nonexistent(self):
         with self.app.test_request_context('/'):
             self.app.preprocess_request()
@@ -202,6 +317,208 @@ class TestFlaskCouchDBWithSchematics(testutil.TempDatabaseMixin, unittest.TestCa
             assert isinstance(page2.prev, basestring)
             
     
+    def test_lazy_page_items(self):
+        paginate = flask.ext.couchdb.paginate
+        self.manager.add_document(BlogPost)
+        self.manager.sync(self.app)
+        with self.app.test_request_context('/'):
+            self.app.preprocess_request()
+            flask.g.couch.db.update(POSTS_FOR_PAGINATION)
+            
+            wrapped = []
+            view = BlogPost.all_posts()
+            wrapper = view.view.wrapper
+            view.view.wrapper = lambda row: wrapped.append(row) or wrapper(row)
+            page = paginate(view, 10)
+            assert len(page.items) == 10
+            assert wrapped == []
+            assert page.items[3].id == '0004'
+            assert page.items[3] is page.items[3]
+            assert len(wrapped) == 1
+            assert [post.id for post in page.items[:2]] == ['0001', '0002']
+            assert [post.id for post in page.items][-1] == '0010'
+            assert len(wrapped) == 10
+            
+            page = paginate(BlogPost.all_posts(), 5, fields=['title'])
+            post = page.items[0]
+            assert isinstance(post, BlogPost)
+            assert post.id == '0001'
+            assert post.title == 'N1'
+            assert post.text is None
+    
     def test_paging_keys(self):
         pass
 
+
+# The test cases below run against the in-process CouchDB stand-in.
+
+class Author(schematics_document.Model):
+    name = StringType()
+
+
+class Post(schematics_document.Document):
+    title = StringType(required=True)
+    score = IntType(default=3)
+    created = DateTimeType()
+    tags = ListType(StringType())
+    author = ModelType(Author)
+    extra = DictType(StringType, serialized_name='x')
+    validated = []
+    
+    def validate_title(self, data, value):
+        Post.validated.append(value)
+        return value
+
+
+class OrderedPost(schematics_document.Document):
+    title = StringType()
+    body = StringType(serialize_when_none=True)
+    
+    class Options(object):
+        export_order = True
+        roles = {'default': whitelist('title', 'body', '_id')}
+
+
+class InitPost(schematics_document.Document):
+    title = StringType()
+    
+    def __init__(self, raw_data=None, deserialize_mapping=None):
+        super(InitPost, self).__init__(raw_data, deserialize_mapping)
+        self.title = self.title or 'untitled'
+
+
+RAW = [
+    {'_id': 'p1', '_rev': '1-a', 'doc_type': 'Post', 'title': 'One',
+     'score': 5, 'created': '2010-06-01T12:00:00Z', 'tags': ['a', 'b'],
+     'author': {'name': 'Steve'}, 'x': {'k': 'v'}},
+    {'id': 'p2', 'title': 'Two', 'tags': []},
+    {'doc_id': 'p3', 'score': '7'},
+    {},
+]
+
+BAD = [
+    {'_id': 'p4', 'title': 'Rogue', 'other': 1},
+    {'_id': 'p5', 'title': 'Bad', 'score': 'many'},
+    {'_id': 'p6', 'created': 'yesterday', 'tags': 'a'},
+]
+
+
+def generic_wrap(cls, data):
+    return BaseDocument.wrap.im_func(cls, data)
+
+
+def generic_json(doc):
+    return BaseDocument.to_primitive(doc)
+
+
+def import_errors(wrap, raw):
+    try:
+        wrap(dict(raw))
+    except DataError, exc:
+        return exc.to_primitive()
+
+
+def validation_errors(doc):
+    try:
+        doc.validate()
+    except DataError, exc:
+        return exc.to_primitive()
+
+
+def same_state(a, b):
+    return (type(a) is type(b) and dict(a._data) == dict(b._data) and
+            a._data.converted == b._data.converted and
+            dict(a._data.valid) == dict(b._data.valid))
+
+
+class TestSchematicsConverter(StandInMixin, unittest.TestCase):
+    database = 'converter-tests'
+    
+    def setUp(self):
+        StandInMixin.setUp(self)
+        del Post.validated[:]
+    
+    def test_load(self):
+        for raw in RAW:
+            doc = Post.wrap(dict(raw))
+            expected = generic_wrap(Post, dict(raw))
+            assert same_state(doc, expected), raw
+            assert doc == expected
+            assert doc.to_primitive() == generic_json(expected)
+            assert validation_errors(doc) == validation_errors(expected)
+            assert same_state(doc, expected), raw
+        assert isinstance(Post.wrap(RAW[0]).author, Author)
+    
+    def test_load_errors(self):
+        for raw in BAD:
+            compiled = import_errors(Post.wrap, raw)
+            assert compiled is not None
+            assert compiled == import_errors(
+                lambda data: generic_wrap(Post, data), raw), raw
+    
+    def test_export(self):
+        for raw in RAW:
+            doc = Post.wrap(dict(raw))
+            assert doc.to_primitive() == generic_json(doc)
+            doc.tags = None
+            doc.score = None
+            assert doc.to_primitive() == generic_json(doc)
+        doc = OrderedPost.wrap({'_id': 'o1', 'title': 'Ordered'})
+        assert doc.to_primitive() == generic_json(doc)
+        assert list(doc.to_primitive()) == list(generic_json(doc))
+    
+    def test_custom_init(self):
+        doc = InitPost.wrap({'_id': 'i1'})
+        assert doc.title == 'untitled'
+        assert same_state(doc, generic_wrap(InitPost, {'_id': 'i1'}))
+    
+    def test_store_validates_changes_only(self):
+        with self.app.test_request_context('/'):
+            self.app.preprocess_request()
+            post = Post(dict(_id='s1', title='Stored', tags=['a']))
+            post.store()
+            assert Post.validated == ['Stored']
+            post.tags.append('b')
+            post.store()
+            assert Post.validated == ['Stored', 'Stored']
+            assert sorted(post._data.converted) == ['_id', '_rev']
+            post.title = 'Changed'
+            post.store()
+            assert Post.validated == ['Stored', 'Stored', 'Changed']
+            post.title = ''
+            post.store(validate=False)
+            assert Post.validated == ['Stored', 'Stored', 'Changed']
+            stored = self.db['s1']
+            assert stored['tags'] == ['a', 'b']
+            assert Post.load('s1', self.db).to_primitive() == \
+                generic_json(generic_wrap(Post, dict(stored)))
+            # retrying after a conflict doesn't validate again
+            stored['title'] = 'Elsewhere'
+            self.db.save(stored)
+            post.title = 'Retried'
+            self.assertRaises(ResourceConflict, post.store)
+            self.assertRaises(ResourceConflict, post.store)
+            assert Post.validated[-1:] == ['Retried']
+            assert len(Post.validated) == 4
+    
+    def test_store_many(self):
+        with self.app.test_request_context('/'):
+            self.app.preprocess_request()
+            posts = [Post(dict(_id='m%d' % n, title='Post %d' % n))
+                     for n in range(3)]
+            assert Post.store_many(posts).ok
+            assert len(Post.validated) == 3
+            for post in posts:
+                post.tags = ['new']
+            stored = self.db['m0']
+            self.db.save(stored)
+            result = Post.store_many(posts)
+            assert result.conflicts == [posts[0]]
+            assert len(Post.validated) == 6
+            result = Post.store_many(posts)
+            assert result.conflicts == [posts[0]]
+            assert len(Post.validated) == 6
+            posts[1].title = None
+            result = Post.store_many(posts)
+            assert result.failed == [posts[0], posts[1]]
+            assert self.db['m2']['_rev'].startswith('2-')